@@ -0,0 +1,192 @@
+port module ApiCache exposing (..)
+
+import Http
+import Json.Decode as Decode exposing (Decoder, Value)
+import Json.Decode.Pipeline exposing (hardcoded, required)
+import Json.Encode as Encode
+import RemoteData exposing (WebData)
+import Task
+
+
+
+-- TYPES --
+
+
+type alias ApiCache =
+    { dataload : String -- "updated_on" of the dataload the entries are from
+    , entries : List Entry -- Responses, most recently used first
+    , confirmed : Bool -- The server is known to still have that dataload
+    }
+
+
+type alias Entry =
+    { key : String
+    , value : Value
+    , size : Int -- Characters of JSON, as stored
+    }
+
+
+maxEntries : Int
+maxEntries =
+    100
+
+
+{-| Characters of JSON kept; localStorage usually allows 5 MB in all
+-}
+maxSize : Int
+maxSize =
+    2000000
+
+
+
+-- SERIALIZATION --
+
+
+decoder : Decoder ApiCache
+decoder =
+    Decode.oneOf
+        [ Decode.succeed ApiCache
+            |> required "dataload" Decode.string
+            |> required "entries"
+                (Decode.list
+                    (Decode.map2 entry
+                        (Decode.index 0 Decode.string)
+                        (Decode.index 1 Decode.value)
+                    )
+                )
+            |> hardcoded False
+
+        -- Start over rather than fail on anything unreadable
+        , Decode.succeed empty
+        ]
+
+
+encode : ApiCache -> Value
+encode cache =
+    Encode.object
+        [ ( "dataload", Encode.string cache.dataload )
+        , ( "entries"
+          , Encode.list
+                (\e -> Encode.list identity [ Encode.string e.key, e.value ])
+                cache.entries
+          )
+        ]
+
+
+{-| Save the cache, unless it is not yet known which dataload its
+entries are from
+-}
+store : ApiCache -> Cmd msg
+store cache =
+    if cache.dataload == "" then
+        Cmd.none
+
+    else
+        encode cache
+            |> storeApiCache
+
+
+port storeApiCache : Value -> Cmd msg
+
+
+
+-- UTILITY FUNCTIONS --
+
+
+empty : ApiCache
+empty =
+    { dataload = ""
+    , entries = []
+    , confirmed = False
+    }
+
+
+entry : String -> Value -> Entry
+entry key value =
+    { key = key
+    , value = value
+    , size = String.length key + String.length (Encode.encode 0 value)
+    }
+
+
+get : String -> ApiCache -> Maybe Value
+get key cache =
+    List.filter (\e -> e.key == key) cache.entries
+        |> List.head
+        |> Maybe.map .value
+
+
+{-| Remember a response, dropping the least recently used beyond the cap
+on entries and any that would take the cache over its size
+-}
+insert : String -> Value -> ApiCache -> ApiCache
+insert key value cache =
+    let
+        fits e ( kept, size ) =
+            if size + e.size <= maxSize then
+                ( e :: kept, size + e.size )
+
+            else
+                ( kept, size )
+    in
+    { cache
+        | entries =
+            entry key value
+                :: List.filter (\e -> e.key /= key) cache.entries
+                |> List.take maxEntries
+                |> List.foldl fits ( [], 0 )
+                |> Tuple.first
+                |> List.reverse
+    }
+
+
+{-| Remember a successful response
+-}
+remember : String -> WebData Value -> ApiCache -> ApiCache
+remember key data cache =
+    case data of
+        RemoteData.Success value ->
+            insert key value cache
+
+        _ ->
+            cache
+
+
+{-| The cache for a dataload, emptied if it holds another dataload's data
+or data from an unknown dataload
+-}
+forDataload : String -> ApiCache -> ApiCache
+forDataload dataload cache =
+    if cache.dataload == dataload then
+        { cache | dataload = dataload, confirmed = True }
+
+    else
+        { empty | dataload = dataload, confirmed = True }
+
+
+{-| Respond from the cache if possible, else GET the url; until the
+dataload is confirmed the cache may be stale, so always GET
+-}
+fetch : String -> String -> (WebData Value -> msg) -> ApiCache -> Cmd msg
+fetch key url toMsg cache =
+    case ( cache.confirmed, get key cache ) of
+        ( True, Just value ) ->
+            Task.perform toMsg (Task.succeed (RemoteData.Success value))
+
+        _ ->
+            Http.get
+                { url = url
+                , expect =
+                    Http.expectJson (RemoteData.fromResult >> toMsg)
+                        Decode.value
+                }
+
+
+decodeResponse : Decoder a -> WebData Value -> WebData a
+decodeResponse dec data =
+    RemoteData.andThen
+        (Decode.decodeValue dec
+            >> Result.mapError (Decode.errorToString >> Http.BadBody)
+            >> RemoteData.fromResult
+        )
+        data
@@ -1,10 +1,11 @@
 module Main exposing (Model, Msg(..), init, main, subscriptions, update, view)
 
+import ApiCache exposing (ApiCache)
 import Bootstrap.Navbar as Navbar
 import Browser
 import Browser.Navigation as Nav
 import Cart as CartData
-import Config
+import Config exposing (apiServer)
 import Credentials exposing (Credentials)
 import Html exposing (..)
 import Html.Attributes exposing (..)
@@ -53,6 +54,7 @@ type alias Model =
     , searchParams : Maybe SearchParams
     , flow : Flow
     , redirectUrl : Maybe Url
+    , dataload : Maybe String
     }
 
 
@@ -60,6 +62,7 @@ type alias Flags =
     { cart : Maybe CartData.Cart
     , cred : Maybe Credentials
     , bytes : Maybe Page.SignIn.State
+    , apiCache : Maybe ApiCache
     }
 
 
@@ -78,6 +81,7 @@ type Msg
     = AboutMsg Page.About.Msg
     | CartMsg Page.Cart.Msg
     | ConditionsMsg Page.Conditions.Msg
+    | DataloadResponse (Result Http.Error String)
     | GotUserInfo (Result Http.Error User)
     | HomeMsg Page.Home.Msg
     | LinkClicked Browser.UrlRequest
@@ -101,6 +105,9 @@ flagsDecoder =
             (Decode.nullable Credentials.decoder)
         |> Json.Decode.Pipeline.required "bytes"
             (Decode.nullable Page.SignIn.decoder)
+        |> Json.Decode.Pipeline.optional "apiCache"
+            (Decode.nullable ApiCache.decoder)
+            Nothing
 
 
 init : Value -> Url.Url -> Nav.Key -> ( Model, Cmd Msg )
@@ -151,6 +158,7 @@ init flags url navKey =
                             (Maybe.withDefault Credentials.default storedCred)
                         )
                         storedUser
+                        (Maybe.withDefault ApiCache.empty f.apiCache)
                     , f.bytes
                     )
 
@@ -162,6 +170,7 @@ init flags url navKey =
                         Idle
                         (Just Credentials.default)
                         Session.Guest
+                        ApiCache.empty
                     , Nothing
                     )
 
@@ -204,9 +213,10 @@ init flags url navKey =
             , searchParams = Nothing
             , flow = newFlow
             , redirectUrl = Nothing
+            , dataload = Nothing
             }
     in
-    ( model, Cmd.batch [ navbarCmd, subMsg, cmd ] )
+    ( model, Cmd.batch [ navbarCmd, subMsg, cmd, getDataload ] )
 
 
 
@@ -260,10 +270,13 @@ update msg model =
             let
                 ( newPage, newMsg ) =
                     changeRouteTo (Route.fromUrl url)
-                        model.session
+                        (currentSession model)
                         model.searchParams
             in
-            ( { model | curPage = newPage }, newMsg )
+            -- A new dataload empties the cache for the pages after this
+            ( { model | curPage = newPage }
+            , Cmd.batch [ newMsg, getDataload ]
+            )
 
         ( NavbarMsg state, _ ) ->
             ( { model | navbarState = state }, Cmd.none )
@@ -304,6 +317,21 @@ update msg model =
             , Cmd.map ConditionsMsg newCmd
             )
 
+        ( DataloadResponse (Ok updatedOn), _ ) ->
+            let
+                apiCache =
+                    ApiCache.forDataload updatedOn model.session.apiCache
+            in
+            ( { model
+                | dataload = Just updatedOn
+                , session = Session.setApiCache model.session apiCache
+              }
+            , ApiCache.store apiCache
+            )
+
+        ( DataloadResponse (Err _), _ ) ->
+            ( model, Cmd.none )
+
         ( GotUserInfo userInfoResponse, _ ) ->
             case userInfoResponse of
                 Err _ ->
@@ -331,7 +359,7 @@ update msg model =
         ( Logout, _ ) ->
             let
                 newSession =
-                    Session.logout model.session
+                    Session.logout (currentSession model)
 
                 ( newPage, newMsg ) =
                     changeRouteTo
@@ -380,7 +408,9 @@ update msg model =
         ( SetSearchParams params, _ ) ->
             let
                 ( newPage, newMsg ) =
-                    changeRouteTo (Just Route.Home) model.session (Just params)
+                    changeRouteTo (Just Route.Home)
+                        (currentSession model)
+                        (Just params)
 
                 newModel =
                     { model
@@ -486,6 +516,19 @@ view model =
                 (Html.map StudyMsg (Page.Study.view subModel))
 
 
+{-| The session with any cached responses from an older dataload dropped
+-}
+currentSession : Model -> Session
+currentSession model =
+    case model.dataload of
+        Just updatedOn ->
+            Session.setApiCache model.session
+                (ApiCache.forDataload updatedOn model.session.apiCache)
+
+        _ ->
+            model.session
+
+
 childTranslator : Page.Profile.Translator Msg
 childTranslator =
     Page.Profile.translator
@@ -591,6 +634,16 @@ changeRouteTo maybeRoute session params =
             ( HomePage subModel, Cmd.map HomeMsg subMsg )
 
 
+getDataload : Cmd Msg
+getDataload =
+    Http.get
+        { url = apiServer ++ "/dataload"
+        , expect =
+            Http.expectJson DataloadResponse
+                (Decode.field "updated_on" Decode.string)
+        }
+
+
 getUserInfo : Page.SignIn.Configuration -> OAuth.Token -> Cmd Msg
 getUserInfo configuration token =
     Http.request
@@ -0,0 +1,39 @@
+module Memo exposing (Memo, empty, get, remember)
+
+-- TYPES --
+
+
+{-| Rows from the searches already run, keyed on their URLs, most
+recent first
+-}
+type alias Memo a =
+    List ( String, List a )
+
+
+maxEntries : Int
+maxEntries =
+    20
+
+
+
+-- UTILITY FUNCTIONS --
+
+
+empty : Memo a
+empty =
+    []
+
+
+get : String -> Memo a -> Maybe (List a)
+get key memo =
+    memo
+        |> List.filter (\( k, _ ) -> k == key)
+        |> List.head
+        |> Maybe.map Tuple.second
+
+
+remember : String -> List a -> Memo a -> Memo a
+remember key rows memo =
+    ( key, rows )
+        :: List.filter (\( k, _ ) -> k /= key) memo
+        |> List.take maxEntries
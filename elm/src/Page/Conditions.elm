@@ -17,6 +17,7 @@ import Http
 import Json.Decode exposing (Decoder, field, float, int, nullable, string)
 import Json.Decode.Pipeline exposing (hardcoded, optional, required)
 import Maybe.Extra exposing (isNothing)
+import Memo exposing (Memo)
 import RemoteData exposing (RemoteData, WebData)
 import Route
 import Session exposing (Session)
@@ -30,6 +31,8 @@ type alias Model =
     , filterBool : Bool
     , conditions : WebData (List Condition)
     , tableState : Table.State
+    , searched : String
+    , memo : Memo Condition
     }
 
 
@@ -41,7 +44,7 @@ type alias Condition =
 
 
 type Msg
-    = ConditionsResponse (WebData (List Condition))
+    = ConditionsResponse String (WebData (List Condition))
     | Search
     | SetConditionsFilter String
     | SetFilterBool Bool
@@ -55,6 +58,8 @@ init session =
       , filterBool = False
       , conditions = RemoteData.NotAsked
       , tableState = Table.initialSort "conditionName"
+      , searched = ""
+      , memo = Memo.empty
       }
     , Cmd.none
     )
@@ -63,13 +68,46 @@ init session =
 update : Msg -> Model -> ( Model, Cmd Msg )
 update msg model =
     case msg of
-        ConditionsResponse data ->
-            ( { model | conditions = data }
-            , Cmd.none
-            )
+        ConditionsResponse url data ->
+            let
+                memo =
+                    case data of
+                        RemoteData.Success rows ->
+                            Memo.remember url rows model.memo
+
+                        _ ->
+                            model.memo
+            in
+            -- Keep the rows, but show them only for the latest search
+            if url == model.searched then
+                ( { model | conditions = data, memo = memo }, Cmd.none )
+
+            else
+                ( { model | memo = memo }, Cmd.none )
 
         Search ->
-            ( model, doSearch model )
+            let
+                url =
+                    searchUrl model
+            in
+            -- A search already run is not sent again; a new one replaces
+            -- any still in flight
+            case Memo.get url model.memo of
+                Just rows ->
+                    ( { model
+                        | conditions = RemoteData.Success rows
+                        , searched = url
+                      }
+                    , Http.cancel tracker
+                    )
+
+                Nothing ->
+                    ( { model
+                        | conditions = RemoteData.Loading
+                        , searched = url
+                      }
+                    , Cmd.batch [ Http.cancel tracker, doSearch url ]
+                    )
 
         SetConditionsFilter text ->
             let
@@ -193,8 +231,13 @@ tableConfig =
 --    }
 
 
-doSearch : Model -> Cmd Msg
-doSearch model =
+tracker : String
+tracker =
+    "conditions"
+
+
+searchUrl : Model -> String
+searchUrl model =
     let
         conditions =
             Url.Builder.string "name" <|
@@ -206,17 +249,24 @@ doSearch model =
 
         params =
             Url.Builder.toQuery [ conditions, boolSearch ]
-
-        url =
-            apiServer ++ "/conditions" ++ params
     in
-    Http.get
-        { url = url
+    apiServer ++ "/conditions" ++ params
+
+
+doSearch : String -> Cmd Msg
+doSearch url =
+    Http.request
+        { method = "GET"
+        , headers = []
+        , url = url
+        , body = Http.emptyBody
         , expect =
             -- Http.expectJson
             expectJson
-                (RemoteData.fromResult >> ConditionsResponse)
+                (RemoteData.fromResult >> ConditionsResponse url)
                 (Json.Decode.list decoderCondition)
+        , timeout = Nothing
+        , tracker = Just tracker
         }
 
 
@@ -1,5 +1,6 @@
 module Page.Home exposing (Model, Msg, init, subscriptions, update, view)
 
+import ApiCache
 import Bool.Extra exposing (ifElse)
 import Bootstrap.Badge as Badge
 import Bootstrap.Button as Button
@@ -20,7 +21,7 @@ import Html exposing (Html, a, b, br, div, h1, img, text)
 import Html.Attributes exposing (class, for, href, src, style, target, value)
 import Html.Events exposing (onClick, onInput, onSubmit)
 import Http
-import Json.Decode exposing (Decoder, field, float, int, nullable, string)
+import Json.Decode exposing (Decoder, Value, field, float, int, nullable, string)
 import Json.Decode.Pipeline exposing (hardcoded, optional, required)
 import Maybe.Extra exposing (isNothing, unwrap)
 import Regex
@@ -52,6 +53,10 @@ type alias Model =
     , queryText : Maybe String
     , queryTextBool : Bool
     , recordLimit : Int
+    , resultsLimit : Int
+    , resultsPageLoading : Bool
+    , resultsQuery : List Url.Builder.QueryParameter
+    , resultsScrollTop : Int
     , searchName : Maybe String
     , searchResults : WebData SearchResults
     , selectedStudies : List Study
@@ -116,10 +121,12 @@ type Msg
     | AddStudyType String
     | CartMsg Cart.Msg
     | DoSearch
-    | PhasesResponse (WebData (List Phase))
+    | PageResponse Int (WebData SearchResults)
+    | PhasesResponse (WebData Value)
     | RemovePhase Phase
     | RemoveStudyType StudyType
     | Reset
+    | ResultsScrolled Int
     | SaveSearch
     | SavedSearchResponse (WebData SavedSearches)
     | SearchResponse (WebData SearchResults)
@@ -136,7 +143,7 @@ type Msg
     | SetRecordLimit String
     | SetSearchName String
     | SetSponsors String
-    | StudyTypesResponse (WebData (List StudyType))
+    | StudyTypesResponse (WebData Value)
 
 
 
@@ -144,9 +151,37 @@ type Msg
 
 
 defaultRecordLimit =
+    1000
+
+
+{-| Results are fetched a page at a time as they are scrolled to, and only
+the rows in view (plus a few either side) are put in the table
+-}
+resultsPageSize : Int
+resultsPageSize =
     100
 
 
+resultsRowHeight : Int
+resultsRowHeight =
+    48
+
+
+resultsVisibleRows : Int
+resultsVisibleRows =
+    15
+
+
+resultsOverscan : Int
+resultsOverscan =
+    10
+
+
+searchTracker : String
+searchTracker =
+    "search"
+
+
 initialModel : Session -> Model
 initialModel session =
     { errorMessage = Nothing
@@ -167,6 +202,10 @@ initialModel session =
     , queryText = Nothing
     , queryTextBool = False
     , recordLimit = defaultRecordLimit
+    , resultsLimit = defaultRecordLimit
+    , resultsPageLoading = False
+    , resultsQuery = []
+    , resultsScrollTop = 0
     , searchName = Nothing
     , searchResults = RemoteData.NotAsked
     , selectedStudies = []
@@ -243,7 +282,10 @@ init session params =
         , queryTextBool = queryTextBool
         , searchName = searchName
       }
-    , Cmd.batch [ getPhases, getStudyTypes ]
+    , Cmd.batch
+        [ getPhases session.apiCache
+        , getStudyTypes session.apiCache
+        ]
     )
 
 
@@ -349,10 +391,61 @@ update msg model =
                 ( { model | errorMessage = Just err }, Cmd.none )
 
         DoSearch ->
-            ( { model | searchResults = RemoteData.Loading }, doSearch model )
+            let
+                -- Later pages are for this search, whatever is edited since
+                newModel =
+                    { model
+                        | searchResults = RemoteData.Loading
+                        , resultsLimit = model.recordLimit
+                        , resultsPageLoading = False
+                        , resultsQuery = searchQuery model
+                        , resultsScrollTop = 0
+                    }
+            in
+            ( newModel
+            , Cmd.batch [ Http.cancel searchTracker, doSearch newModel 0 0 ]
+            )
 
-        PhasesResponse phases ->
+        PageResponse after data ->
+            case ( model.searchResults, data ) of
+                ( RemoteData.Success results, RemoteData.Success page ) ->
+                    -- Ignore a page that no longer follows on
+                    if after == lastStudyId results then
+                        fetchMoreResults
+                            { model
+                                | searchResults =
+                                    RemoteData.Success
+                                        { results
+                                            | records =
+                                                results.records ++ page.records
+                                        }
+                                , resultsPageLoading = False
+                            }
+
+                    else
+                        ( model, Cmd.none )
+
+                ( _, RemoteData.Failure httpError ) ->
+                    ( { model
+                        | errorMessage = Just (viewHttpErrorMessage httpError)
+                        , resultsPageLoading = False
+                      }
+                    , Cmd.none
+                    )
+
+                _ ->
+                    ( model, Cmd.none )
+
+        PhasesResponse response ->
             let
+                phases =
+                    ApiCache.decodeResponse
+                        (Json.Decode.list decoderPhase)
+                        response
+
+                ( newSession, storeCmd ) =
+                    Session.remember "phases" response model.session
+
                 newPhases =
                     case phases of
                         RemoteData.Success data ->
@@ -373,8 +466,9 @@ update msg model =
                 | phases = phases
                 , querySelectedPhases = newSelectedPhases
                 , initPhaseIds = Nothing
+                , session = newSession
               }
-            , Cmd.none
+            , storeCmd
             )
 
         RemovePhase newPhase ->
@@ -413,6 +507,9 @@ update msg model =
             , Cmd.none
             )
 
+        ResultsScrolled scrollTop ->
+            fetchMoreResults { model | resultsScrollTop = scrollTop }
+
         SaveSearch ->
             ( model, saveSearch model )
 
@@ -485,8 +582,16 @@ update msg model =
         SetEnrollment enrollment ->
             ( { model | queryEnrollment = String.toInt enrollment }, Cmd.none )
 
-        StudyTypesResponse studyTypes ->
+        StudyTypesResponse response ->
             let
+                studyTypes =
+                    ApiCache.decodeResponse
+                        (Json.Decode.list decoderStudyType)
+                        response
+
+                ( newSession, storeCmd ) =
+                    Session.remember "study_types" response model.session
+
                 newStudyTypes =
                     case studyTypes of
                         RemoteData.Success data ->
@@ -507,8 +612,9 @@ update msg model =
                 | studyTypes = studyTypes
                 , querySelectedStudyTypes = newSelectedStudyTypes
                 , initStudyTypeIds = Nothing
+                , session = newSession
               }
-            , Cmd.none
+            , storeCmd
             )
 
 
@@ -835,19 +941,70 @@ view model =
 
                         title =
                             "Showing "
-                                ++ commify (List.length data.records)
+                                ++ commify (resultsWanted model data.count)
                                 ++ " of "
                                 ++ commify data.count
                                 ++ " found"
 
+                        -- Start on an even row so the stripes stay put
+                        first =
+                            max 0
+                                ((model.resultsScrollTop // resultsRowHeight)
+                                    - resultsOverscan
+                                )
+                                |> (\n -> n - modBy 2 n)
+
+                        visible =
+                            data.records
+                                |> List.drop first
+                                |> List.take
+                                    (resultsVisibleRows + 2 * resultsOverscan)
+
+                        -- Rows not drawn, loaded or not, are taken up by
+                        -- spacers so the scrollbar reflects all of them
+                        spacer numRows =
+                            tr
+                                [ Bootstrap.Table.rowAttr <|
+                                    style "height" <|
+                                        String.fromInt
+                                            (numRows * resultsRowHeight)
+                                            ++ "px"
+                                ]
+                                []
+
+                        numAfter =
+                            resultsWanted model data.count
+                                - first
+                                - List.length visible
+
+                        cell =
+                            Bootstrap.Table.cellAttr <|
+                                style "white-space" "nowrap"
+
                         mkRow study =
-                            tr []
-                                [ td []
+                            tr
+                                [ Bootstrap.Table.rowAttr <|
+                                    style "height" <|
+                                        String.fromInt resultsRowHeight
+                                            ++ "px"
+                                ]
+                                [ td [ cell ]
                                     [ Cart.addToCartButton cart study.studyId
                                         |> Html.map CartMsg
                                     ]
-                                , td [] [ text study.title ]
-                                , td []
+                                , td
+                                    [ cell
+                                    , Bootstrap.Table.cellAttr <|
+                                        style "max-width" "0"
+                                    , Bootstrap.Table.cellAttr <|
+                                        style "overflow" "hidden"
+                                    , Bootstrap.Table.cellAttr <|
+                                        style "text-overflow" "ellipsis"
+                                    , Bootstrap.Table.cellAttr <|
+                                        Html.Attributes.title study.title
+                                    ]
+                                    [ text study.title ]
+                                , td [ cell ]
                                     [ a
                                         [ Route.href
                                             (Route.Study study.nctId)
@@ -875,12 +1032,35 @@ view model =
                                         ]
                                 , tbody =
                                     tbody []
-                                        (List.map
-                                            mkRow
-                                            data.records
+                                        (spacer first
+                                            :: List.map mkRow visible
+                                            ++ [ spacer numAfter ]
                                         )
                                 }
 
+                        scroller =
+                            div
+                                [ style "height" <|
+                                    String.fromInt
+                                        (resultsVisibleRows * resultsRowHeight)
+                                        ++ "px"
+                                , style "overflow-y" "auto"
+                                , Html.Events.on "scroll" <|
+                                    Json.Decode.map ResultsScrolled
+                                        (Json.Decode.at
+                                            [ "target", "scrollTop" ]
+                                            (Json.Decode.map round float)
+                                        )
+                                ]
+                                [ resultsTable
+                                , div []
+                                    [ text <|
+                                        ifElse "Fetching more..."
+                                            ""
+                                            model.resultsPageLoading
+                                    ]
+                                ]
+
                         resultsDiv =
                             let
                                 idList =
@@ -898,7 +1078,7 @@ view model =
                                             div [] []
 
                                         _ ->
-                                            div [] [ resultsTable ]
+                                            scroller
                             in
                             [ h1 [] [ text title ]
                             , errorMessage
@@ -949,30 +1129,112 @@ filteredConditions conditions conditionFilter =
             []
 
 
-getPhases : Cmd Msg
-getPhases =
-    Http.get
-        { url = apiServer ++ "/phases"
-        , expect =
-            Http.expectJson
-                (RemoteData.fromResult >> PhasesResponse)
-                (Json.Decode.list decoderPhase)
-        }
+getPhases : ApiCache.ApiCache -> Cmd Msg
+getPhases apiCache =
+    ApiCache.fetch "phases" (apiServer ++ "/phases") PhasesResponse apiCache
+
+
+getStudyTypes : ApiCache.ApiCache -> Cmd Msg
+getStudyTypes apiCache =
+    ApiCache.fetch "study_types"
+        (apiServer ++ "/study_types")
+        StudyTypesResponse
+        apiCache
+
+
+{-| Fetch the next page of results if the rows in view are close to or
+past the last one loaded
+-}
+fetchMoreResults : Model -> ( Model, Cmd Msg )
+fetchMoreResults model =
+    case ( model.searchResults, model.resultsPageLoading ) of
+        ( RemoteData.Success results, False ) ->
+            let
+                numLoaded =
+                    List.length results.records
+
+                lastVisible =
+                    (model.resultsScrollTop // resultsRowHeight)
+                        + resultsVisibleRows
+
+                nearEnd =
+                    lastVisible + resultsPageSize // 2 >= numLoaded
+            in
+            if numLoaded < resultsWanted model results.count && nearEnd then
+                ( { model | resultsPageLoading = True }
+                , doSearch model numLoaded (lastStudyId results)
+                )
+
+            else
+                ( model, Cmd.none )
+
+        _ ->
+            ( model, Cmd.none )
+
+
+{-| The most results to load of the count found; a limit of 0 is none
+-}
+resultsWanted : Model -> Int -> Int
+resultsWanted model count =
+    if model.resultsLimit > 0 then
+        min count model.resultsLimit
+
+    else
+        count
 
 
-getStudyTypes : Cmd Msg
-getStudyTypes =
-    Http.get
-        { url = apiServer ++ "/study_types"
+{-| The study_id of the last result loaded, or 0 for none
+-}
+lastStudyId : SearchResults -> Int
+lastStudyId results =
+    List.reverse results.records
+        |> List.head
+        |> Maybe.map .studyId
+        |> Maybe.withDefault 0
+
+
+{-| Search for the page of results after the numLoaded so far, the last
+of them with study_id "after"; only the first page (none loaded) has
+the count
+-}
+doSearch : Model -> Int -> Int -> Cmd Msg
+doSearch model numLoaded after =
+    let
+        recordLimit =
+            Url.Builder.int "limit" <|
+                resultsWanted model (numLoaded + resultsPageSize)
+                    - numLoaded
+
+        recordAfter =
+            if numLoaded > 0 then
+                [ Url.Builder.int "after" after ]
+
+            else
+                []
+
+        searchUrl =
+            apiServer
+                ++ "/search"
+                ++ Url.Builder.toQuery
+                    (model.resultsQuery ++ [ recordLimit ] ++ recordAfter)
+
+        toMsg =
+            ifElse SearchResponse (PageResponse after) (numLoaded == 0)
+    in
+    Http.request
+        { method = "GET"
+        , headers = []
+        , url = searchUrl
+        , body = Http.emptyBody
         , expect =
-            Http.expectJson
-                (RemoteData.fromResult >> StudyTypesResponse)
-                (Json.Decode.list decoderStudyType)
+            Http.expectJson (RemoteData.fromResult >> toMsg) decoderSearchResults
+        , timeout = Nothing
+        , tracker = Just searchTracker
         }
 
 
-doSearch : Model -> Cmd Msg
-doSearch model =
+searchQuery : Model -> List Url.Builder.QueryParameter
+searchQuery model =
     let
         builder ( label, value ) =
             case value of
@@ -1031,9 +1293,6 @@ doSearch model =
             Url.Builder.int "sponsors_bool"
                 (ifElse 1 0 model.querySponsorsBool)
 
-        recordLimit =
-            Url.Builder.int "limit" model.recordLimit
-
         queryParams =
             List.filterMap builder
                 [ ( "text"
@@ -1064,27 +1323,13 @@ doSearch model =
                   , model.queryStudyFirstPosted
                   )
                 ]
-
-        params =
-            Url.Builder.toQuery <|
-                queryParams
-                    ++ [ queryTextBool
-                       , queryConditionsBool
-                       , queryInterventionsBool
-                       , querySponsorsBool
-                       , recordLimit
-                       ]
-
-        searchUrl =
-            apiServer ++ "/search" ++ params
     in
-    Http.get
-        { url = searchUrl
-        , expect =
-            Http.expectJson
-                (RemoteData.fromResult >> SearchResponse)
-                decoderSearchResults
-        }
+    queryParams
+        ++ [ queryTextBool
+           , queryConditionsBool
+           , queryInterventionsBool
+           , querySponsorsBool
+           ]
 
 
 saveSearch : Model -> Cmd Msg
@@ -1233,7 +1478,7 @@ decoderSavedSearches =
 decoderSearchResults : Decoder SearchResults
 decoderSearchResults =
     Json.Decode.succeed SearchResults
-        |> Json.Decode.Pipeline.required "count" int
+        |> Json.Decode.Pipeline.optional "count" int 0
         |> Json.Decode.Pipeline.required "records"
             (Json.Decode.list decoderStudy)
 
@@ -17,6 +17,7 @@ import Http
 import Json.Decode exposing (Decoder, field, float, int, nullable, string)
 import Json.Decode.Pipeline exposing (hardcoded, optional, required)
 import Maybe.Extra exposing (isNothing)
+import Memo exposing (Memo)
 import RemoteData exposing (RemoteData, WebData)
 import Route
 import Session exposing (Session)
@@ -30,6 +31,8 @@ type alias Model =
     , filterBool : Bool
     , sponsors : WebData (List Sponsor)
     , tableState : Table.State
+    , searched : String
+    , memo : Memo Sponsor
     }
 
 
@@ -41,7 +44,7 @@ type alias Sponsor =
 
 
 type Msg
-    = SponsorsResponse (WebData (List Sponsor))
+    = SponsorsResponse String (WebData (List Sponsor))
     | Search
     | SetSponsorsFilter String
     | SetFilterBool Bool
@@ -55,6 +58,8 @@ init session =
       , filterBool = False
       , sponsors = RemoteData.NotAsked
       , tableState = Table.initialSort "sponsorName"
+      , searched = ""
+      , memo = Memo.empty
       }
     , Cmd.none
     )
@@ -63,13 +68,46 @@ init session =
 update : Msg -> Model -> ( Model, Cmd Msg )
 update msg model =
     case msg of
-        SponsorsResponse data ->
-            ( { model | sponsors = data }
-            , Cmd.none
-            )
+        SponsorsResponse url data ->
+            let
+                memo =
+                    case data of
+                        RemoteData.Success rows ->
+                            Memo.remember url rows model.memo
+
+                        _ ->
+                            model.memo
+            in
+            -- Keep the rows, but show them only for the latest search
+            if url == model.searched then
+                ( { model | sponsors = data, memo = memo }, Cmd.none )
+
+            else
+                ( { model | memo = memo }, Cmd.none )
 
         Search ->
-            ( model, doSearch model )
+            let
+                url =
+                    searchUrl model
+            in
+            -- A search already run is not sent again; a new one replaces
+            -- any still in flight
+            case Memo.get url model.memo of
+                Just rows ->
+                    ( { model
+                        | sponsors = RemoteData.Success rows
+                        , searched = url
+                      }
+                    , Http.cancel tracker
+                    )
+
+                Nothing ->
+                    ( { model
+                        | sponsors = RemoteData.Loading
+                        , searched = url
+                      }
+                    , Cmd.batch [ Http.cancel tracker, doSearch url ]
+                    )
 
         SetSponsorsFilter text ->
             let
@@ -191,8 +229,13 @@ tableConfig =
         }
 
 
-doSearch : Model -> Cmd Msg
-doSearch model =
+tracker : String
+tracker =
+    "sponsors"
+
+
+searchUrl : Model -> String
+searchUrl model =
     let
         sponsors =
             Url.Builder.string "name" <|
@@ -204,17 +247,24 @@ doSearch model =
 
         params =
             Url.Builder.toQuery [ sponsors, boolSearch ]
-
-        url =
-            apiServer ++ "/sponsors" ++ params
     in
-    Http.get
-        { url = url
+    apiServer ++ "/sponsors" ++ params
+
+
+doSearch : String -> Cmd Msg
+doSearch url =
+    Http.request
+        { method = "GET"
+        , headers = []
+        , url = url
+        , body = Http.emptyBody
         , expect =
             -- Http.expectJson
             expectJson
-                (RemoteData.fromResult >> SponsorsResponse)
+                (RemoteData.fromResult >> SponsorsResponse url)
                 (Json.Decode.list decoderSponsor)
+        , timeout = Nothing
+        , tracker = Just tracker
         }
 
 
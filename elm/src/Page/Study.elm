@@ -1,5 +1,6 @@
 module Page.Study exposing (Model, Msg, init, subscriptions, update, view)
 
+import ApiCache
 import Bootstrap.Button as Button
 import Bootstrap.Grid as Grid
 import Bootstrap.Grid.Col as Col
@@ -11,8 +12,7 @@ import Common exposing (commify, viewHttpErrorMessage)
 import Config exposing (apiServer, maxCartSize, serverAddress)
 import Html exposing (Html, a, div, h1, h2, li, text, ul)
 import Html.Attributes exposing (href, style, target)
-import Http
-import Json.Decode exposing (Decoder, field, float, int, nullable, string)
+import Json.Decode exposing (Decoder, Value, field, float, int, nullable, string)
 import Json.Decode.Pipeline exposing (hardcoded, optional, required)
 import RemoteData exposing (RemoteData, WebData)
 import Route
@@ -98,7 +98,7 @@ type alias Study =
 type Msg
     = TabMsg Tab.State
     | CartMsg Cart.Msg
-    | StudyResponse (WebData Study)
+    | StudyResponse String (WebData Value)
 
 
 init : Session -> String -> ( Model, Cmd Msg )
@@ -108,7 +108,7 @@ init session nctId =
       , tabState = Tab.initialState
       , errorMessage = Nothing
       }
-    , Cmd.batch [ getStudy nctId ]
+    , Cmd.batch [ getStudy session.apiCache nctId ]
     )
 
 
@@ -157,9 +157,16 @@ update msg model =
             , Cmd.none
             )
 
-        StudyResponse data ->
-            ( { model | study = data }
-            , Cmd.none
+        StudyResponse nctId data ->
+            let
+                ( newSession, storeCmd ) =
+                    Session.remember ("study/" ++ nctId) data model.session
+            in
+            ( { model
+                | study = ApiCache.decodeResponse decoderStudy data
+                , session = newSession
+              }
+            , storeCmd
             )
 
 
@@ -480,19 +487,13 @@ alignRight =
     Bootstrap.Table.cellAttr (style "text-align" "right")
 
 
-getStudy : String -> Cmd Msg
-getStudy nctId =
+getStudy : ApiCache.ApiCache -> String -> Cmd Msg
+getStudy apiCache nctId =
     let
         url =
             apiServer ++ "/study/" ++ nctId
     in
-    Http.get
-        { url = url
-        , expect =
-            Http.expectJson
-                (RemoteData.fromResult >> StudyResponse)
-                decoderStudy
-        }
+    ApiCache.fetch ("study/" ++ nctId) url (StudyResponse nctId) apiCache
 
 
 decoderStudy : Decoder Study
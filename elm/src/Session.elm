@@ -1,8 +1,11 @@
 module Session exposing (..)
 
+import ApiCache exposing (ApiCache)
 import Browser.Navigation as Nav
 import Cart exposing (Cart)
 import Credentials exposing (Credentials)
+import Json.Decode exposing (Value)
+import RemoteData
 import State exposing (State)
 import Types exposing (Flow(..))
 import User exposing (User)
@@ -20,6 +23,7 @@ type alias Session =
     , flow : Flow
     , cred : Maybe Credentials
     , user : SessionUser
+    , apiCache : ApiCache
     }
 
 
@@ -28,6 +32,22 @@ setCart session cart =
     { session | cart = cart }
 
 
+setApiCache : Session -> ApiCache -> Session
+setApiCache session apiCache =
+    { session | apiCache = apiCache }
+
+
+{-| Remember a response in the cache, returning the command to save it
+-}
+remember : String -> RemoteData.WebData Value -> Session -> ( Session, Cmd msg )
+remember key data session =
+    let
+        apiCache =
+            ApiCache.remember key data session.apiCache
+    in
+    ( setApiCache session apiCache, ApiCache.store apiCache )
+
+
 setUser : Session -> SessionUser -> Session
 setUser session user =
     { session | user = user }
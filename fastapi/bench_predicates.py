@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Benchmark the predicate-built /search filters against the old ones
+
+The old /search joined the link tables into the FROM list from a list of
+"where" dicts, with the values written into the SQL; legacy_sql keeps
+that builder to compare against. Each case is a set of /search
+parameters with values sampled from the database; both versions count
+the distinct matching studies, which test_predicates.py checks are the
+same studies.
+"""
+
+import argparse
+import psycopg2
+import re
+import statistics
+import time
+from db import CONFIG_FILE, make_dsn, read_config
+from itertools import chain, combinations
+from typing import Dict, List, NamedTuple, Tuple
+
+
+class Args(NamedTuple):
+    """ Command-line arguments """
+    config: str
+    repeat: int
+
+
+#
+# Each filter alone, then each pair of filters
+#
+FILTERS = [
+    'text', 'phase_ids', 'study_type_ids', 'enrollment', 'overall_status_id',
+    'last_known_status_id', 'study_first_posted', 'last_update_posted',
+    'condition_names', 'sponsor_names', 'intervention_names',
+    'condition_ids', 'sponsor_ids'
+]
+
+#
+# The old joins gave names and ids of the same entity the same alias, so
+# those pairs failed (and the old /search returned nothing); they are left
+# out of the comparison
+#
+CLASHES = [{'condition_names', 'condition_ids'},
+           {'sponsor_names', 'sponsor_ids'}]
+
+
+# --------------------------------------------------
+def get_args() -> Args:
+    """ Get command-line arguments """
+
+    parser = argparse.ArgumentParser(
+        description='Time old and new /search filters',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-c',
+                        '--config',
+                        help='Configuration file',
+                        metavar='FILE',
+                        default=CONFIG_FILE)
+
+    parser.add_argument('-r',
+                        '--repeat',
+                        help='Runs per query',
+                        metavar='INT',
+                        type=int,
+                        default=5)
+
+    args = parser.parse_args()
+    return Args(args.config, args.repeat)
+
+
+# --------------------------------------------------
+def main() -> None:
+    """ Make a jazz noise here """
+
+    args = get_args()
+    dbh = psycopg2.connect(make_dsn(read_config(args.config)))
+    cur = dbh.cursor()
+
+    print(f'{"filters":45} {"old ms":>8} {"new ms":>8} {"studies":>8}')
+    for params in cases(sample(cur)):
+        old, num = timed(cur, legacy_sql(params), [], args.repeat)
+        new, _ = timed(cur, *new_sql(params), args.repeat)
+        print(f'{",".join(params):45} {old:8.2f} {new:8.2f} {num:8,}')
+
+    cur.close()
+    dbh.close()
+
+
+# --------------------------------------------------
+def sample(cur) -> Dict[str, str]:
+    """ A value for each filter that matches some studies """
+
+    def one(sql: str):
+        cur.execute(sql)
+        return cur.fetchone()[0]
+
+    def word(table: str, name: str) -> str:
+        return re.findall(
+            r'[a-z]{4,}',
+            one(f"""
+                select   x.{name}
+                from     {table} x, study_to_{table} l
+                where    l.{table}_id=x.{table}_id
+                group by 1
+                order by count(*) desc
+                limit    1
+            """).lower())[0]
+
+    def common(column: str, table: str = 'study') -> str:
+        return str(
+            one(f"""
+                select   {column}
+                from     {table}
+                where    {column} is not null
+                group by 1
+                order by count(*) desc
+                limit    1
+            """))
+
+    return {
+        'text': word('condition', 'condition_name'),
+        'phase_ids': common('phase_id'),
+        'study_type_ids': common('study_type_id'),
+        'enrollment': '>= 100',
+        'overall_status_id': common('overall_status_id'),
+        'last_known_status_id': common('last_known_status_id'),
+        'study_first_posted': str(
+            one('select percentile_disc(0.5) within group '
+                '(order by study_first_posted) from study')),
+        'last_update_posted': str(
+            one('select percentile_disc(0.5) within group '
+                '(order by last_update_posted) from study')),
+        'condition_names': word('condition', 'condition_name'),
+        'sponsor_names': word('sponsor', 'sponsor_name'),
+        'intervention_names': word('intervention', 'intervention_name'),
+        'condition_ids': common('condition_id', 'study_to_condition'),
+        'sponsor_ids': common('sponsor_id', 'study_to_sponsor'),
+    }
+
+
+# --------------------------------------------------
+def cases(values: Dict[str, str]) -> List[Dict[str, str]]:
+    """ /search parameters for each filter and pair of filters """
+
+    return [{flt: values[flt]
+             for flt in combo}
+            for combo in chain(combinations(FILTERS, 1),
+                               combinations(FILTERS, 2))
+            if not any(clash <= set(combo) for clash in CLASHES)]
+
+
+# --------------------------------------------------
+def timed(cur, sql: str, params: List, repeat: int) -> Tuple[float, int]:
+    """ Median milliseconds to count the studies, and the count """
+
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cur.execute(f'select count(*) from ({sql}) as found', params)
+        num = cur.fetchone()[0]
+        runs.append((time.perf_counter() - start) * 1000)
+
+    return statistics.median(runs), num
+
+
+# --------------------------------------------------
+def new_sql(params: Dict[str, str]) -> Tuple[str, List]:
+    """ Distinct matching study ids from the predicates, with parameters """
+
+    # The API module reads its config on import
+    from main import search_filters
+
+    # As FastAPI would pass them
+    tables, table_params, filters = search_filters(
+        **{
+            param: int(value) if param.endswith('_status_id') else value
+            for param, value in params.items()
+        })
+    where, where_params = filters.compile()
+
+    return ('select s.study_id from {} where {}'.format(
+        ', '.join(tables), where), table_params + where_params)
+
+
+# --------------------------------------------------
+def legacy_sql(params: Dict[str, str]) -> str:
+    """ Distinct matching study ids as the old "where" dicts built them """
+
+    def tsquery(query: str, language: str = '') -> str:
+        return "plainto_tsquery({}'{}')".format(
+            f"'{language}', " if language else '', query)
+
+    where = []
+    if text := params.get('text'):
+        where.append({
+            'tables': [],
+            'where': ['s.fulltext @@ {}'.format(tsquery(text, 'english'))]
+        })
+
+    for param, column in [('phase_ids', 'phase_id'),
+                          ('study_type_ids', 'study_type_id')]:
+        if ids := params.get(param):
+            where.append({
+                'tables': [],
+                'where': [f's.{column} in ({ids})']
+            })
+
+    if match := re.match(r'(=|==|<|<=|>|>=)?\s*(\d+)',
+                         params.get('enrollment', '')):
+        op = match.group(1) or '>='
+        num = match.group(2)
+        where.append({'tables': [], 'where': [f's.enrollment {op} {num}']})
+
+    for column in ['overall_status_id', 'last_known_status_id']:
+        if value := params.get(column):
+            where.append({'tables': [], 'where': [f's.{column} = {value}']})
+
+    for column in ['study_first_posted', 'last_update_posted']:
+        if value := params.get(column):
+            where.append({
+                'tables': [],
+                'where': [f"s.{column} >= '{value}'"]
+            })
+
+    for param, table, alias, link in [
+        ('condition_names', 'condition', 'c', 's2c'),
+        ('sponsor_names', 'sponsor', 'sp', 's2p'),
+        ('intervention_names', 'intervention', 'i', 's2i'),
+    ]:
+        if names := params.get(param):
+            where.append({
+                'tables': [f'study_to_{table} {link}', f'{table} {alias}'],
+                'where': [
+                    f's.study_id={link}.study_id',
+                    f'{link}.{table}_id={alias}.{table}_id',
+                    f'{alias}.{table}_name @@ {tsquery(names)}'
+                ]
+            })
+
+    for param, table, link in [('condition_ids', 'condition', 's2c'),
+                               ('sponsor_ids', 'sponsor', 's2p')]:
+        if ids := params.get(param):
+            where.append({
+                'tables': [f'study_to_{table} {link}'],
+                'where': [
+                    f's.study_id={link}.study_id',
+                    f'{link}.{table}_id in ({ids})'
+                ]
+            })
+
+    table_names = ['study s'] + list(
+        chain.from_iterable(map(lambda x: x['tables'], where)))
+
+    return 'select distinct s.study_id from {} where {}'.format(
+        ', '.join(table_names),
+        '\nand '.join(chain.from_iterable(map(lambda x: x['where'], where))))
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Single-flight request coalescing
+
+Concurrent calls with the same key wait on the one call already in
+flight and share its result (or exception) instead of each querying the
+database.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+
+class Call:
+    """ A computation in flight """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Any = None
+        self.waiters = 0
+
+
+class Coalescer:
+    """ Runs one call per key at a time, sharing results with waiters """
+
+    def __init__(self, max_keys: int = 500):
+        self.max_keys = max_keys
+        self._calls: Dict[Hashable, Call] = {}
+        self._metrics: 'OrderedDict[str, Dict[str, int]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def do(self,
+           key: Hashable,
+           func: Callable[[], Any],
+           label: str = '') -> Any:
+        """ Run func, or wait for the identical call in flight """
+
+        with self._lock:
+            metric = self._metric(label or str(key))
+            metric['calls'] += 1
+            if call := self._calls.get(key):
+                call.waiters += 1
+                metric['coalesced'] += 1
+                metric['max_waiters'] = max(metric['max_waiters'],
+                                            call.waiters)
+                leader = False
+            else:
+                call = self._calls[key] = Call()
+                leader = True
+
+        if leader:
+            try:
+                call.result = func()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+
+        return call.result
+
+    def metrics(self) -> Dict[str, Dict[str, int]]:
+        """ Calls, coalesced calls and most waiters per key """
+
+        with self._lock:
+            return {label: dict(m) for label, m in self._metrics.items()}
+
+    def _metric(self, label: str) -> Dict[str, int]:
+        if label in self._metrics:
+            self._metrics.move_to_end(label)
+        else:
+            self._metrics[label] = {
+                'calls': 0,
+                'coalesced': 0,
+                'max_waiters': 0
+            }
+            while len(self._metrics) > self.max_keys:
+                self._metrics.popitem(last=False)
+
+        return self._metrics[label]
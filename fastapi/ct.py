@@ -1,13 +1,10 @@
 from peewee import *
 from playhouse.postgres_ext import *
 
-database = PostgresqlDatabase(
-    'clinical_trial', **{
-        'host': 'postgres-prod.cnw0jywsbq0l.us-west-2.rds.amazonaws.com',
-        'port': 5432,
-        'user': 'kyclark',
-        'password': 'mHo%90^NOMgT'
-    })
+#
+# Connection is set up from config.ini by the app with database.init()
+#
+database = PostgresqlDatabase(None)
 
 
 class UnknownField(object):
@@ -0,0 +1,259 @@
+"""
+Database configuration and connection pools shared by the API and scripts
+"""
+
+import os
+import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+import re
+import threading
+import time
+from configparser import ConfigParser
+from contextlib import contextmanager
+from itertools import count
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from typing import List, NamedTuple, Optional, Set
+
+CONFIG_FILE = './config.ini'
+
+#
+# Errors that mean the server or the connection to it is gone, as opposed
+# to ones (e.g., recovery conflicts on a standby) that fail one statement
+#
+CONNECTION_LOST = (psycopg2.InterfaceError, psycopg2.errors.AdminShutdown,
+                   psycopg2.errors.CrashShutdown,
+                   psycopg2.errors.CannotConnectNow)
+
+
+class WaitingPool(ThreadedConnectionPool):
+    """
+    Thread-safe pool that waits up to "wait" seconds for a connection to
+    be returned when all maxconn are in use, rather than failing at once
+    """
+
+    def __init__(self, minconn: int, maxconn: int, dsn: str, wait: float):
+        super().__init__(minconn, maxconn, dsn)
+        self.wait = wait
+        self._free = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None, wait: Optional[float] = None):
+        """ A connection, or PoolError if none is free in time """
+
+        wait = self.wait if wait is None else wait
+        if not (self._free.acquire(timeout=wait)
+                if wait > 0 else self._free.acquire(blocking=False)):
+            raise PoolError('connection pool exhausted')
+
+        try:
+            return super().getconn(key)
+        except BaseException:
+            self._free.release()
+            raise
+
+    def putconn(self, conn, key=None, close: bool = False) -> None:
+        """ Give back a connection """
+
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._free.release()
+
+
+class ActiveConns:
+    """
+    Connections in use by one request, which can be cancelled from
+    another thread; the lock keeps a connection from being cancelled
+    once it has been given back to its pool
+    """
+
+    def __init__(self):
+        self.conns: Set = set()
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def add(self, conn) -> None:
+        """ Register a connection, refusing it if already cancelled """
+
+        with self._lock:
+            if self.cancelled:
+                raise psycopg2.extensions.QueryCanceledError(
+                    'canceling statement due to client disconnect')
+            self.conns.add(conn)
+
+    def discard(self, conn) -> None:
+        """ Unregister a connection before it goes back to its pool """
+
+        with self._lock:
+            self.conns.discard(conn)
+
+    def cancel(self) -> None:
+        """ Cancel the statements of all registered connections """
+
+        with self._lock:
+            self.cancelled = True
+            for conn in self.conns:
+                conn.cancel()
+
+
+class Replica(NamedTuple):
+    """ A read replica and when it may be tried again after failing """
+    name: str
+    pool: WaitingPool
+    down_until: List[float]
+
+
+class Pools:
+    """
+    Connection pools for the primary and any read replicas
+
+    Read-only work is spread round-robin over the healthy replicas; a
+    replica that fails to connect or drops a connection is skipped for
+    "replica_retry" seconds, and one with no free connection is passed
+    over. Writes, and reads when no replica can take them, go to the
+    primary, waiting up to "pool_wait" seconds for a free connection.
+    """
+
+    def __init__(self, config: ConfigParser):
+        section = config['DEFAULT']
+        maxconn = section.getint('pool_max', fallback=10)
+        wait = section.getfloat('pool_wait', fallback=10.)
+        self.minconn = section.getint('pool_min', fallback=1)
+        self.retry = section.getfloat('replica_retry', fallback=30.)
+        self.primary = WaitingPool(0, maxconn, make_dsn(config), wait)
+        self.replicas = [
+            Replica(name,
+                    WaitingPool(0, maxconn, make_dsn(config, name), wait),
+                    [0.])
+            for name in filter(
+                None, re.split(r'\s*,\s*', section.get('replicas', '')))
+        ]
+        self._turn = count()
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        """ Close all connections """
+
+        self.primary.closeall()
+        for replica in self.replicas:
+            replica.pool.closeall()
+
+    def warm(self) -> None:
+        """
+        Open pool_min connections to the primary and to each replica as a
+        request would, so one that cannot be reached is marked down (or,
+        for the primary, logged by the caller) rather than failing startup
+        """
+
+        held = []
+        try:
+            for read_only in [False] * self.minconn + [True] * (
+                    self.minconn * len(self.replicas)):
+                held.append(self._connect(read_only))
+        finally:
+            for replica, conn in held:
+                (replica.pool if replica else self.primary).putconn(conn)
+
+    def healthy(self) -> List[str]:
+        """ Names of the replicas currently in rotation """
+
+        now = time.monotonic()
+        return [r.name for r in self.replicas if r.down_until[0] <= now]
+
+    @contextmanager
+    def cursor(self,
+               read_only: bool = False,
+               name: Optional[str] = None,
+               timeout: Optional[str] = None,
+               active: Optional[ActiveConns] = None):
+        """
+        Dict cursor, committed on success and rolled back on error;
+        a name makes it a server-side cursor that fetches in batches.
+        A timeout (e.g., "30s") limits each statement in the transaction,
+        and the connection is kept in "active" while in use so that it
+        can be cancelled from elsewhere.
+        """
+
+        replica, conn = self._connect(read_only)
+        pool = replica.pool if replica else self.primary
+        broken = False
+        try:
+            if timeout:
+                with conn.cursor() as cur:
+                    cur.execute('set local statement_timeout = %s',
+                                (timeout, ))
+            if active is not None:
+                active.add(conn)
+            with conn.cursor(name,
+                             cursor_factory=psycopg2.extras.DictCursor) as cur:
+                yield cur
+            conn.commit()
+        except psycopg2.extensions.QueryCanceledError:
+            conn.rollback()
+            raise
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            broken = bool(conn.closed) or isinstance(e, CONNECTION_LOST)
+            if not broken:
+                conn.rollback()
+            elif replica:
+                self._mark_down(replica)
+            raise
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            if active is not None:
+                active.discard(conn)
+            pool.putconn(conn, close=broken or bool(conn.closed))
+
+    def _connect(self, read_only: bool):
+        """ Connection from the next healthy replica, else the primary """
+
+        if read_only and self.replicas:
+            now = time.monotonic()
+            start = next(self._turn)
+            for i in range(len(self.replicas)):
+                replica = self.replicas[(start + i) % len(self.replicas)]
+                if replica.down_until[0] > now:
+                    continue
+                try:
+                    return replica, replica.pool.getconn(wait=0)
+                except PoolError:
+                    continue
+                except psycopg2.OperationalError:
+                    self._mark_down(replica)
+
+        return None, self.primary.getconn()
+
+    def _mark_down(self, replica: Replica) -> None:
+        with self._lock:
+            replica.down_until[0] = time.monotonic() + self.retry
+
+
+# --------------------------------------------------
+def latest_dataload(cur, schema: str = '') -> str:
+    """ "updated_on" of the latest dataload (in schema), or "" if none """
+
+    cur.execute('select max(updated_on) from {}dataload'.format(
+        f'{schema}.' if schema else ''))
+    return str((cur.fetchone() or [None])[0] or '')
+
+
+# --------------------------------------------------
+def read_config(config_file: str = CONFIG_FILE) -> ConfigParser:
+    """ Read configuration file """
+
+    assert os.path.isfile(config_file)
+    config = ConfigParser(interpolation=None)
+    config.read(config_file)
+    return config
+
+
+# --------------------------------------------------
+def make_dsn(config: ConfigParser, section: str = 'DEFAULT') -> str:
+    """ Make a Postgres DSN from a config section """
+
+    return 'dbname={} user={} password={} host={} connect_timeout={}'.format(
+        config[section]['dbname'], config[section]['dbuser'],
+        config[section]['dbpass'], config[section]['dbhost'],
+        config[section].getint('connect_timeout', fallback=10))
@@ -0,0 +1,72 @@
+"""
+In-memory cache of the lookup (dimension) tables, one per worker
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+#
+# Key and name columns of the tables that are always cached
+#
+LOOKUPS = {
+    'status': ('status_id', 'status_name'),
+    'phase': ('phase_id', 'phase_name'),
+    'study_type': ('study_type_id', 'study_type_name'),
+}
+
+#
+# Larger tables, cached only if they fit in the memory budget
+#
+ENTITIES = {
+    'condition': ('condition_id', 'condition_name'),
+    'sponsor': ('sponsor_id', 'sponsor_name'),
+    'intervention': ('intervention_id', 'intervention_name'),
+}
+
+#
+# Rough cost in bytes of one dict entry with an int key and str value
+#
+ENTRY_OVERHEAD = 150
+
+
+class Dimensions:
+    """ id -> name maps for the lookup tables as of one dataload """
+
+    def __init__(self, dataload: str = '', budget_mb: float = 0):
+        self.dataload = dataload
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.names: Dict[str, Dict[int, str]] = {}
+
+    def load(self, cur) -> 'Dimensions':
+        """ Read the tables with the given cursor """
+
+        for table, (key, name) in LOOKUPS.items():
+            cur.execute(f'select {key}, {name} from {table}')
+            self.names[table] = dict(map(tuple, cur.fetchall()))
+
+        used = 0
+        for table, (key, name) in ENTITIES.items():
+            cur.execute(f'select count(*), coalesce(sum(length({name})), 0) '
+                        f'from {table}')
+            num, chars = cur.fetchone()
+            size = num * ENTRY_OVERHEAD + chars
+            if used + size <= self.budget:
+                cur.execute(f'select {key}, {name} from {table}')
+                self.names[table] = dict(map(tuple, cur.fetchall()))
+                used += size
+
+        return self
+
+    def has(self, table: str) -> bool:
+        """ Whether the table is cached """
+
+        return table in self.names
+
+    def name(self, table: str, key: Optional[int]) -> Optional[str]:
+        """ Name for an id """
+
+        return self.names.get(table, {}).get(key)
+
+    def items(self, table: str) -> List[Tuple[int, str]]:
+        """ (id, name) pairs sorted by name """
+
+        return sorted(self.names.get(table, {}).items(), key=lambda r: r[1])
@@ -0,0 +1,63 @@
+"""
+Cancel a request's database queries when its client goes away
+
+Endpoints run in worker threads and cannot see the client disconnect,
+so the middleware watches the ASGI receive channel instead and cancels
+whatever connections the request has registered in "active_conns".
+"""
+
+import asyncio
+from contextvars import ContextVar
+from db import ActiveConns
+from typing import Optional
+
+#
+# Connections in use by the current request and the endpoint it is for
+#
+active_conns: ContextVar[Optional[ActiveConns]] = ContextVar(
+    'active_conns', default=None)
+endpoint: ContextVar[str] = ContextVar('endpoint', default='')
+
+
+class CancelOnDisconnect:
+    """ ASGI middleware cancelling queries of disconnected clients """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        conns = ActiveConns()
+        conns_token = active_conns.set(conns)
+        endpoint_token = endpoint.set(endpoint_name(scope))
+        messages: asyncio.Queue = asyncio.Queue()
+
+        async def watch():
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message['type'] == 'http.disconnect':
+                    await asyncio.to_thread(conns.cancel)
+                    return
+
+        watcher = asyncio.create_task(watch())
+        try:
+            await self.app(scope, messages.get, send)
+        finally:
+            watcher.cancel()
+            active_conns.reset(conns_token)
+            endpoint.reset(endpoint_token)
+
+
+# --------------------------------------------------
+def endpoint_name(scope) -> str:
+    """ First path segment after the root path, e.g., "search" """
+
+    path = scope.get('path', '')
+    root = scope.get('root_path', '')
+    if root and path.startswith(root):
+        path = path[len(root):]
+
+    return path.strip('/').split('/')[0]
@@ -0,0 +1,158 @@
+"""
+Background export jobs written to local disk
+
+A job is identified by the content key of what it exports, so identical
+requests share one file. Job state lives next to the file as JSON, so
+every worker process can report on and serve any job.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, IO, Optional, Tuple
+
+#
+# Seconds without a progress update before a running job is presumed dead
+#
+STALE_AFTER = 300
+
+
+class Exports:
+    """ Pool of export builders and the directory they write to """
+
+    def __init__(self, directory: str, ttl_hours: float, workers: int):
+        self.directory = directory
+        self.ttl = ttl_hours * 3600
+        self.pool = ThreadPoolExecutor(max_workers=workers,
+                                       thread_name_prefix='export')
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def close(self) -> None:
+        """ Stop taking jobs """
+
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def path(self, key: str) -> str:
+        """ Export file """
+
+        return os.path.join(self.directory, f'{key}.csv')
+
+    def status(self, key: str) -> Optional[dict]:
+        """ Job state, or None if there is no usable job """
+
+        try:
+            with open(self._state_file(key)) as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+        age = time.time() - state['updated']
+        if state['status'] == 'done':
+            if age > self.ttl or not os.path.isfile(self.path(key)):
+                return None
+        elif state['status'] == 'running' and age > STALE_AFTER:
+            state.update(status='failed', error='Export stopped responding')
+        elif state['status'] == 'queued' and not alive(state.get('pid')):
+            # Waiting for a free builder takes as long as the jobs ahead,
+            # so a queued job is lost only with the process queueing it
+            state.update(status='failed', error='Export was never started')
+
+        return state
+
+    def submit(self, key: str, total: int,
+               build: Callable[[IO, Callable[[int], None]], int]) -> dict:
+        """ Start building an export unless a usable one exists """
+
+        self.expire()
+        with self._lock:
+            if (state := self.status(key)) and state['status'] != 'failed':
+                return state
+
+            state = self._save(key,
+                               status='queued',
+                               done=0,
+                               total=total,
+                               pid=os.getpid())
+        self.pool.submit(self._run, key, total, build)
+        return state
+
+    def expire(self) -> None:
+        """ Remove exports older than the time to live """
+
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if now - entry.stat().st_mtime > max(self.ttl, STALE_AFTER):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def _run(self, key: str, total: int,
+             build: Callable[[IO, Callable[[int], None]], int]) -> None:
+        tmp = ''
+        last = [0.]
+
+        def progress(done: int) -> None:
+            if time.time() - last[0] >= 1:
+                last[0] = time.time()
+                self._save(key, status='running', done=done, total=total)
+
+        try:
+            self._save(key, status='running', done=0, total=total)
+            fd, tmp = temp_file(self.path(key))
+            with os.fdopen(fd, 'w', newline='') as fh:
+                num_studies = build(fh, progress)
+            os.replace(tmp, self.path(key))
+            self._save(key,
+                       status='done',
+                       done=total,
+                       total=total,
+                       num_studies=num_studies,
+                       size=os.path.getsize(self.path(key)))
+        except Exception as e:
+            if tmp and os.path.isfile(tmp):
+                os.remove(tmp)
+            self._save(key, status='failed', done=0, total=total, error=str(e))
+
+    def _save(self, key: str, **state) -> dict:
+        state.update(export_id=key, updated=time.time())
+        fd, tmp = temp_file(self._state_file(key))
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(state, fh)
+        os.replace(tmp, self._state_file(key))
+        return state
+
+    def _state_file(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.json')
+
+
+# --------------------------------------------------
+def temp_file(path: str) -> Tuple[int, str]:
+    """ Descriptor and name of a new file to write and then move to path """
+
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                               suffix='.tmp',
+                               dir=os.path.dirname(path))
+    os.fchmod(fd, 0o644)
+    return fd, tmp
+
+
+# --------------------------------------------------
+def alive(pid: Optional[int]) -> bool:
+    """ Whether the process is running """
+
+    if not pid:
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
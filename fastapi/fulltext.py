@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Incrementally maintain the weighted Study.fulltext vector, and its copy
+in the study search table
+"""
+
+import argparse
+import psycopg2
+import study_search
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from db import CONFIG_FILE, latest_dataload, make_dsn, read_config
+from typing import List, NamedTuple, Optional
+
+#
+# Sections of a study weighted for ranking, most important first; the
+# text the loader gathers in fulltext_load (e.g., condition names) is kept
+# at the lowest weight so nothing it matched before goes unmatched
+#
+SECTIONS = [
+    ('A', "coalesce(s.official_title, '') || ' ' || "
+     "coalesce(s.brief_title, '') || ' ' || coalesce(s.acronym, '')"),
+    ('B', "coalesce(s.keywords, '')"),
+    ('C', "coalesce(s.brief_summary, '')"),
+    ('D', "coalesce(s.detailed_description, '') || ' ' || "
+     "coalesce(s.fulltext_load, '')"),
+]
+
+FULLTEXT_SQL = ' || '.join(
+    f"setweight(to_tsvector('english', {text}), '{weight}')"
+    for weight, text in SECTIONS)
+
+SOURCE_HASH_SQL = 'md5({})'.format(" || '|' || ".join(text
+                                                     for _, text in SECTIONS))
+
+
+class Args(NamedTuple):
+    """ Command-line arguments """
+    config: str
+    since: Optional[str]
+    all: bool
+    batch_size: int
+    workers: int
+
+
+# --------------------------------------------------
+def get_args() -> Args:
+    """ Get command-line arguments """
+
+    parser = argparse.ArgumentParser(
+        description='Incrementally maintain the weighted Study.fulltext',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-c',
+                        '--config',
+                        help='Configuration file',
+                        metavar='FILE',
+                        default=CONFIG_FILE)
+
+    parser.add_argument('-s',
+                        '--since',
+                        help='Check studies updated since (default: '
+                        'the latest dataload)',
+                        metavar='DATE')
+
+    parser.add_argument('-a',
+                        '--all',
+                        help='Check every study',
+                        action='store_true')
+
+    parser.add_argument('-b',
+                        '--batch_size',
+                        help='Studies per update',
+                        metavar='INT',
+                        type=int,
+                        default=1000)
+
+    parser.add_argument('-w',
+                        '--workers',
+                        help='Number of parallel workers',
+                        metavar='INT',
+                        type=int,
+                        default=4)
+
+    args = parser.parse_args()
+
+    if args.batch_size < 1:
+        parser.error(f'--batch_size "{args.batch_size}" must be > 0')
+
+    if args.workers < 1:
+        parser.error(f'--workers "{args.workers}" must be > 0')
+
+    return Args(args.config, args.since, args.all, args.batch_size,
+                args.workers)
+
+
+# --------------------------------------------------
+def main() -> None:
+    """ Make a jazz noise here """
+
+    args = get_args()
+    dsn = make_dsn(read_config(args.config))
+
+    dbh = psycopg2.connect(dsn)
+    prepare(dbh)
+    since = None if args.all else args.since or last_dataload(dbh)
+    study_ids = candidates(dbh, since, args.all)
+    cur = dbh.cursor()
+    cur.execute('select to_regclass(%s)', (f'public.{study_search.TABLE}', ))
+    searched = bool(cur.fetchone()[0])
+    cur.close()
+    dbh.close()
+
+    batches = [
+        study_ids[i:i + args.batch_size]
+        for i in range(0, len(study_ids), args.batch_size)
+    ]
+
+    print('Checking {:,} studies{} in {:,} batches'.format(
+        len(study_ids), f' updated since {since}' if since else '',
+        len(batches)))
+
+    local = threading.local()
+    connections = []
+    lock = threading.Lock()
+
+    def run(batch: List[int]) -> int:
+        if not hasattr(local, 'dbh'):
+            local.dbh = psycopg2.connect(dsn)
+            with lock:
+                connections.append(local.dbh)
+        return update_batch(local.dbh, batch, searched)
+
+    num_updated = 0
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            jobs = [pool.submit(run, batch) for batch in batches]
+            for job in as_completed(jobs):
+                num_updated += job.result()
+    finally:
+        for conn in connections:
+            conn.close()
+
+    print(f'Done, updated {num_updated:,} studies.')
+
+
+# --------------------------------------------------
+def prepare(dbh) -> None:
+    """ Add the column holding the hash of the indexed text """
+
+    cur = dbh.cursor()
+    cur.execute('alter table study add column if not exists '
+                'fulltext_hash char(32)')
+    dbh.commit()
+    cur.close()
+
+
+# --------------------------------------------------
+def carry_forward(dbh, schema: str) -> int:
+    """
+    Copy the vectors of studies whose text is unchanged from the live
+    table to the one loaded into schema (on the search path)
+    """
+
+    cur = dbh.cursor()
+    cur.execute(
+        """
+        select 1
+        from   information_schema.columns
+        where  table_schema='public'
+        and    table_name='study'
+        and    column_name='fulltext_hash'
+        """)
+    if not cur.fetchone():
+        cur.close()
+        return 0
+
+    cur.execute(f"""
+        update {schema}.study s
+        set    fulltext=o.fulltext,
+               fulltext_hash=o.fulltext_hash
+        from   public.study o
+        where  o.nct_id=s.nct_id
+        and    s.fulltext_hash is null
+        and    o.fulltext_hash={SOURCE_HASH_SQL}
+    """)
+    num = cur.rowcount
+    dbh.commit()
+    cur.close()
+
+    return num
+
+
+# --------------------------------------------------
+def last_dataload(dbh) -> Optional[str]:
+    """ Date of the latest dataload """
+
+    cur = dbh.cursor()
+    dataload = latest_dataload(cur)
+    cur.close()
+
+    return dataload or None
+
+
+# --------------------------------------------------
+def candidates(dbh, since: Optional[str], every: bool = False) -> List[int]:
+    """ Studies touched since the date or never indexed, or every study """
+
+    sql = """
+        select   s.study_id
+        from     study s
+        where    s.fulltext is null
+        or       s.fulltext_hash is null
+        {}
+        order by 1
+    """.format('or true' if every else
+               'or s.record_last_updated >= %s' if since else '')
+
+    cur = dbh.cursor()
+    cur.execute(sql, (since, ) if since else None)
+    study_ids = [rec[0] for rec in cur.fetchall()]
+    cur.close()
+
+    return study_ids
+
+
+# --------------------------------------------------
+def update_batch(dbh, study_ids: List[int], searched: bool = False) -> int:
+    """
+    Recompute the vector for studies whose text changed, and copy it to
+    the study search table if searched, as /search may read it there
+    """
+
+    sql = f"""
+        update study s
+        set    fulltext={FULLTEXT_SQL},
+               fulltext_hash={SOURCE_HASH_SQL}
+        where  s.study_id = any(%s)
+        and    (s.fulltext is null
+                or s.fulltext_hash is distinct from {SOURCE_HASH_SQL})
+    """
+
+    cur = dbh.cursor()
+    try:
+        cur.execute(sql, (study_ids, ))
+        num = cur.rowcount
+        if searched and num:
+            cur.execute(
+                f"""
+                update {study_search.TABLE} x
+                set    fulltext=s.fulltext
+                from   study s
+                where  x.study_id=s.study_id
+                and    s.study_id = any(%s)
+                and    x.fulltext is distinct from s.fulltext
+                """, (study_ids, ))
+        dbh.commit()
+    except Exception:
+        dbh.rollback()
+        raise
+    finally:
+        cur.close()
+
+    return num
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Dictionary of the words behind Study.fulltext for search-box completion
+
+The words of the text the fulltext vector is made from (see fulltext.py),
+as written rather than stemmed, and the number of studies containing
+each are read once per dataload with ts_stat() and written sorted into a
+single file. Workers map it read-only and answer prefix queries by
+binary search, so typed terms, whole or partial, are completed to words
+that actually match studies when searched (and stemmed) again.
+"""
+
+import argparse
+import heapq
+import psycopg2
+from array import array
+from fulltext import SECTIONS as TEXT_SECTIONS
+from db import CONFIG_FILE, latest_dataload, make_dsn, read_config
+from mapped import MappedFile
+from typing import List, NamedTuple, Tuple
+
+MAX_LEXEME = 40
+
+#
+# Arrays in file order, with their array typecodes; "B" is a raw blob
+#
+SECTIONS = [
+    ('num_studies', 'I'),
+    ('lexeme_offset', 'I'),
+    ('lexeme', 'B'),
+]
+
+
+class Args(NamedTuple):
+    """ Command-line arguments """
+    config: str
+    outfile: str
+    min_studies: int
+
+
+class Lexicon(MappedFile):
+    """ Read-only view of a lexicon file """
+
+    MAGIC = b'CTLX'
+    VERSION = 2
+    KIND = 'lexicon'
+    SECTIONS = SECTIONS
+
+    @property
+    def num_lexemes(self) -> int:
+        return self.count
+
+    def complete(self, prefix: str, k: int) -> List[Tuple[str, int]]:
+        """ The k words starting with prefix found in the most studies """
+
+        key = prefix.lower().encode()
+        lo = self._bisect(key)
+
+        # No UTF-8 byte is 0xff, so this sorts after every completion
+        hi = self._bisect(key + b'\xff')
+
+        counts = self._views['num_studies']
+        top = heapq.nlargest(k, range(lo, hi), key=counts.__getitem__)
+        return [(self._lexeme(i), counts[i]) for i in top]
+
+    def _bisect(self, key: bytes) -> int:
+        lo, hi = 0, self.num_lexemes
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._lexeme_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def _lexeme_bytes(self, i: int) -> bytes:
+        offsets = self._views['lexeme_offset']
+        return self._views['lexeme'][offsets[i]:offsets[i + 1]].tobytes()
+
+    def _lexeme(self, i: int) -> str:
+        return self._lexeme_bytes(i).decode()
+
+
+# --------------------------------------------------
+def get_args() -> Args:
+    """ Get command-line arguments """
+
+    parser = argparse.ArgumentParser(
+        description='Build the lexicon of fulltext lexemes',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-c',
+                        '--config',
+                        help='Configuration file',
+                        metavar='FILE',
+                        default=CONFIG_FILE)
+
+    parser.add_argument('-o',
+                        '--outfile',
+                        help='Lexicon file (default: lexicon_file '
+                        'from config)',
+                        metavar='FILE',
+                        default='')
+
+    parser.add_argument('-m',
+                        '--min_studies',
+                        help='Leave out lexemes found in fewer studies',
+                        metavar='INT',
+                        type=int,
+                        default=2)
+
+    args = parser.parse_args()
+    return Args(args.config, args.outfile, args.min_studies)
+
+
+# --------------------------------------------------
+def main() -> None:
+    """ Make a jazz noise here """
+
+    args = get_args()
+    config = read_config(args.config)
+    outfile = args.outfile or config['DEFAULT'].get('lexicon_file', '')
+    if not outfile:
+        raise SystemExit('No --outfile and no lexicon_file in config')
+
+    dbh = psycopg2.connect(make_dsn(config))
+    num = build(dbh, outfile, args.min_studies)
+    dbh.close()
+
+    print(f'Wrote {num:,} lexemes to "{outfile}".')
+
+
+# --------------------------------------------------
+def build(dbh, outfile: str, min_studies: int = 2) -> int:
+    """ Write the lexicon for the current data, replacing any old file """
+
+    cur = dbh.cursor()
+    dataload = latest_dataload(cur)
+
+    # Unstemmed words, less those the english config drops as stop words
+    text = " || ' ' || ".join(text for _, text in TEXT_SECTIONS)
+    cur.execute(
+        """
+        select word, ndoc
+        from   ts_stat(%s)
+        where  ndoc >= %s
+        and    length(word) <= %s
+        and    numnode(plainto_tsquery('english', word)) > 0
+        """, (f"select to_tsvector('simple', {text}) from study s",
+              min_studies, MAX_LEXEME))
+
+    # Sorted as UTF-8 bytes to match the binary search in Lexicon
+    lexemes = sorted((word.encode(), ndoc) for word, ndoc in cur.fetchall())
+    cur.close()
+    dbh.rollback()
+
+    arrays = {
+        name: array(code) if code != 'B' else bytearray()
+        for name, code in SECTIONS
+    }
+    arrays['lexeme_offset'].append(0)
+    for word, ndoc in lexemes:
+        arrays['num_studies'].append(ndoc)
+        arrays['lexeme'].extend(word)
+        arrays['lexeme_offset'].append(len(arrays['lexeme']))
+
+    return Lexicon.write(outfile, dataload, len(lexemes), arrays)
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -4,31 +4,111 @@ FastAPI server for Clinical Trials
 
 import csv
 import ct
+import hashlib
 import io
+import json
+import logging
 import os
 import psycopg2
-import psycopg2.extras
+import psycopg2.errors
 import re
-from configparser import ConfigParser
-from dateutil.parser import parse
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
-from functools import lru_cache
-from itertools import chain
+import stats
+import struct
+import study_search
+import threading
+import time
+from coalesce import Coalescer
+from contextlib import asynccontextmanager
+from db import Pools, latest_dataload, read_config
+from dimensions import LOOKUPS, Dimensions
+from disconnect import CancelOnDisconnect, active_conns, endpoint
+from exports import Exports
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from lexicon import Lexicon
+from predicates import LINKS, And, Eligible, LinkedIds, LinkedNames, Where
+from psycopg2.pool import PoolError
 from pydantic import BaseModel
-from pymongo import MongoClient
+from related import Related
 from starlette.middleware.cors import CORSMiddleware
-from typing import List, Optional
+from study_index import StudyIndex
+from typing import Callable, Dict, Iterator, List, Optional, TextIO, Tuple
 
 #
 # Read configuration for global settings
 #
-config_file = './config.ini'
-assert os.path.isfile(config_file)
-config = ConfigParser(interpolation=None)
-config.read(config_file)
+config = read_config()
+pools = None
+study_index = None
+latest_index = None
+lexicon = None
+related = None
+latest_related = None
+cube = None
+latest_cube = None
+dims = Dimensions()
+dims_checked = 0.
+dims_lock = threading.Lock()
+file_stamps: Dict[str, Tuple[int, int]] = {}
+search_table_for = ('', 'study', 0.)
+coalescer = Coalescer()
+exports = None
+logger = logging.getLogger('uvicorn.error')
 
-app = FastAPI(root_path=config['DEFAULT']['api_prefix'])
+
+# --------------------------------------------------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """ Connect to the database and optionally warm caches per worker """
+
+    global exports, lexicon, pools
+    start = time.perf_counter()
+
+    pools = Pools(config)
+    try:
+        pools.warm()
+    except psycopg2.Error as e:
+        logger.warning('Cannot connect to the primary: %s', e)
+    exports = Exports(
+        config['DEFAULT'].get('export_dir', './exports'),
+        config['DEFAULT'].getfloat('export_ttl_hours', fallback=24.),
+        config['DEFAULT'].getint('export_workers', fallback=2))
+    ct.database.init(config['DEFAULT']['dbname'],
+                     user=config['DEFAULT']['dbuser'],
+                     password=config['DEFAULT']['dbpass'],
+                     host=config['DEFAULT']['dbhost'])
+
+    # Files from another dataload go unused, so check it before using any
+    lexicon = reopen(None, 'lexicon_file', Lexicon)
+    try:
+        with get_cur(read_only=True) as cur:
+            refresh_files(latest_dataload(cur))
+    except psycopg2.Error as e:
+        logger.warning('Cannot check the dataload of the files: %s', e)
+
+    if config['DEFAULT'].getboolean('warm_cache', fallback=False):
+        warm_cache()
+
+    logger.info('Worker started in %.3f seconds',
+                time.perf_counter() - start)
+
+    yield
+
+    exports.close()
+    if latest_index:
+        latest_index.close()
+    if lexicon:
+        lexicon.close()
+    if latest_related:
+        latest_related.close()
+    if latest_cube:
+        latest_cube.close()
+    ct.database.close()
+    pools.close()
+
+
+app = FastAPI(root_path=config['DEFAULT']['api_prefix'], lifespan=lifespan)
 
 origins = [
     "http://localhost:*",
@@ -42,6 +122,60 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CancelOnDisconnect)
+
+
+# --------------------------------------------------
+@app.exception_handler(psycopg2.Error)
+def database_error(request: Request, e: psycopg2.Error) -> JSONResponse:
+    """
+    Malformed search syntax is 400, timeouts 504, an unreachable database
+    503, the rest 500
+    """
+
+    if isinstance(e, psycopg2.errors.SyntaxError) and 'tsquery' in str(e):
+        return JSONResponse(status_code=400,
+                            content={
+                                'detail': {
+                                    'error': 'bad_query',
+                                    'message': 'Bad search: ' +
+                                    str(e).strip().splitlines()[0]
+                                }
+                            })
+
+    if isinstance(e, psycopg2.extensions.QueryCanceledError):
+        logger.warning('%s: %s', request.url.path, str(e).strip())
+        return JSONResponse(status_code=504,
+                            content={
+                                'detail': {
+                                    'error': 'query_canceled',
+                                    'message': 'Query timed out or canceled',
+                                    'timeout': statement_timeout()
+                                }
+                            })
+
+    if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError,
+                      PoolError)):
+        logger.error('%s: %s', request.url.path, str(e).strip())
+        retry = config['DEFAULT'].getint('retry_after', fallback=5)
+        return JSONResponse(status_code=503,
+                            headers={'Retry-After': str(retry)},
+                            content={
+                                'detail': {
+                                    'error': 'database_unavailable',
+                                    'message': 'Database unavailable',
+                                    'retry_after': retry
+                                }
+                            })
+
+    logger.exception('%s: database error', request.url.path, exc_info=e)
+    return JSONResponse(status_code=500,
+                        content={
+                            'detail': {
+                                'error': 'database_error',
+                                'message': 'Database error'
+                            }
+                        })
 
 
 class ConditionDropDown(BaseModel):
@@ -55,11 +189,29 @@ class Dataload(BaseModel):
     updated_on: str
 
 
+class Location(BaseModel):
+    study_location_id: int
+    study_id: int
+    nct_id: str
+    title: str
+    facility_name: Optional[str] = None
+    investigator_name: Optional[str] = None
+    contact_name: Optional[str] = None
+    status: Optional[str] = None
+
+
 class Phase(BaseModel):
     phase_id: int
     phase_name: str
 
 
+class RelatedStudy(BaseModel):
+    study_id: int
+    nct_id: str
+    title: str
+    similarity: float
+
+
 class SavedSearch(BaseModel):
     saved_search_id: int
     search_name: str
@@ -87,6 +239,14 @@ class StudyCart(BaseModel):
     title: str
 
 
+class SavedSearchResults(BaseModel):
+    saved_search_id: int
+    dataload: str
+    since: Optional[str] = None
+    count: int
+    records: List[StudyCart]
+
+
 class StudyDownload(BaseModel):
     study_id: int
     nct_id: str
@@ -94,10 +254,41 @@ class StudyDownload(BaseModel):
     detailed_description: str
 
 
+class ExportRequest(BaseModel):
+    study_ids: str
+    fields: Optional[str] = ''
+
+
+class ExportJob(BaseModel):
+    export_id: str
+    status: str
+    done: int
+    total: int
+    num_studies: Optional[int] = None
+    size: Optional[int] = None
+    error: Optional[str] = None
+
+
 class StudySearchResult(BaseModel):
     study_id: int
     nct_id: str
     title: str
+    rank: Optional[float] = None
+    official_title: Optional[str] = None
+    brief_title: Optional[str] = None
+    acronym: Optional[str] = None
+    brief_summary: Optional[str] = None
+    detailed_description: Optional[str] = None
+    keywords: Optional[str] = None
+    enrollment: Optional[int] = None
+    start_date: Optional[str] = None
+    completion_date: Optional[str] = None
+    study_first_posted: Optional[str] = None
+    last_update_posted: Optional[str] = None
+    phase_id: Optional[int] = None
+    study_type_id: Optional[int] = None
+    overall_status_id: Optional[int] = None
+    last_known_status_id: Optional[int] = None
 
 
 class StudyDoc(BaseModel):
@@ -133,38 +324,37 @@ class StudyIntervention(BaseModel):
 
 class StudyDetail(BaseModel):
     study_id: int
-    study_type_id: int
-    study_type: str
-    phase_id: int
-    phase: str
-    overall_status_id: int
-    overall_status: str
-    last_known_status_id: int
-    last_known_status: str
+    study_type_id: Optional[int] = None
+    study_type: Optional[str] = None
+    phase_id: Optional[int] = None
+    phase: Optional[str] = None
+    overall_status_id: Optional[int] = None
+    overall_status: Optional[str] = None
+    last_known_status_id: Optional[int] = None
+    last_known_status: Optional[str] = None
     nct_id: str
-    official_title: str
-    brief_title: str
-    detailed_description: str
-    org_study_id: str
-    acronym: str
-    source: str
-    rank: str
-    brief_summary: str
-    why_stopped: Optional[str]
-    study_type: Optional[str]
-    has_expanded_access: Optional[str]
-    target_duration: Optional[str]
-    biospec_retention: Optional[str]
-    biospec_description: Optional[str]
-    keywords: Optional[str]
-    start_date: Optional[str]
-    completion_date: Optional[str]
-    enrollment: Optional[int]
-    sponsors: List[StudySponsor]
-    conditions: List[StudyCondition]
-    interventions: List[StudyIntervention]
-    study_outcomes: List[StudyOutcome]
-    study_docs: List[StudyDoc]
+    official_title: Optional[str] = None
+    brief_title: Optional[str] = None
+    detailed_description: Optional[str] = None
+    org_study_id: Optional[str] = None
+    acronym: Optional[str] = None
+    source: Optional[str] = None
+    rank: Optional[str] = None
+    brief_summary: Optional[str] = None
+    why_stopped: Optional[str] = None
+    has_expanded_access: Optional[str] = None
+    target_duration: Optional[str] = None
+    biospec_retention: Optional[str] = None
+    biospec_description: Optional[str] = None
+    keywords: Optional[str] = None
+    start_date: Optional[str] = None
+    completion_date: Optional[str] = None
+    enrollment: Optional[int] = None
+    sponsors: Optional[List[StudySponsor]] = None
+    conditions: Optional[List[StudyCondition]] = None
+    interventions: Optional[List[StudyIntervention]] = None
+    study_outcomes: Optional[List[StudyOutcome]] = None
+    study_docs: Optional[List[StudyDoc]] = None
 
 
 class StudyType(BaseModel):
@@ -178,26 +368,348 @@ class Sponsor(BaseModel):
     num_studies: int
 
 
+class Suggestion(BaseModel):
+    lexeme: str
+    num_studies: int
+
+
+class StatsGroup(BaseModel):
+    values: List[Optional[int]]
+    names: List[Optional[str]]
+    count: int
+
+
+class StatsResults(BaseModel):
+    group_by: List[str]
+    total: int
+    groups: List[StatsGroup]
+
+
 class Summary(BaseModel):
     num_studies: int
 
 
 class SearchResults(BaseModel):
-    count: int
+    count: Optional[int] = None
     records: List[StudySearchResult]
 
 
-dsn_tmpl = 'dbname={} user={} password={} host={}'
-dsn = dsn_tmpl.format(config['DEFAULT']['dbname'], config['DEFAULT']['dbuser'],
-                      config['DEFAULT']['dbpass'], config['DEFAULT']['dbhost'])
-dbh = psycopg2.connect(dsn)
+class LocationResults(BaseModel):
+    count: int
+    records: List[Location]
+
+
+#
+# Weights of the fulltext sections {D, C, B, A} (see fulltext.py)
+#
+RANK_WEIGHTS = '{0.1, 0.2, 0.4, 1.0}'
+RELEVANCE_TOP_K = 50
+STREAM_BATCH = 1000
+COALESCE_LABEL_LEN = 200
+SAVED_RESULTS_KEEP = 10
+SUGGEST_MIN_PREFIX = 2
+SUGGEST_MAX = 50
+LOCATIONS_PAGE = 100
+LOCATIONS_MAX = 1000
+RELATED_MAX = 20
+STATS_MAX_GROUP_BY = 3
+
+#
+# Ages as in the eligibility criteria, in years when no unit is given;
+# they are converted to days by age_in_days() (see migrate.py)
+#
+AGE_RE = re.compile(
+    r'^\s*(\d+(?:\.\d+)?)\s*(year|month|week|day|hour|minute)?s?\s*$',
+    re.I)
+AGE_UNITS = {
+    'year': 365.25,
+    'month': 30.4375,
+    'week': 7,
+    'day': 1,
+    'hour': 1 / 24,
+    'minute': 1 / 1440
+}
+MAX_AGE_YEARS = 150
+GENDERS = ['all', 'female', 'male']
+DOWNLOAD_BATCH = 500
+EXPORT_CHUNK = 1024 * 1024
+
+DOWNLOAD_FIELDS = [
+    'nct_id', 'official_title', 'brief_title', 'brief_summary',
+    'detailed_description', 'keywords', 'enrollment', 'start_date',
+    'completion_date', 'last_known_status', 'overall_status', 'conditions',
+    'interventions', 'outcomes', 'sponsors', 'study_docs'
+]
+
+#
+# Study columns that may be requested with "fields" in /search
+#
+SEARCH_FIELDS = [
+    'official_title', 'brief_title', 'acronym', 'brief_summary',
+    'detailed_description', 'keywords', 'enrollment', 'start_date',
+    'completion_date', 'study_first_posted', 'last_update_posted',
+    'phase_id', 'study_type_id', 'overall_status_id', 'last_known_status_id'
+]
+
+#
+# Fields of /study: study columns, lookup names and child collections
+#
+STUDY_COLUMNS = [
+    'study_type_id', 'phase_id', 'overall_status_id', 'last_known_status_id',
+    'official_title', 'brief_title', 'detailed_description', 'org_study_id',
+    'acronym', 'source', 'rank', 'brief_summary', 'why_stopped',
+    'has_expanded_access', 'target_duration', 'biospec_retention',
+    'biospec_description', 'keywords', 'start_date', 'completion_date',
+    'enrollment'
+]
+
+STUDY_LOOKUPS = {
+    'study_type': ('study_type_id', 'study_type'),
+    'phase': ('phase_id', 'phase'),
+    'overall_status': ('overall_status_id', 'status'),
+    'last_known_status': ('last_known_status_id', 'status'),
+}
+
+#
+# Study columns returned as they are; text columns give '' for null
+#
+STUDY_AS_IS = ['enrollment'] + [col for col, _ in STUDY_LOOKUPS.values()]
+
+STUDY_LINKED = {
+    'sponsors': 'sponsor',
+    'conditions': 'condition',
+    'interventions': 'intervention',
+}
+
+STUDY_CHILDREN = {
+    'sponsors':
+    """
+        select   p.sponsor_id, p.sponsor_name
+        from     study_to_sponsor s2p, sponsor p
+        where    s2p.study_id=%s
+        and      s2p.sponsor_id=p.sponsor_id
+    """,
+    'conditions':
+    """
+        select   c.condition_id, c.condition_name
+        from     study_to_condition s2c, condition c
+        where    s2c.study_id=%s
+        and      s2c.condition_id=c.condition_id
+    """,
+    'interventions':
+    """
+        select   i.intervention_id, i.intervention_name
+        from     study_to_intervention s2i, intervention i
+        where    s2i.study_id=%s
+        and      s2i.intervention_id=i.intervention_id
+    """,
+    'study_outcomes':
+    """
+        select   o.study_outcome_id, o.outcome_type, o.measure,
+                 o.time_frame, o.description
+        from     study_outcome o
+        where    o.study_id=%s
+    """,
+    'study_docs':
+    """
+        select   d.study_doc_id, d.doc_id, d.doc_type, d.doc_url,
+                 d.doc_comment
+        from     study_doc d
+        where    d.study_id=%s
+    """,
+}
+
+#
+# Indexes behind the typeahead lookups, loaded into shared buffers with
+# pg_prewarm where the extension is installed
+#
+WARM_INDEXES = [
+    'condition_condition_fulltext_idx',
+    'study_to_condition_condition_id_study_id_idx',
+    'sponsor_sponsor_fulltext_idx', 'study_to_sponsor_sponsor_id_study_id_idx'
+]
+
+
+# --------------------------------------------------
+def get_cur(read_only: bool = False,
+            name: Optional[str] = None,
+            shared: bool = False):
+    """
+    Get db cursor, from a read replica if read_only, with the statement
+    timeout of the current endpoint. Its queries are canceled if the
+    client disconnects unless the work is shared with other requests.
+    """
+
+    return pools.cursor(read_only,
+                        name,
+                        timeout=statement_timeout(),
+                        active=None if shared else active_conns.get())
 
 
 # --------------------------------------------------
-def get_cur():
-    """ Get db cursor """
+def statement_timeout() -> str:
+    """ "statement_timeout_<endpoint>" from config, else the default """
 
-    return dbh.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    section = config['DEFAULT']
+    return section.get(f'statement_timeout_{endpoint.get()}',
+                       section.get('statement_timeout', ''))
+
+
+# --------------------------------------------------
+def get_dims() -> Dimensions:
+    """ Lookup names, reloaded when a new dataload appears """
+
+    global dims, dims_checked
+    interval = config['DEFAULT'].getfloat('dataload_check', fallback=60.)
+    if time.monotonic() - dims_checked < interval:
+        return dims
+
+    with dims_lock:
+        if time.monotonic() - dims_checked >= interval:
+            try:
+                with get_cur(read_only=True) as cur:
+                    dataload = latest_dataload(cur)
+                    if dataload != dims.dataload or not dims.names:
+                        if dims.dataload:
+                            logger.info('New dataload %s', dataload)
+                        dims = Dimensions(
+                            dataload, config['DEFAULT'].getfloat(
+                                'dimension_budget_mb',
+                                fallback=64.)).load(cur)
+                refresh_files(dataload)
+                dims_checked = time.monotonic()
+            except Exception as e:
+                logger.error('Cannot load lookups: %s', e)
+
+    return dims
+
+
+# --------------------------------------------------
+def lookup_name(cur, dims: Dimensions, table: str,
+                value: Optional[int]) -> str:
+    """
+    Name of an id in a lookup table, read from the table if the cached
+    names lack it (until the next dataload check, or if they failed to
+    load)
+    """
+
+    if value is None:
+        return ''
+
+    name = dims.name(table, value)
+    if name is None:
+        key, col = LOOKUPS[table]
+        cur.execute(f'select {col} from {table} where {key}=%s', (value, ))
+        name = (cur.fetchone() or [None])[0]
+
+    return name or ''
+
+
+# --------------------------------------------------
+def refresh_files(dataload: str) -> None:
+    """
+    Map the study index, lexicon, related studies and stats cube again when
+    they are rebuilt; any but the lexicon from another dataload has the
+    wrong studies, so it goes unused until one for this dataload is written
+    """
+
+    global cube, latest_cube, latest_index, latest_related, lexicon
+    global related, study_index
+    lexicon = reopen(lexicon, 'lexicon_file', Lexicon)
+    latest_index = reopen(latest_index, 'study_index_file', StudyIndex)
+    study_index = latest_index if latest_index and (latest_index.dataload
+                                                    == dataload) else None
+    latest_related = reopen(latest_related, 'related_file', Related)
+    related = latest_related if latest_related and (
+        latest_related.dataload == dataload) else None
+    latest_cube = reopen(latest_cube, 'stats_file', stats.Cube)
+    cube = latest_cube if latest_cube and (latest_cube.dataload
+                                           == dataload) else None
+
+
+# --------------------------------------------------
+def reopen(current, option: str, cls: Callable):
+    """
+    The file named by the option opened with cls if it has been written
+    since last opened, else current. Replaced files are not closed, as
+    requests may still be reading them; they are unmapped once unused.
+    """
+
+    filename = config['DEFAULT'].get(option, '')
+    if not filename or not os.path.isfile(filename):
+        return current
+
+    stat = os.stat(filename)
+    stamp = (stat.st_ino, stat.st_mtime_ns)
+    if file_stamps.get(option) == stamp:
+        return current
+
+    file_stamps[option] = stamp
+    try:
+        opened = cls(filename)
+        logger.info('Using "%s" from dataload %s', filename, opened.dataload)
+        return opened
+    except (OSError, ValueError, struct.error) as e:
+        logger.warning('Not using "%s": %s', filename, e)
+        return current
+
+
+# --------------------------------------------------
+def search_table() -> str:
+    """
+    "study_search" if enabled and built from the current dataload; until it
+    is (or while it cannot be checked), check again every dataload_check
+    seconds, as it may be built after the dataload
+    """
+
+    global search_table_for
+    if not config['DEFAULT'].getboolean('use_study_search', fallback=False):
+        return 'study'
+
+    dataload = get_dims().dataload
+    checked_for, table, checked = search_table_for
+    interval = config['DEFAULT'].getfloat('dataload_check', fallback=60.)
+    if checked_for != dataload or (table == 'study' and
+                                   time.monotonic() - checked >= interval):
+        table = 'study'
+        try:
+            with get_cur(read_only=True) as cur:
+                cur.execute(
+                    "select obj_description(to_regclass(%s), 'pg_class')",
+                    (study_search.TABLE, ))
+                if cur.fetchone()[0] == dataload:
+                    table = study_search.TABLE
+        except psycopg2.Error as e:
+            logger.error('Cannot check %s: %s', study_search.TABLE, e)
+
+        search_table_for = (dataload, table, time.monotonic())
+
+    return table
+
+
+# --------------------------------------------------
+def warm_cache() -> None:
+    """
+    Preload lookups so the first request is as fast as the rest; each
+    worker does this, so it is off by default
+    """
+
+    get_dims()
+
+    for read_only in [False] + [True] * len(pools.replicas):
+        try:
+            with get_cur(read_only=read_only) as cur:
+                cur.execute("select 1 from pg_extension "
+                            "where extname='pg_prewarm'")
+                if cur.fetchone():
+                    cur.execute(
+                        """
+                        select pg_prewarm(to_regclass(name))
+                        from   unnest(%s) as name
+                        where  to_regclass(name) is not null
+                        """, (WARM_INDEXES, ))
+        except psycopg2.Error as e:
+            logger.warning('Cannot warm cache: %s', e)
 
 
 # --------------------------------------------------
@@ -205,31 +717,51 @@ def get_cur():
 def view_cart(study_ids: str) -> List[StudyCart]:
     """ View studies in cart """
 
-    ids = list(filter(str.isdigit, re.split(r'\s*,\s*', study_ids)))
-    sql = """
-        select s.study_id, s.nct_id, s.brief_title
-        from   study s
-        where  s.study_id in ({})
-    """.format(', '.join(ids))
+    # Each study once, in the order first given
+    ids = list(
+        dict.fromkeys(
+            map(int, filter(str.isdigit, re.split(r'\s*,\s*', study_ids)))))
+    titles = study_titles(ids)
 
-    # print(sql)
+    def f(study_id):
+        nct_id, brief_title, _ = titles[study_id]
+        return StudyCart(study_id=study_id, nct_id=nct_id, title=brief_title)
 
-    def f(rec):
-        return StudyCart(study_id=rec['study_id'],
-                         nct_id=rec['nct_id'],
-                         title=rec['brief_title'])
+    return list(map(f, filter(lambda i: i in titles, ids)))
 
-    res = []
-    try:
-        cur = get_cur()
-        cur.execute(sql)
-        res = cur.fetchall()
-    except:
-        dbh.rollback()
-    finally:
-        cur.close()
 
-    return list(map(f, res))
+# --------------------------------------------------
+def study_titles(study_ids: List[int],
+                 shared: bool = False) -> Dict[int, Tuple[str, str, str]]:
+    """
+    NCT ID, brief and official title by study, from the index if loaded;
+    shared if the work is for other requests too (see get_cur)
+    """
+
+    # A new dataload can unload the index meanwhile
+    get_dims()
+    titles = {}
+    if index := study_index:
+        for study_id in study_ids:
+            if rec := index.get(study_id):
+                titles[study_id] = (rec.nct_id, rec.brief_title,
+                                    rec.official_title)
+
+    if missing := [i for i in study_ids if i not in titles]:
+        sql = """
+            select s.study_id, s.nct_id, s.brief_title, s.official_title
+            from   study s
+            where  s.study_id = any(%s)
+        """
+
+        with get_cur(read_only=True, shared=shared) as cur:
+            cur.execute(sql, (missing, ))
+            for rec in cur.fetchall():
+                titles[rec['study_id']] = (rec['nct_id'],
+                                           rec['brief_title'] or '',
+                                           rec['official_title'] or '')
+
+    return titles
 
 
 # --------------------------------------------------
@@ -237,51 +769,58 @@ def view_cart(study_ids: str) -> List[StudyCart]:
 def download(study_ids: str, fields: Optional[str] = '') -> StreamingResponse:
     """ Download """
 
-    ids = list(filter(str.isdigit, re.split('\s*,\s*', study_ids)))
+    ids = list(filter(str.isdigit, re.split(r'\s*,\s*', study_ids)))
     if not ids:
         return []
 
-    default_fields = [
-        'nct_id', 'official_title', 'brief_title', 'brief_summary',
-        'detailed_description', 'keywords', 'enrollment', 'start_date',
-        'completion_date', 'last_known_status', 'overall_status', 'conditions',
-        'interventions', 'outcomes', 'sponsors', 'study_docs'
-    ]
+    stream = io.StringIO()
+    write_csv(stream, ids, fields.split(',') if fields else DOWNLOAD_FIELDS)
 
-    sql = """
-        select s.study_id, s.nct_id, s.official_title,
-               s.brief_title, s.brief_summary,
-               s.detailed_description, s.keywords, s.enrollment, s.start_date,
-               s.completion_date, st1.status_name as last_known_status,
-               st2.status_name as overall_status
-        from   study s, status as st1, status as st2
-        where  s.study_id in ({})
-        and    s.last_known_status_id=st1.status_id
-        and    s.overall_status_id=st2.status_id
-    """.format(', '.join(ids))
-    # print(sql)
-
-    res = []
-    try:
-        cur = get_cur()
-        cur.execute(sql)
-        res = cur.fetchall()
-        cur.close()
-    except:
-        dbh.rollback()
-    finally:
-        cur.close()
+    response = StreamingResponse(iter([stream.getvalue()]),
+                                 media_type="text/csv")
+    response.headers[
+        "Content-Disposition"] = "attachment; filename=download.csv"
+    return response
+
+
+# --------------------------------------------------
+def write_csv(fh: TextIO,
+              ids: List[str],
+              flds: List[str],
+              progress: Optional[Callable[[int], None]] = None) -> int:
+    """ Write studies as CSV in batches, returning the number written """
 
     def clean(s):
         if isinstance(s, str):
-            return re.sub('\s+', ' ', s)
-
-    stream = io.StringIO()
-    if res:
-        flds = fields.split(',') if fields else default_fields
-        writer = csv.DictWriter(stream, fieldnames=flds, delimiter=',')
-        writer.writeheader()
-        for row in map(dict, res):
+            return re.sub(r'\s+', ' ', s)
+
+    writer = None
+    num_written = 0
+    for start in range(0, len(ids), DOWNLOAD_BATCH):
+        sql = """
+            select s.study_id, s.nct_id, s.official_title,
+                   s.brief_title, s.brief_summary,
+                   s.detailed_description, s.keywords, s.enrollment,
+                   s.start_date, s.completion_date,
+                   s.last_known_status_id, s.overall_status_id
+            from   study s
+            where  s.study_id in ({})
+        """.format(', '.join(ids[start:start + DOWNLOAD_BATCH]))
+
+        dims = get_dims()
+        with get_cur(read_only=True) as cur:
+            cur.execute(sql)
+            res = list(map(dict, cur.fetchall()))
+            for row in res:
+                for fld in ['last_known_status', 'overall_status']:
+                    row[fld] = lookup_name(cur, dims, 'status',
+                                           row[f'{fld}_id'])
+
+        if res and writer is None:
+            writer = csv.DictWriter(fh, fieldnames=flds, delimiter=',')
+            writer.writeheader()
+
+        for row in res:
             if 'conditions' in flds:
                 row['conditions'] = ';'.join(
                     get_study_conditions(row['study_id']))
@@ -300,62 +839,144 @@ def download(study_ids: str, fields: Optional[str] = '') -> StreamingResponse:
                 row['study_docs'] = ';'.join(get_study_docs(row['study_id']))
 
             writer.writerow({f: clean(row[f]) for f in flds})
+            num_written += 1
 
-    response = StreamingResponse(iter([stream.getvalue()]),
-                                 media_type="text/csv")
-    response.headers[
-        "Content-Disposition"] = "attachment; filename=download.csv"
-    return response
+        if progress:
+            progress(min(start + DOWNLOAD_BATCH, len(ids)))
+
+    return num_written
 
 
 # --------------------------------------------------
-def get_study_conditions(study_id: int) -> List[str]:
-    """ Get conditions for study """
+@app.post('/exports', response_model=ExportJob)
+def create_export(req: ExportRequest) -> ExportJob:
+    """ Start a CSV export in the background, or reuse an identical one """
 
-    sql = """
-        select c.condition_name
-        from   condition c, study_to_condition s2c
-        where  s2c.study_id=%s
-        and    s2c.condition_id=c.condition_id
-    """
+    ids = sorted(set(filter(str.isdigit, re.split(r'\s*,\s*',
+                                                  req.study_ids))),
+                 key=int)
+    if not ids:
+        raise HTTPException(status_code=400, detail='No study ids')
 
-    res = []
-    try:
-        cur = get_cur()
-        cur.execute(sql, (study_id, ))
-        res = cur.fetchall()
-        cur.close()
-    except:
-        dbh.rollback()
-    finally:
-        cur.close()
+    flds = list(filter(None, req.fields.split(','))) or DOWNLOAD_FIELDS
+    if bad := [fld for fld in flds if fld not in DOWNLOAD_FIELDS]:
+        raise HTTPException(status_code=400,
+                            detail='Bad field(s): {}'.format(', '.join(bad)))
+
+    content = json.dumps([get_dims().dataload, ids, flds])
+    key = hashlib.sha256(content.encode()).hexdigest()[:32]
+
+    def build(fh: TextIO, progress: Callable[[int], None]) -> int:
+        return write_csv(fh, ids, flds, progress)
+
+    return ExportJob(**exports.submit(key, len(ids), build))
+
+
+# --------------------------------------------------
+@app.get('/exports/{export_id}', response_model=ExportJob)
+def export_status(export_id: str) -> ExportJob:
+    """ Export status and progress """
 
-    return list(map(lambda r: r['condition_name'], res))
+    if not re.fullmatch(r'[0-9a-f]{32}', export_id) or not (
+            state := exports.status(export_id)):
+        raise HTTPException(status_code=404, detail='No such export')
+
+    return ExportJob(**state)
+
+
+# --------------------------------------------------
+@app.get('/exports/{export_id}/file')
+def export_file(export_id: str,
+                byte_range: Optional[str] = Header(None, alias='range')):
+    """ Export file, resumable with a Range header """
+
+    state = exports.status(export_id) if re.fullmatch(r'[0-9a-f]{32}',
+                                                      export_id) else None
+    if not state:
+        raise HTTPException(status_code=404, detail='No such export')
+
+    if state['status'] != 'done':
+        raise HTTPException(status_code=409,
+                            detail=f'Export is {state["status"]}')
+
+    path = exports.path(export_id)
+    size = os.path.getsize(path)
+    start, end = 0, size - 1
+    if byte_range:
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', byte_range.strip())
+        if not match or match.groups() == ('', ''):
+            raise HTTPException(status_code=416, detail='Bad range')
+        first, last = match.groups()
+        if first:
+            start, end = int(first), min(int(last), end) if last else end
+        else:
+            start = max(size - int(last), 0)
+        if start > end:
+            raise HTTPException(status_code=416,
+                                detail='Range not satisfiable',
+                                headers={'Content-Range': f'bytes */{size}'})
+
+    def chunks():
+        with open(path, 'rb') as fh:
+            fh.seek(start)
+            remaining = end - start + 1
+            while remaining > 0 and (chunk := fh.read(
+                    min(EXPORT_CHUNK, remaining))):
+                remaining -= len(chunk)
+                yield chunk
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Length': str(end - start + 1),
+        'Content-Disposition': f'attachment; filename={export_id}.csv',
+    }
+    if byte_range:
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    return StreamingResponse(chunks(),
+                             status_code=206 if byte_range else 200,
+                             media_type='text/csv',
+                             headers=headers)
+
+
+# --------------------------------------------------
+def get_study_conditions(study_id: int) -> List[str]:
+    """ Get conditions for study """
+
+    return get_linked_names('condition', study_id)
 
 
 # --------------------------------------------------
 def get_study_interventions(study_id: int) -> List[str]:
     """ Get interventions for study """
 
-    sql = """
-        select i.intervention_name
-        from   intervention i, study_to_intervention s2i
-        where  s2i.study_id=%s
-        and    s2i.intervention_id=i.intervention_id
-    """
+    return get_linked_names('intervention', study_id)
 
-    res = []
-    try:
-        cur = get_cur()
-        cur.execute(sql, (study_id, ))
-        res = cur.fetchall()
-        cur.close()
-    except:
-        dbh.rollback()
-    finally:
-        cur.close()
 
-    return list(map(lambda r: r['intervention_name'], res))
+# --------------------------------------------------
+def get_linked_names(entity: str, study_id: int) -> List[str]:
+    """ Names linked to a study, resolved from the cache if it holds them """
+
+    link, table, key, name = LINKS[entity]
+    dims = get_dims()
+    with get_cur(read_only=True) as cur:
+        if dims.has(table):
+            cur.execute(f'select l.{key} from {link} l where l.study_id=%s',
+                        (study_id, ))
+            names = [dims.name(table, r[0]) for r in cur.fetchall()]
+
+            # Ids newer than the cached names are read with their names
+            if None not in names:
+                return names
+
+        cur.execute(
+            f"""
+            select x.{name}
+            from   {link} l, {table} x
+            where  l.study_id=%s
+            and    l.{key}=x.{key}
+            """, (study_id, ))
+        return list(filter(None, [r[0] for r in cur.fetchall()]))
 
 
 # --------------------------------------------------
@@ -368,16 +989,9 @@ def get_study_outcomes(study_id: int) -> List[str]:
         where  o.study_id=%s
     """
 
-    res = []
-    try:
-        cur = get_cur()
+    with get_cur(read_only=True) as cur:
         cur.execute(sql, (study_id, ))
         res = cur.fetchall()
-        cur.close()
-    except:
-        dbh.rollback()
-    finally:
-        cur.close()
 
     def f(rec):
         return '::'.join([
@@ -400,16 +1014,9 @@ def get_study_docs(study_id: int) -> List[str]:
         where  d.study_id=%s
     """
 
-    res = []
-    try:
-        cur = get_cur()
+    with get_cur(read_only=True) as cur:
         cur.execute(sql, (study_id, ))
         res = cur.fetchall()
-        cur.close()
-    except:
-        dbh.rollback()
-    finally:
-        cur.close()
 
     def f(rec):
         return '::'.join([
@@ -426,29 +1033,13 @@ def get_study_docs(study_id: int) -> List[str]:
 def get_study_sponsors(study_id: int) -> List[str]:
     """ Get sponsors for study """
 
-    sql = """
-        select p.sponsor_name
-        from   sponsor p, study_to_sponsor s2p
-        where  s2p.study_id=%s
-        and    s2p.sponsor_id=p.sponsor_id
-    """
-
-    res = []
-    try:
-        cur = get_cur()
-        cur.execute(sql, (study_id, ))
-        res = cur.fetchall()
-        cur.close()
-    except:
-        dbh.rollback()
-    finally:
-        cur.close()
-
-    return list(map(lambda r: r['sponsor_name'], res))
+    return get_linked_names('sponsor', study_id)
 
 
 # --------------------------------------------------
-@app.get('/search', response_model=SearchResults)
+@app.get('/search',
+         response_model=SearchResults,
+         response_model_exclude_unset=True)
 def search(text: Optional[str] = '',
            text_bool: Optional[int] = 0,
            condition_names: Optional[str] = '',
@@ -461,170 +1052,375 @@ def search(text: Optional[str] = '',
            overall_status_id: Optional[int] = 0,
            last_known_status_id: Optional[int] = 0,
            condition_ids: Optional[str] = '',
+           condition_ids_all: Optional[int] = 0,
            sponsor_ids: Optional[str] = '',
+           sponsor_ids_all: Optional[int] = 0,
            study_type_ids: Optional[str] = '',
            phase_ids: Optional[str] = '',
            last_update_posted: Optional[str] = '',
            study_first_posted: Optional[str] = '',
-           limit: Optional[int] = 0) -> List[StudySearchResult]:
-    """ Search """
+           age: Optional[str] = '',
+           min_age: Optional[str] = '',
+           max_age: Optional[str] = '',
+           gender: Optional[str] = '',
+           healthy_volunteers: Optional[int] = 0,
+           sort: Optional[str] = '',
+           fields: Optional[str] = '',
+           stream: Optional[int] = 0,
+           accept: Optional[str] = Header(None),
+           limit: Optional[int] = 0,
+           after: Optional[int] = 0) -> List[StudySearchResult]:
+    """
+    Search, a page at a time with limit and, after the first, the last
+    study_id of the page before; only the first page has the count
+    """
+
+    if sort not in ('', 'relevance'):
+        raise HTTPException(status_code=400, detail=f'Bad sort "{sort}"')
+
+    if after and sort == 'relevance':
+        raise HTTPException(status_code=400,
+                            detail='Relevance results come in one page')
+
+    if sort == 'relevance' and not text:
+        raise HTTPException(status_code=400,
+                            detail='Relevance needs text to rank on')
+
+    if limit and limit < 0:
+        raise HTTPException(status_code=400, detail=f'Bad limit "{limit}"')
+
+    extra = get_fields(fields, SEARCH_FIELDS)
+
+    # Decided once, as a new dataload can unload the index meanwhile
+    get_dims()
+    indexed = study_index is not None
+    base = ['study_id'] if indexed else [
+        'study_id', 'nct_id', 'official_title'
+    ]
+    flds = base + [f for f in extra if f not in base]
+
+    # The search table has no long text, so fields of it need the study
+    table = search_table()
+    if not set(flds) <= set(study_search.COLUMNS):
+        table = 'study'
+
+    tables, table_params, filters = search_filters(
+        text=text,
+        text_bool=text_bool,
+        condition_names=condition_names,
+        conditions_bool=conditions_bool,
+        sponsor_names=sponsor_names,
+        sponsors_bool=sponsors_bool,
+        intervention_names=intervention_names,
+        interventions_bool=interventions_bool,
+        enrollment=enrollment,
+        overall_status_id=overall_status_id,
+        last_known_status_id=last_known_status_id,
+        condition_ids=condition_ids,
+        condition_ids_all=condition_ids_all,
+        sponsor_ids=sponsor_ids,
+        sponsor_ids_all=sponsor_ids_all,
+        study_type_ids=study_type_ids,
+        phase_ids=phase_ids,
+        last_update_posted=last_update_posted,
+        study_first_posted=study_first_posted,
+        age=age,
+        min_age=min_age,
+        max_age=max_age,
+        gender=gender,
+        healthy_volunteers=healthy_volunteers,
+        table=table)
+
+    if not filters.predicates:
+        return SearchResults(count=0, records=[])
+
+    # Later pages start from a key, so they never read the pages before
+    if after:
+        filters &= Where('s.study_id > %s', after)
+
+    where, params = filters.compile()
+    params = table_params + params
+
+    count_sql = """
+        select count(s.study_id)
+        from   {}
+        where  {}
+    """.format(', '.join(tables), where)
+
+    rank, order = '', ''
+    if sort == 'relevance':
+        # Rank only the matching rows; order by/limit is a bounded top-k sort
+        rank = f", ts_rank_cd('{RANK_WEIGHTS}', s.fulltext, query, 1) as rank"
+        order = 'order by rank desc, s.study_id'
+        limit = limit or RELEVANCE_TOP_K
+    elif limit or after:
+        # Pages are in study_id order to follow on from the key
+        order = 'order by s.study_id'
+
+    select_sql = """
+        select {}{}
+        from   {}
+        where  {}
+        {}
+        limit {}
+    """.format(', '.join(map(lambda f: f's.{f}', flds)), rank,
+               ', '.join(tables), where, order, limit or 'ALL')
+
+    if stream or 'application/x-ndjson' in (accept or ''):
+        return StreamingResponse(stream_search(select_sql, params, extra,
+                                               bool(rank), indexed),
+                                 media_type='application/x-ndjson')
+
+    def run():
+        count = {}
+        with get_cur(read_only=True, shared=True) as cur:
+            if not after:
+                cur.execute(count_sql, params)
+                count['count'] = (cur.fetchone() or [0])[0]
+
+            cur.execute(select_sql, params)
+            res = cur.fetchall()
+
+        # With the index loaded, titles come from it rather than the table
+        titles = study_titles([rec['study_id'] for rec in res],
+                              shared=True) if indexed else None
+
+        return SearchResults(**count,
+                             records=[
+                                 search_result(rec, extra, bool(rank), titles)
+                                 for rec in res
+                             ])
+
+    # Identical searches in flight at once share one query
+    return coalescer.do((select_sql, repr(params)), run,
+                        coalesce_label('/search', select_sql, params))
 
-    flds = ['study_id', 'nct_id', 'official_title']
-    where = []
+
+# --------------------------------------------------
+def search_filters(text: Optional[str] = '',
+                   text_bool: Optional[int] = 0,
+                   condition_names: Optional[str] = '',
+                   conditions_bool: Optional[int] = 0,
+                   sponsor_names: Optional[str] = '',
+                   sponsors_bool: Optional[int] = 0,
+                   intervention_names: Optional[str] = '',
+                   interventions_bool: Optional[int] = 0,
+                   enrollment: Optional[str] = '',
+                   overall_status_id: Optional[int] = 0,
+                   last_known_status_id: Optional[int] = 0,
+                   condition_ids: Optional[str] = '',
+                   condition_ids_all: Optional[int] = 0,
+                   sponsor_ids: Optional[str] = '',
+                   sponsor_ids_all: Optional[int] = 0,
+                   study_type_ids: Optional[str] = '',
+                   phase_ids: Optional[str] = '',
+                   last_update_posted: Optional[str] = '',
+                   study_first_posted: Optional[str] = '',
+                   age: Optional[str] = '',
+                   min_age: Optional[str] = '',
+                   max_age: Optional[str] = '',
+                   gender: Optional[str] = '',
+                   healthy_volunteers: Optional[int] = 0,
+                   table: str = 'study') -> Tuple[List[str], List, And]:
+    """ Tables with their parameters, and the filters for a search """
+
+    filters = And()
+    tables, table_params = [f'{table} s'], []
+    arrays = table == study_search.TABLE
 
     if text:
-        where.append({
-            'tables': [],
-            'where':
-            ['s.fulltext @@ {}'.format(tsquery(text, text_bool, 'english'))]
-        })
-
-    if phase_ids:
-        if ids := list(filter(str.isdigit, phase_ids.split(','))):
-            where.append({
-                'tables': [],
-                'where': ['s.phase_id in ({})'.format(','.join(ids))]
-            })
-
-    if study_type_ids:
-        if ids := list(filter(str.isdigit, study_type_ids.split(','))):
-            where.append({
-                'tables': [],
-                'where': ['s.study_type_id in ({})'.format(','.join(ids))]
-            })
+        query, param = tsquery(text, text_bool, 'english')
+        tables.append(f'{query} as query')
+        table_params.append(param)
+        filters &= Where('s.fulltext @@ query')
+
+    if ids := to_ids(phase_ids):
+        filters &= Where('s.phase_id = any(%s)', ids)
+
+    if ids := to_ids(study_type_ids):
+        filters &= Where('s.study_type_id = any(%s)', ids)
 
     if match := re.match(r'(=|==|<|<=|>|>=)?\s*(\d+)', enrollment):
-        op = match.group(1) or '>='
-        num = match.group(2)
-        where.append({'tables': [], 'where': [f's.enrollment {op} {num}']})
+        op = {'==': '='}.get(match.group(1), match.group(1) or '>=')
+        filters &= Where(f's.enrollment {op} %s', int(match.group(2)))
 
     if overall_status_id > 0:
-        where.append({
-            'tables': [],
-            'where': ['s.overall_status_id = {}'.format(overall_status_id)]
-        })
+        filters &= Where('s.overall_status_id = %s', overall_status_id)
 
     if last_known_status_id > 0:
-        where.append({
-            'tables': [],
-            'where':
-            ['s.last_known_status_id = {}'.format(last_known_status_id)]
-        })
+        filters &= Where('s.last_known_status_id = %s', last_known_status_id)
 
     if dt := parse_date(study_first_posted):
-        where.append({
-            'tables': [],
-            'where':
-            ["s.study_first_posted >= '{}'".format(dt)]
-        })
+        filters &= Where('s.study_first_posted >= %s', dt)
 
     if dt := parse_date(last_update_posted):
-        where.append({
-            'tables': [],
-            'where':
-            ["s.last_update_posted >= '{}'".format(dt)]
-        })
+        filters &= Where('s.last_update_posted >= %s', dt)
 
     if condition_names:
-        names = 'c.condition_name @@ {}'.format(
-            tsquery(condition_names, conditions_bool))
-
-        where.append({
-            'tables': ['study_to_condition s2c', 'condition c'],
-            'where': [
-                's.study_id=s2c.study_id', 's2c.condition_id=c.condition_id',
-                names
-            ]
-        })
+        filters &= LinkedNames('condition',
+                               *tsquery(condition_names, conditions_bool,
+                                        'english'),
+                               arrays=arrays)
 
     if sponsor_names:
-        names = 'sp.sponsor_name @@ {}'.format(
-            tsquery(sponsor_names, sponsors_bool))
-        where.append({
-            'tables': ['study_to_sponsor s2p', 'sponsor sp'],
-            'where':
-            ['s.study_id=s2p.study_id', 's2p.sponsor_id=sp.sponsor_id', names]
-        })
+        filters &= LinkedNames('sponsor',
+                               *tsquery(sponsor_names, sponsors_bool,
+                                        'english'),
+                               arrays=arrays)
 
     if intervention_names:
-        names = 'i.intervention_name @@ {}'.format(
-            tsquery(intervention_names, interventions_bool))
-        where.append({
-            'tables': ['study_to_intervention s2i', 'intervention i'],
-            'where': [
-                's.study_id=s2i.study_id',
-                's2i.intervention_id=i.intervention_id', names
-            ]
-        })
-
-    if condition_ids:
-        where.append({
-            'tables': ['study_to_condition s2c'],
-            'where': [
-                's.study_id=s2c.study_id',
-                's2c.condition_id in ({})'.format(condition_ids)
-            ]
-        })
-
-    if sponsor_ids:
-        where.append({
-            'tables': ['study_to_sponsor s2p'],
-            'where': [
-                's.study_id=s2p.study_id',
-                's2p.sponsor_id in ({})'.format(sponsor_ids)
-            ]
-        })
-
-    if not where:
-        return SearchResults(count=0, records=[])
+        filters &= LinkedNames('intervention',
+                               *tsquery(intervention_names,
+                                        interventions_bool, 'english'),
+                               arrays=arrays)
 
-    table_names = ['study s'] + list(
-        chain.from_iterable(map(lambda x: x['tables'], where)))
-    where = '\nand '.join(chain.from_iterable(map(lambda x: x['where'],
-                                                  where)))
+    if ids := to_ids(condition_ids):
+        filters &= LinkedIds('condition', ids, bool(condition_ids_all),
+                             arrays)
 
-    count_sql = """
-        select count(s.study_id)
-        from   {}
-        where  {}
-    """.format(', '.join(table_names), where)
+    if ids := to_ids(sponsor_ids):
+        filters &= LinkedIds('sponsor', ids, bool(sponsor_ids_all), arrays)
 
-    select_sql = """
-        select s.study_id, s.nct_id, s.official_title
-        from   {}
-        where  {}
-        limit {}
-    """.format(', '.join(table_names), where, limit or 'ALL')
+    # Eligibility: the age is within the ages taken, or the ages taken
+    # overlap min_age to max_age; "N/A" ages are open-ended
+    eligible = And()
+    if age:
+        parse_age(age)
+        eligible &= Where('e.age_days @> age_in_days(%s)', age)
 
-    res = []
-    count = 0
-    try:
-        cur = get_cur()
-        cur.execute(count_sql)
-        if counts := cur.fetchone():
-            count = counts[0]
+    if min_age or max_age:
+        if min_age and max_age and parse_age(min_age) > parse_age(max_age):
+            raise HTTPException(status_code=400,
+                                detail='min_age is over max_age')
 
-        cur.execute(select_sql)
-        res = cur.fetchall()
-        cur.close()
-    except:
-        dbh.rollback()
+        for each in filter(None, [min_age, max_age]):
+            parse_age(each)
 
-    def f(rec):
-        return StudySearchResult(study_id=rec['study_id'],
-                                 nct_id=rec['nct_id'],
-                                 title=rec['official_title'] or 'NA')
+        eligible &= Where(
+            "e.age_days && int4range(age_in_days(%s), age_in_days(%s), '[]')",
+            min_age or None, max_age or None)
+
+    if gender:
+        if gender.lower() not in GENDERS:
+            raise HTTPException(status_code=400,
+                                detail='gender must be one of ' +
+                                ', '.join(GENDERS))
+
+        # Any gender is no filter; one gender finds the studies open to it
+        if gender.lower() != 'all':
+            eligible &= Where('e.eligible_gender in (%s, %s)', 'all',
+                              gender.lower())
+
+    if healthy_volunteers:
+        eligible &= Where('e.accepts_healthy_volunteers')
+
+    if eligible.predicates:
+        filters &= Eligible(eligible)
+
+    return tables, table_params, filters
+
+
+# --------------------------------------------------
+def stream_search(sql: str, params: List, extra: List[str], ranked: bool,
+                  indexed: bool) -> Iterator[str]:
+    """ One JSON line per study, read through a server-side cursor """
+
+    with get_cur(read_only=True, name='stream_search') as cur:
+        cur.itersize = STREAM_BATCH
+        cur.execute(sql, params)
+        while batch := cur.fetchmany(STREAM_BATCH):
+            titles = study_titles([rec['study_id'] for rec in batch
+                                   ]) if indexed else None
+            yield ''.join(
+                json.dumps(
+                    jsonable_encoder(search_result(rec, extra, ranked, titles),
+                                     exclude_unset=True)) + '\n'
+                for rec in batch)
+
+
+# --------------------------------------------------
+def search_result(
+        rec, extra: List[str], ranked: bool,
+        titles: Optional[Dict[int, Tuple[str, str,
+                                         str]]]) -> StudySearchResult:
+    """ Make a search result from a row, with titles unless in the row """
+
+    nct_id, _, title = titles.get(rec['study_id'], (
+        '', '', '')) if titles is not None else (rec['nct_id'], '',
+                                                 rec['official_title'])
+
+    projected = {
+        fld: str(rec[fld])
+        if fld.endswith(('_date', '_posted')) and rec[fld] is not None else
+        rec[fld]
+        for fld in extra
+    }
+    if ranked:
+        projected['rank'] = rec['rank']
+
+    return StudySearchResult(study_id=rec['study_id'],
+                             nct_id=nct_id,
+                             title=title or 'NA',
+                             **projected)
+
+
+# --------------------------------------------------
+def coalesce_label(endpoint: str, sql: str, params: List) -> str:
+    """ Readable key for the coalescing metrics """
+
+    where = sql.split('where', 1)[-1]
+    return '{} {!r} {}'.format(endpoint, params,
+                               ' '.join(where.split()))[:COALESCE_LABEL_LEN]
+
+
+# --------------------------------------------------
+@app.get('/coalescing', response_model=Dict[str, Dict[str, int]])
+def coalescing() -> Dict[str, Dict[str, int]]:
+    """ Request coalescing metrics per query """
+
+    return coalescer.metrics()
+
+
+# --------------------------------------------------
+def get_fields(fields: str, allowed: List[str]) -> List[str]:
+    """ Split requested fields, checking against those allowed """
+
+    flds = list(filter(None, re.split(r'\s*,\s*', fields.strip())))
+    if bad := [fld for fld in flds if fld not in allowed]:
+        raise HTTPException(status_code=400,
+                            detail='Bad field(s): {}'.format(', '.join(bad)))
+
+    return flds
+
+
+# --------------------------------------------------
+def tsquery(query: str,
+            bool_search: int,
+            language: str = '') -> Tuple[str, str]:
+    """ Make into query, returning the SQL and its parameter """
+
+    return "{}to_tsquery({}%s)".format(
+        '' if bool_search else 'plain', f"'{language}', " if language else
+        ''), make_bool(query) if bool_search else query
+
+
+# --------------------------------------------------
+def prefix_tsquery(query: str, language: str = '') -> Tuple[str, str]:
+    """ Make into query matching the last word as a prefix """
 
-    return SearchResults(count=count, records=list(map(f, res)))
+    if not (words := re.findall(r'\w+', query)):
+        return tsquery(query, 0, language)
+
+    return "to_tsquery({}%s)".format(
+        f"'{language}', " if language else ''), ' & '.join(words[:-1] +
+                                                          [words[-1] + ':*'])
 
 
 # --------------------------------------------------
-def tsquery(query: str, bool_search: int, language: str = '') -> str:
-    """ Make into query """
+def to_ids(ids: str) -> List[int]:
+    """ Comma-separated ids to ints, dropping anything else """
 
-    return "{}to_tsquery({}'{}')".format(
-        '' if bool_search else 'plain', f"'{language}', " if language else '',
-        make_bool(query) if bool_search else query)
+    return list(map(int, filter(str.isdigit, re.split(r'\s*,\s*', ids))))
 
 
 # --------------------------------------------------
@@ -632,27 +1428,40 @@ def make_bool(s: str) -> str:
     """ Turn and or to & | """
 
     s = re.sub('[*]', '', s)
-    s = re.sub('\s+and\s+', ' & ', s, re.I)
-    s = re.sub('\s+or\s+', ' | ', s, re.I)
-    s = re.sub('\s+not\s+', ' ! ', s, re.I)
+    s = re.sub(r'\s+and\s+', ' & ', s, flags=re.I)
+    s = re.sub(r'\s+or\s+', ' | ', s, flags=re.I)
+    s = re.sub(r'\s+not\s+', ' ! ', s, flags=re.I)
     return s
 
 
+# --------------------------------------------------
+@app.get('/suggest', response_model=List[Suggestion])
+def suggest(prefix: str, k: Optional[int] = 10) -> List[Suggestion]:
+    """
+    Completions of the last word typed into the search box from the
+    words of the studies' fulltext, most studies first
+    """
+
+    words = re.findall(r'\w+', prefix)
+    if not lexicon or not words or len(words[-1]) < SUGGEST_MIN_PREFIX:
+        return []
+
+    return [
+        Suggestion(lexeme=lexeme, num_studies=num)
+        for lexeme, num in lexicon.complete(words[-1],
+                                            max(1, min(k, SUGGEST_MAX)))
+    ]
+
+
 # --------------------------------------------------
 @app.get('/summary', response_model=Summary)
 # @lru_cache()
 def summary():
     """ DB summary stats """
 
-    cur = get_cur()
-    res = []
-    try:
+    with get_cur(read_only=True) as cur:
         cur.execute('select count(study_id) as num_studies from study')
         res = cur.fetchone()
-    except:
-        dbh.rollback()
-    finally:
-        cur.close()
 
     if res:
         return Summary(num_studies=res['num_studies'])
@@ -661,113 +1470,228 @@ def summary():
 
 
 # --------------------------------------------------
-@app.get('/study/{nct_id}', response_model=Optional[StudyDetail])
-def study(nct_id: str) -> StudyDetail:
+@app.get('/stats', response_model=StatsResults)
+def study_stats(group_by: str,
+                condition_ids: Optional[str] = '',
+                condition_ids_all: Optional[int] = 0,
+                sponsor_ids: Optional[str] = '',
+                sponsor_ids_all: Optional[int] = 0,
+                sort: Optional[str] = '',
+                limit: Optional[int] = 0) -> StatsResults:
+    """
+    Count studies grouped by dimensions and at most one of condition or
+    sponsor, e.g., "phase,start_year"; sort "count" puts the largest first
+    """
+
+    groups = get_fields(group_by, list(stats.DIMENSIONS) + list(
+        stats.ENTITIES))
+    if not groups or len(groups) > STATS_MAX_GROUP_BY:
+        raise HTTPException(status_code=400,
+                            detail='Group by 1 to '
+                            f'{STATS_MAX_GROUP_BY} dimensions')
+
+    if len(set(groups)) < len(groups) or len(
+            set(groups) & set(stats.ENTITIES)) > 1:
+        raise HTTPException(status_code=400,
+                            detail='Group by each dimension once and by '
+                            'at most one of ' + ', '.join(stats.ENTITIES))
+
+    if sort not in ('', 'count'):
+        raise HTTPException(status_code=400, detail=f'Bad sort "{sort}"')
+
+    # Checking the dataload unloads a cube from an older one
+    dims = get_dims()
+    counts = cube
+    if not counts:
+        raise HTTPException(status_code=503,
+                            detail='Statistics are not available')
+
+    selected = None
+    for entity, ids, match_all in [
+        ('condition', to_ids(condition_ids), condition_ids_all),
+        ('sponsor', to_ids(sponsor_ids), sponsor_ids_all),
+    ]:
+        if ids:
+            selected = counts.studies(entity, ids, bool(match_all),
+                                      selected)
+
+    total = len(counts) if selected is None else int(selected.sum())
+    found = counts.group(groups, selected, sort == 'count', max(0, limit))
+
+    names = {}
+    for i, group in enumerate(groups):
+        if group in stats.ENTITIES:
+            names[group] = entity_names(
+                group, [values[i] for values, _ in found], dims)
+
+    def name(group: str, value: int) -> Optional[str]:
+        if value < 0:
+            return None
+        if group in names:
+            return names[group].get(value)
+        if table := stats.DIMENSIONS[group][1]:
+            if (label := dims.name(table, value)) is None:
+                with get_cur(read_only=True) as cur:
+                    label = lookup_name(cur, dims, table, value) or None
+            return label
+        if group == 'enrollment':
+            return stats.enrollment_label(value)
+        return str(value)
+
+    return StatsResults(
+        group_by=groups,
+        total=total,
+        groups=[
+            StatsGroup(values=[None if v < 0 else v for v in values],
+                       names=[name(g, v) for g, v in zip(groups, values)],
+                       count=count) for values, count in found
+        ])
+
+
+# --------------------------------------------------
+def entity_names(entity: str, ids: List[int],
+                 dims: Dimensions) -> Dict[int, str]:
+    """ Names of conditions or sponsors, from the cache if it has them """
+
+    names = {}
+    if dims.has(entity):
+        names = {key: dims.name(entity, key) for key in ids}
+
+    if missing := [key for key in ids if names.get(key) is None]:
+        _, table, key, name = LINKS[entity]
+        with get_cur(read_only=True) as cur:
+            cur.execute(
+                f'select {key}, {name} from {table} where {key} = any(%s)',
+                (missing, ))
+            names.update(map(tuple, cur.fetchall()))
+
+    return names
+
+
+# --------------------------------------------------
+@app.get('/study/{nct_id}',
+         response_model=Optional[StudyDetail],
+         response_model_exclude_unset=True)
+def study(nct_id: str, fields: Optional[str] = '') -> StudyDetail:
     """ Study details """
 
-    if studies := ct.Study.select().where(ct.Study.nct_id == nct_id):
-        study = studies[0]
-
-        sponsors = [
-            StudySponsor(sponsor_id=s.sponsor_id,
-                         sponsor_name=s.sponsor.sponsor_name)
-            for s in ct.StudyToSponsor.select().where(
-                ct.StudyToSponsor.study_id == study.study_id)
-        ]
-
-        conditions = [
-            StudyCondition(condition_id=c.condition_id,
-                           condition_name=c.condition.condition_name)
-            for c in ct.StudyToCondition.select().where(
-                ct.StudyToCondition.study_id == study.study_id)
-        ]
-
-        interventions = [
-            StudyIntervention(
-                intervention_id=c.intervention_id,
-                intervention_name=c.intervention.intervention_name)
-            for c in ct.StudyToIntervention.select().where(
-                ct.StudyToIntervention.study_id == study.study_id)
-        ]
-
-        study_docs = [
-            StudyDoc(study_doc_id=doc.study_doc_id,
-                     doc_id=doc.doc_id,
-                     doc_type=doc.doc_type,
-                     doc_url=doc.doc_url,
-                     doc_comment=doc.doc_comment)
-            for doc in ct.StudyDoc.select().where(
-                ct.StudyDoc.study_id == study.study_id)
-        ]
-
-        study_outcomes = [
-            StudyOutcome(study_outcome_id=o.study_outcome_id,
-                         outcome_type=o.outcome_type,
-                         measure=o.measure,
-                         time_frame=o.time_frame,
-                         description=o.description)
-            for o in ct.StudyOutcome.select().where(
-                ct.StudyOutcome.study_id == study.study_id)
-        ]
-
-        return StudyDetail(
-            study_id=study.study_id,
-            study_type_id=study.study_type_id,
-            study_type=study.study_type.study_type_name,
-            phase_id=study.phase_id,
-            phase=study.phase.phase_name,
-            overall_status_id=study.overall_status_id,
-            overall_status=study.overall_status.status_name,
-            last_known_status_id=study.last_known_status_id,
-            last_known_status=study.last_known_status.status_name,
-            nct_id=study.nct_id,
-            official_title=study.official_title or '',
-            brief_title=study.brief_title or '',
-            detailed_description=study.detailed_description or '',
-            org_study_id=study.org_study_id or '',
-            acronym=study.acronym or '',
-            source=study.source or '',
-            rank=study.rank or '',
-            brief_summary=study.brief_summary or '',
-            why_stopped=study.why_stopped or '',
-            has_expanded_access=study.has_expanded_access or '',
-            target_duration=study.target_duration or '',
-            biospec_retention=study.biospec_retention or '',
-            biospec_description=study.biospec_description or '',
-            keywords=study.keywords or '',
-            start_date=str(study.start_date) or '',
-            completion_date=str(study.completion_date) or '',
-            enrollment=study.enrollment,
-            sponsors=sponsors,
-            conditions=conditions,
-            interventions=interventions,
-            study_outcomes=study_outcomes,
-            study_docs=study_docs)
+    all_fields = STUDY_COLUMNS + list(STUDY_LOOKUPS) + list(STUDY_CHILDREN)
+    flds = get_fields(fields, all_fields) or all_fields
+
+    lookups = [STUDY_LOOKUPS[f][0] for f in flds if f in STUDY_LOOKUPS]
+    columns = ['s.study_id', 's.nct_id'] + [
+        f's.{col}' for col in STUDY_COLUMNS if col in flds or col in lookups
+    ]
+
+    sql = """
+        select {}
+        from   study s
+        where  s.nct_id=%s
+    """.format(', '.join(columns))
+
+    children = {
+        'sponsors': StudySponsor,
+        'conditions': StudyCondition,
+        'interventions': StudyIntervention,
+        'study_outcomes': StudyOutcome,
+        'study_docs': StudyDoc,
+    }
+
+    dims = get_dims()
+    with get_cur(read_only=True) as cur:
+        cur.execute(sql, (nct_id, ))
+        if not (study := cur.fetchone()):
+            return None
+
+        detail = {
+            fld: val
+            for fld, val in dict(study).items()
+            if fld in flds or fld in ('study_id', 'nct_id')
+        }
+        for col in filter(lambda c: c in flds, STUDY_COLUMNS):
+            if col in ('start_date', 'completion_date'):
+                detail[col] = str(detail[col])
+            elif col not in STUDY_AS_IS:
+                detail[col] = detail[col] or ''
+
+        for fld, (col, table) in STUDY_LOOKUPS.items():
+            if fld in flds:
+                detail[fld] = lookup_name(cur, dims, table, study[col])
+
+        for fld, child_sql in STUDY_CHILDREN.items():
+            if fld not in flds:
+                continue
+
+            rows = None
+            entity = STUDY_LINKED.get(fld)
+            if entity and dims.has(entity):
+                # Only the ids are read; names come from the cache
+                link, table, key, name = LINKS[entity]
+                cur.execute(
+                    f'select l.{key} from {link} l where l.study_id=%s',
+                    (study['study_id'], ))
+                rows = [{
+                    key: rec[0],
+                    name: dims.name(table, rec[0])
+                } for rec in cur.fetchall()]
+                if any(row[name] is None for row in rows):
+                    rows = None
+
+            if rows is None:
+                cur.execute(child_sql, (study['study_id'], ))
+                rows = [dict(rec) for rec in cur.fetchall()]
+
+            detail[fld] = [children[fld](**row) for row in rows]
+
+    return StudyDetail(**detail)
+
+
+# --------------------------------------------------
+@app.get('/study/{nct_id}/related', response_model=List[RelatedStudy])
+def related_studies(nct_id: str,
+                    k: Optional[int] = 10) -> List[RelatedStudy]:
+    """ The studies most like one, by what they study and who sponsors them """
+
+    # Checking the dataload unloads neighbors from an older one
+    get_dims()
+    neighbors = related
+    if not neighbors:
+        raise HTTPException(status_code=503,
+                            detail='Related studies are not available')
+
+    index = study_index
+    if index and (rec := index.find(nct_id)):
+        study_id = rec.study_id
+    else:
+        with get_cur(read_only=True) as cur:
+            cur.execute('select study_id from study where nct_id=%s',
+                        (nct_id, ))
+            if not (rec := cur.fetchone()):
+                raise HTTPException(status_code=404,
+                                    detail=f'Unknown study "{nct_id}"')
+            study_id = rec['study_id']
+
+    found = neighbors.neighbors(study_id, max(1, min(k or 10, RELATED_MAX)))
+    titles = study_titles([study_id for study_id, _ in found])
+
+    return [
+        RelatedStudy(study_id=study_id,
+                     nct_id=titles[study_id][0],
+                     title=titles[study_id][2],
+                     similarity=round(similarity, 4))
+        for study_id, similarity in found if study_id in titles
+    ]
 
 
 # --------------------------------------------------
 @app.get('/study_types', response_model=List[StudyType])
-@lru_cache()
 def study_types() -> List[StudyType]:
     """ Study Types """
 
-    sql = f"""
-        select   t.study_type_id, t.study_type_name
-        from     study_type t
-        order by 2
-    """
-
-    cur = get_cur()
-    res = []
-    try:
-        cur.execute(sql)
-        res = cur.fetchall()
-    except:
-        dbh.rollback()
-    finally:
-        cur.close()
-
-    return list(map(lambda r: StudyType(**dict(r)), res))
+    return [
+        StudyType(study_type_id=i, study_type_name=name)
+        for i, name in get_dims().items('study_type')
+    ]
 
 
 # --------------------------------------------------
@@ -776,7 +1700,8 @@ def conditions(name: str,
                bool_search: Optional[int] = 0) -> List[ConditionDropDown]:
     """ Conditions/Num Studies """
 
-    clause = 'and c.condition_name @@ {}'.format(tsquery(name, bool_search))
+    names, param = tsquery(name, bool_search, 'english')
+    clause = f'and c.condition_fulltext @@ {names}'
 
     sql = f"""
         select   c.condition_id, c.condition_name,
@@ -789,18 +1714,15 @@ def conditions(name: str,
         order by 3 desc, 2
     """
 
-    res = []
-    try:
-        cur = get_cur()
-        cur.execute(sql)
-        res = cur.fetchall()
-    except Exception as e:
-        dbh.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
+    def run():
+        with get_cur(read_only=True, shared=True) as cur:
+            cur.execute(sql, (param, ))
+            res = cur.fetchall()
 
-    return list(map(lambda r: ConditionDropDown(**dict(r)), res))
+        return list(map(lambda r: ConditionDropDown(**dict(r)), res))
+
+    return coalescer.do((sql, param), run,
+                        coalesce_label('/conditions', sql, [param]))
 
 
 # --------------------------------------------------
@@ -808,7 +1730,8 @@ def conditions(name: str,
 def sponsors(name: str, bool_search: Optional[int] = 0) -> List[Sponsor]:
     """ Sponsors/Num Studies """
 
-    clause = 'and p.sponsor_name @@ {}'.format(tsquery(name, bool_search))
+    names, param = tsquery(name, bool_search, 'english')
+    clause = f'and p.sponsor_fulltext @@ {names}'
     sql = f"""
         select   p.sponsor_id, p.sponsor_name, count(s.study_id) as num_studies
         from     sponsor p, study_to_sponsor s2p, study s
@@ -819,42 +1742,82 @@ def sponsors(name: str, bool_search: Optional[int] = 0) -> List[Sponsor]:
         order by 3 desc, 2
     """
 
-    cur = get_cur()
-    res = []
-    try:
-        cur.execute(sql)
+    with get_cur(read_only=True) as cur:
+        cur.execute(sql, (param, ))
         res = cur.fetchall()
-    except Exception as e:
-        dbh.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
 
     return list(map(lambda r: Sponsor(**dict(r)), res))
 
 
 # --------------------------------------------------
-@app.get('/phases', response_model=List[Phase])
-def phases() -> List[Phase]:
-    """ Phases """
-
-    sql = """
-        select   p.phase_id, p.phase_name
-        from     phase p
-        order by 2
+@app.get('/locations', response_model=LocationResults)
+def locations(facility: Optional[str] = '',
+              investigator: Optional[str] = '',
+              status: Optional[str] = '',
+              limit: Optional[int] = LOCATIONS_PAGE,
+              offset: Optional[int] = 0) -> LocationResults:
+    """
+    Trial sites by facility and/or investigator name, the last word of
+    each matching as a prefix, and site status (e.g., "Recruiting")
     """
 
-    cur = get_cur()
-    res = []
-    try:
-        cur.execute(sql)
+    filters = And()
+    if facility:
+        query, param = prefix_tsquery(facility, 'simple')
+        filters &= Where(f'l.facility_fulltext @@ {query}', param)
+
+    if investigator:
+        query, param = prefix_tsquery(investigator, 'simple')
+        filters &= Where(f'l.investigator_fulltext @@ {query}', param)
+
+    if status:
+        filters &= Where('l.status = %s', status)
+
+    if not filters.predicates:
+        raise HTTPException(status_code=400,
+                            detail='Need facility, investigator or status')
+
+    where, params = filters.compile()
+    with get_cur(read_only=True) as cur:
+        cur.execute(
+            f"""
+            select count(*)
+            from   study_location l
+            where  {where}
+            """, params)
+        count = cur.fetchone()[0]
+
+        cur.execute(
+            f"""
+            select   l.study_location_id, l.study_id, l.facility_name,
+                     l.investigator_name, l.contact_name, l.status
+            from     study_location l
+            where    {where}
+            order by l.study_id, l.study_location_id
+            limit    %s
+            offset   %s
+            """, params + [max(1, min(limit, LOCATIONS_MAX)),
+                           max(offset, 0)])
         res = cur.fetchall()
-    except:
-        dbh.rollback()
-    finally:
-        cur.close()
 
-    return list(map(lambda r: Phase(**dict(r)), res))
+    titles = study_titles(list(set(rec['study_id'] for rec in res)))
+
+    def f(rec):
+        nct_id, _, title = titles.get(rec['study_id'], ('', '', ''))
+        return Location(nct_id=nct_id, title=title, **dict(rec))
+
+    return LocationResults(count=count, records=list(map(f, res)))
+
+
+# --------------------------------------------------
+@app.get('/phases', response_model=List[Phase])
+def phases() -> List[Phase]:
+    """ Phases """
+
+    return [
+        Phase(phase_id=i, phase_name=name)
+        for i, name in get_dims().items('phase')
+    ]
 
 
 # --------------------------------------------------
@@ -916,22 +1879,162 @@ def saved_searches(email: str) -> List[SavedSearch]:
         order by 2
     """
 
-    cur = get_cur()
-    res = []
-    try:
+    with get_cur() as cur:
         cur.execute(sql)
         res = cur.fetchall()
-    except:
-        dbh.rollback()
-    finally:
-        cur.close()
 
     return list(map(lambda r: SavedSearch(**dict(r)), res))
 
 
+# --------------------------------------------------
+@app.get('/saved_searches/{saved_search_id}/results',
+         response_model=SavedSearchResults)
+def saved_search_results(saved_search_id: int,
+                         since: Optional[str] = '',
+                         limit: Optional[int] = 0) -> SavedSearchResults:
+    """
+    Run a saved search, keeping its result ids per dataload so repeat
+    visits are a lookup; "since" a dataload gives only the new studies
+    """
+
+    if since and not (since := parse_date(since)):
+        raise HTTPException(status_code=400, detail='Bad "since" date')
+
+    with get_cur(read_only=True) as cur:
+        cur.execute(
+            """
+            select s.*
+            from   saved_search s
+            where  s.saved_search_id=%s
+            """, (saved_search_id, ))
+        saved = cur.fetchone()
+        if not saved:
+            raise HTTPException(status_code=404, detail='No such search')
+
+        if not (current := latest_dataload(cur)):
+            raise HTTPException(status_code=503, detail='No data loaded')
+
+        cur.execute(
+            """
+            select r.dataload, r.study_ids, r.nct_ids
+            from   saved_search_result r
+            where  r.saved_search_id=%s
+            and    r.dataload = any(%s::date[])
+            and    r.nct_ids is not null
+            """, (saved_search_id, [current] + ([since] if since else [])))
+        snapshots = {
+            str(r['dataload']): (r['study_ids'], r['nct_ids'])
+            for r in cur
+        }
+
+    if current not in snapshots:
+        # Concurrent first visits after a dataload share one run
+        snapshots[current] = coalescer.do(
+            ('saved_search', saved_search_id, current),
+            lambda: save_search_results(saved, current),
+            f'/saved_searches/{saved_search_id}/results')
+
+    study_ids = snapshots[current][0]
+    if since:
+        if since not in snapshots:
+            raise HTTPException(status_code=404,
+                                detail=f'No results kept as of {since}')
+        study_ids = new_since(*snapshots[current], snapshots[since][1])
+
+    shown = study_ids[:limit] if limit else study_ids
+    titles = study_titles(shown)
+    return SavedSearchResults(
+        saved_search_id=saved_search_id,
+        dataload=current,
+        since=since or None,
+        count=len(study_ids),
+        records=[
+            StudyCart(study_id=study_id,
+                      nct_id=titles.get(study_id, ('', '', ''))[0],
+                      title=titles.get(study_id, ('', '', ''))[2] or 'NA')
+            for study_id in shown
+        ])
+
+
+# --------------------------------------------------
+def save_search_results(saved,
+                        dataload: str) -> Tuple[List[int], List[str]]:
+    """ Run a saved search and keep its result ids for the dataload """
+
+    enrollment = saved['enrollment']
+    tables, table_params, filters = search_filters(
+        text=saved['full_text'],
+        text_bool=saved['full_text_bool'],
+        condition_names=saved['conditions'],
+        conditions_bool=saved['conditions_bool'],
+        sponsor_names=saved['sponsors'],
+        sponsors_bool=saved['sponsors_bool'],
+        intervention_names=saved['interventions'],
+        interventions_bool=saved['interventions_bool'],
+        enrollment=str(enrollment) if enrollment else '',
+        phase_ids=saved['phase_ids'],
+        study_type_ids=saved['study_type_ids'],
+        table=search_table())
+
+    study_ids, nct_ids = [], []
+    if filters.predicates:
+        where, params = filters.compile()
+        with get_cur(read_only=True, shared=True) as cur:
+            cur.execute(
+                """
+                select   s.study_id, s.nct_id
+                from     {}
+                where    {}
+                order by s.study_id
+                """.format(', '.join(tables), where), table_params + params)
+            for rec in cur:
+                study_ids.append(rec[0])
+                nct_ids.append(rec[1])
+
+    with get_cur(shared=True) as cur:
+        cur.execute(
+            """
+            insert into saved_search_result
+                   (saved_search_id, dataload, study_ids, nct_ids)
+            values (%s, %s, %s, %s)
+            on conflict (saved_search_id, dataload)
+            do update set study_ids=excluded.study_ids,
+                          nct_ids=excluded.nct_ids
+            """, (saved['saved_search_id'], dataload, study_ids, nct_ids))
+
+        cur.execute(
+            """
+            delete from saved_search_result
+            where  saved_search_id=%s
+            and    dataload not in (select   r.dataload
+                                    from     saved_search_result r
+                                    where    r.saved_search_id=%s
+                                    order by r.dataload desc
+                                    limit    %s)
+            """, (saved['saved_search_id'], saved['saved_search_id'],
+                  SAVED_RESULTS_KEEP))
+
+    return study_ids, nct_ids
+
+
+# --------------------------------------------------
+def new_since(study_ids: List[int], nct_ids: List[str],
+              old_nct_ids: List[str]) -> List[int]:
+    """
+    The studies of a result not in an older one, by NCT ID, as study_ids
+    are not kept from one dataload to the next
+    """
+
+    old = set(old_nct_ids)
+    return [
+        study_id for study_id, nct_id in zip(study_ids, nct_ids)
+        if nct_id not in old
+    ]
+
+
 # --------------------------------------------------
 @app.get('/dataload', response_model=Dataload)
-def phases() -> Dataload:
+def dataload() -> Dataload:
     """ Dataload """
 
     sql = """
@@ -941,11 +2044,10 @@ def phases() -> Dataload:
         limit 1
     """
 
-    cur = get_cur()
     num_studies = 0
     updated_on = 'NA'
 
-    try:
+    with get_cur(read_only=True) as cur:
         cur.execute(sql)
         res = cur.fetchone()
         if res:
@@ -956,18 +2058,33 @@ def phases() -> Dataload:
         if res:
             num_studies = res['num_studies']
 
-    except:
-        dbh.rollback()
-    finally:
-        cur.close()
-
     return Dataload(num_studies=num_studies, updated_on=updated_on)
 
+
+# --------------------------------------------------
+def parse_age(age: str) -> float:
+    """ Days in an age like "18" (years) or "6 months" """
+
+    if not (match := AGE_RE.match(age)):
+        raise HTTPException(status_code=400, detail=f'Bad age "{age}"')
+
+    days = float(match.group(1)) * AGE_UNITS[(match.group(2)
+                                              or 'year').lower()]
+    if days > MAX_AGE_YEARS * AGE_UNITS['year']:
+        raise HTTPException(
+            status_code=400,
+            detail=f'Age "{age}" is over {MAX_AGE_YEARS} years')
+
+    return days
+
+
 # --------------------------------------------------
 def parse_date(text: str) -> Optional[str]:
     """ Parse date """
 
     if text:
+        from dateutil.parser import parse
+
         try:
             dt = parse(text)
             return dt.strftime('%Y-%m-%d')
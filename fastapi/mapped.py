@@ -0,0 +1,107 @@
+"""
+Versioned files of arrays that the API workers map read-only
+
+A file is a header (magic, version, dataload and a count), a table of
+the offset and length of each section, then the sections, each aligned
+to 8 bytes. The study index, lexicon, related studies and stats cube
+are all such files, and subclass MappedFile with their own magic,
+version and sections.
+"""
+
+import mmap
+import os
+import struct
+from typing import Any, Dict, List, Tuple
+
+HEADER = struct.Struct('=4sH10sI')
+SECTION = struct.Struct('=QQ')
+
+
+class MappedFile:
+    """ Read-only view of a file, with a view of each section """
+
+    MAGIC = b''
+    VERSION = 0
+    KIND = 'file'
+
+    # Arrays in file order, with their typecodes; "B" is a raw blob
+    SECTIONS: List[Tuple[str, str]] = []
+
+    def __init__(self, filename: str):
+        with open(filename, 'rb') as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._views: Dict[str, Any] = {}
+        try:
+            magic, version, dataload, count = HEADER.unpack_from(self._mm)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError(f'"{filename}" is not a version '
+                                 f'{self.VERSION} {self.KIND}')
+
+            self.filename = filename
+            self.dataload = dataload.decode().rstrip('\0')
+            self.count = count
+
+            for i, (name, code) in enumerate(self.SECTIONS):
+                offset, length = SECTION.unpack_from(
+                    self._mm, HEADER.size + i * SECTION.size)
+                if offset + length > len(self._mm):
+                    raise ValueError(f'"{filename}" is truncated')
+                self._views[name] = self._view(offset, length, code)
+        except (ValueError, TypeError, struct.error) as e:
+            try:
+                self.close()
+            except BufferError:
+                pass  # Unmapped once the views made so far are gone
+            if isinstance(e, ValueError):
+                raise
+            raise ValueError(f'"{filename}" is truncated or corrupt: {e}')
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self) -> None:
+        """ Release the mapping """
+
+        # Other views (e.g., NumPy arrays) go when no longer referenced
+        views = [v for v in self._views.values() if isinstance(v, memoryview)]
+        self._views = {}
+        for view in views:
+            view.release()
+        self._mm.close()
+
+    def _view(self, offset: int, length: int, code: str) -> Any:
+        """ A section as a typed view of the mapping """
+
+        return memoryview(self._mm)[offset:offset + length].cast(code)
+
+    @classmethod
+    def write(cls, outfile: str, dataload: str, count: int,
+              arrays: Dict[str, Any]) -> int:
+        """
+        Write the arrays (anything exposing its bytes as a buffer) in the
+        order of SECTIONS, replacing any old file; workers holding the old
+        file keep their mapping until they reopen
+        """
+
+        tmp = f'{outfile}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(
+                HEADER.pack(cls.MAGIC, cls.VERSION, dataload.encode(), count))
+
+            offset = HEADER.size + len(cls.SECTIONS) * SECTION.size
+            blobs = []
+            for name, _ in cls.SECTIONS:
+                blob = memoryview(arrays[name]).cast('B')
+                offset += -offset % 8
+                fh.write(SECTION.pack(offset, len(blob)))
+                blobs.append((offset, blob))
+                offset += len(blob)
+
+            for offset, blob in blobs:
+                fh.write(b'\0' * (offset - fh.tell()))
+                fh.write(blob)
+
+        os.replace(tmp, outfile)
+
+        return count
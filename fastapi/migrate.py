@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""
+Versioned schema migrations for the indexes the API depends on
+
+Applied versions are recorded in "schema_migration", so running this
+again only applies what is new. Indexes are built concurrently, so a
+live database keeps serving while they build; a build that failed
+before leaves an invalid index, which is dropped and built again.
+
+Statements are not: adding the stored generated columns (versions 4
+to 6) rewrites each table holding an ACCESS EXCLUSIVE lock, blocking
+reads of it until done. The API queries those columns, so run this
+in a quiet window before deploying the code that needs a version.
+"""
+
+import argparse
+import psycopg2
+import statistics
+import time
+from db import CONFIG_FILE, make_dsn, read_config
+from typing import Dict, List, NamedTuple, Tuple
+
+
+class Args(NamedTuple):
+    """ Command-line arguments """
+    config: str
+    benchmark: bool
+    repeat: int
+    dry_run: bool
+
+
+class Index(NamedTuple):
+    """ An index to create """
+    table: str
+    columns: Tuple[str, ...]
+    unique: bool = False
+    using: str = 'btree'
+
+    @property
+    def name(self) -> str:
+        return '{}_{}_{}'.format(self.table, '_'.join(self.columns),
+                                 'key' if self.unique else 'idx')
+
+
+class Migration(NamedTuple):
+    """ A numbered set of statements and the indexes that follow them """
+    version: int
+    description: str
+    indexes: List[Index]
+    statements: Tuple[str, ...] = ()
+
+
+#
+# Tables whose names are searched through a stored vector, "<table>_fulltext"
+#
+NAMED = ['condition', 'sponsor', 'intervention']
+
+#
+# Names searched by /locations through "<prefix>_fulltext", unstemmed
+#
+LOCATION_NAMES = ['facility', 'investigator']
+
+#
+# Free-text eligibility ages ("18 Years", "6 Months", "N/A") in days
+#
+AGE_IN_DAYS = r"""
+    create or replace function age_in_days(age text) returns integer
+    language sql immutable strict as $$
+        select round(m[1]::numeric *
+                     case lower(coalesce(m[2], 'year'))
+                          when 'year' then 365.25
+                          when 'month' then 30.4375
+                          when 'week' then 7
+                          when 'day' then 1
+                          when 'hour' then 1 / 24.0
+                          else 1 / 1440.0
+                     end)::integer
+        from   regexp_match(age, '^\s*(\d+(?:\.\d+)?)\s*'
+                                 '(year|month|week|day|hour|minute)?s?\s*$',
+                            'i') as m
+    $$
+"""
+
+#
+# Result ids of each saved search as of each dataload; deltas compare the
+# NCT IDs, as a dataload gives every study a new study_id
+#
+SAVED_RESULTS_TABLE = """
+    create table if not exists saved_search_result (
+        saved_search_id integer not null
+            references saved_search (saved_search_id) on delete cascade,
+        dataload date not null,
+        study_ids integer[] not null,
+        primary key (saved_search_id, dataload)
+    )
+"""
+
+MIGRATIONS = [
+    Migration(1, 'Link tables in both directions', [
+        Index('study_to_condition', ('study_id', 'condition_id')),
+        Index('study_to_condition', ('condition_id', 'study_id')),
+        Index('study_to_sponsor', ('study_id', 'sponsor_id')),
+        Index('study_to_sponsor', ('sponsor_id', 'study_id')),
+        Index('study_to_intervention', ('study_id', 'intervention_id')),
+        Index('study_to_intervention', ('intervention_id', 'study_id')),
+    ]),
+    Migration(2, 'Study lookups, filters and dates', [
+        Index('study', ('nct_id', ), unique=True),
+        Index('study', ('overall_status_id', )),
+        Index('study', ('last_known_status_id', )),
+        Index('study', ('phase_id', )),
+        Index('study', ('study_type_id', )),
+        Index('study', ('enrollment', )),
+        Index('study', ('study_first_posted', )),
+        Index('study', ('last_update_posted', )),
+        Index('study', ('fulltext', ), using='gin'),
+    ]),
+    Migration(3, 'Study details by study', [
+        Index('study_outcome', ('study_id', )),
+        Index('study_doc', ('study_id', )),
+        Index('study_location', ('study_id', )),
+        Index('study_eligibility', ('study_id', )),
+        Index('study_arm_group', ('study_id', )),
+        Index('study_design', ('study_id', )),
+        Index('study_url', ('study_id', )),
+        Index('saved_search', ('web_user_id', )),
+    ]),
+    Migration(4,
+              'Stored name vectors for condition, sponsor and intervention',
+              [
+                  Index(table, (f'{table}_fulltext', ), using='gin')
+                  for table in NAMED
+              ],
+              statements=tuple(
+                  f'alter table {table} add column if not exists '
+                  f'{table}_fulltext tsvector generated always as '
+                  f"(to_tsvector('english', coalesce({table}_name, ''))) "
+                  'stored' for table in NAMED)),
+    Migration(5,
+              'Site names and status for /locations',
+              [
+                  Index('study_location', (f'{name}_fulltext', ),
+                        using='gin') for name in LOCATION_NAMES
+              ] + [Index('study_location', ('status', ))],
+              statements=tuple(
+                  'alter table study_location add column if not exists '
+                  f'{name}_fulltext tsvector generated always as '
+                  f"(to_tsvector('simple', coalesce({name}_name, ''))) "
+                  'stored' for name in LOCATION_NAMES)),
+    Migration(6,
+              'Eligibility ages in days, gender and healthy volunteers',
+              [
+                  Index('study_eligibility', ('age_days', ), using='gist'),
+                  Index('study_eligibility', ('eligible_gender', )),
+              ],
+              statements=(
+                  AGE_IN_DAYS,
+                  """
+                  alter table study_eligibility
+                  add column if not exists age_days int4range
+                  generated always as (
+                      case when age_in_days(minimum_age) >
+                                age_in_days(maximum_age) then null
+                           else int4range(age_in_days(minimum_age),
+                                          age_in_days(maximum_age), '[]')
+                      end) stored
+                  """,
+                  """
+                  alter table study_eligibility
+                  add column if not exists accepts_healthy_volunteers boolean
+                  generated always as (
+                      lower(trim(healthy_volunteers))
+                      in ('yes', 'accepts healthy volunteers')) stored
+                  """,
+                  """
+                  alter table study_eligibility
+                  add column if not exists eligible_gender text
+                  generated always as (
+                      case when lower(trim(gender))
+                                in ('all', 'female', 'male')
+                           then lower(trim(gender))
+                      end) stored
+                  """,
+              )),
+    Migration(7,
+              'Saved search results per dataload', [],
+              statements=(SAVED_RESULTS_TABLE, )),
+    Migration(8,
+              'Saved search results by NCT ID, which outlast a dataload', [],
+              statements=('alter table saved_search_result '
+                          'add column if not exists nct_ids text[]', )),
+]
+
+#
+# Queries behind the endpoints, timed before and after migrating
+#
+BENCHMARKS = [
+    ('/study by nct_id', 'select * from study where nct_id=%(nct_id)s'),
+    ('/study conditions', """
+        select c.condition_name
+        from   study_to_condition sc, condition c
+        where  sc.study_id=%(study_id)s
+        and    sc.condition_id=c.condition_id
+     """),
+    ('/study outcomes',
+     'select * from study_outcome where study_id=%(study_id)s'),
+    ('/study docs', 'select * from study_doc where study_id=%(study_id)s'),
+    ('/search condition_ids', """
+        select count(*)
+        from   study s
+        where  exists (select 1 from study_to_condition l
+                       where l.study_id=s.study_id
+                       and l.condition_id = any(%(condition_ids)s))
+     """),
+    ('/search phase and status', """
+        select count(*)
+        from   study s
+        where  s.phase_id=%(phase_id)s
+        and    s.overall_status_id=%(status_id)s
+     """),
+    ('/search last_update_posted', """
+        select count(*)
+        from   study s
+        where  s.last_update_posted >= %(posted)s
+     """),
+    ('/conditions counts', """
+        select count(*)
+        from   study_to_condition sc
+        where  sc.condition_id = any(%(condition_ids)s)
+     """),
+]
+
+
+# --------------------------------------------------
+def get_args() -> Args:
+    """ Get command-line arguments """
+
+    parser = argparse.ArgumentParser(
+        description='Apply schema migrations',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-c',
+                        '--config',
+                        help='Configuration file',
+                        metavar='FILE',
+                        default=CONFIG_FILE)
+
+    parser.add_argument('-b',
+                        '--benchmark',
+                        help='Time the endpoint queries before and after',
+                        action='store_true')
+
+    parser.add_argument('-r',
+                        '--repeat',
+                        help='Benchmark runs per query',
+                        metavar='INT',
+                        type=int,
+                        default=5)
+
+    parser.add_argument('-n',
+                        '--dry_run',
+                        help='Only show the pending migrations',
+                        action='store_true')
+
+    args = parser.parse_args()
+    return Args(args.config, args.benchmark, args.repeat, args.dry_run)
+
+
+# --------------------------------------------------
+def main() -> None:
+    """ Make a jazz noise here """
+
+    args = get_args()
+    config = read_config(args.config)
+    dbh = psycopg2.connect(make_dsn(config))
+
+    # Concurrent index builds cannot run inside a transaction
+    dbh.autocommit = True
+
+    applied = applied_versions(dbh)
+    pending = [m for m in MIGRATIONS if m.version not in applied]
+    for migration in pending:
+        print(f'{migration.version}: {migration.description}')
+        if args.dry_run:
+            for sql in migration.statements:
+                print(f'  {sql}')
+            for index in migration.indexes:
+                print(f'  {index_sql(index)}')
+
+    if not pending or args.dry_run:
+        print(f'{len(pending)} pending migration(s).')
+        dbh.close()
+        return
+
+    before = benchmark(dbh, args.repeat) if args.benchmark else {}
+
+    for migration in pending:
+        migrate(dbh, migration)
+
+    if args.benchmark:
+        after = benchmark(dbh, args.repeat)
+        print(f'\n{"query":30} {"before ms":>10} {"after ms":>10}')
+        for name, _ in BENCHMARKS:
+            print(f'{name:30} {before[name]:10.2f} {after[name]:10.2f}')
+
+    dbh.close()
+    print(f'Applied {len(pending)} migration(s).')
+
+
+# --------------------------------------------------
+def applied_versions(dbh) -> List[int]:
+    """ Versions already applied, creating the table to track them """
+
+    cur = dbh.cursor()
+    cur.execute("""
+        create table if not exists schema_migration (
+            version integer primary key,
+            description text not null,
+            applied_on timestamp with time zone not null default now()
+        )
+    """)
+    cur.execute('select version from schema_migration')
+    versions = [rec[0] for rec in cur.fetchall()]
+    cur.close()
+
+    return versions
+
+
+# --------------------------------------------------
+def migrate(dbh, migration: Migration) -> None:
+    """ Run the statements of a migration, build its indexes, record it """
+
+    cur = dbh.cursor()
+    for sql in migration.statements:
+        cur.execute(sql)
+
+    for index in migration.indexes:
+        cur.execute(
+            """
+            select i.indisvalid
+            from   pg_index i, pg_class c
+            where  i.indexrelid=c.oid
+            and    c.relname=%s
+            """, (index.name, ))
+
+        if (valid := cur.fetchone()) and not valid[0]:
+            print(f'  Dropping invalid index "{index.name}"')
+            cur.execute(f'drop index concurrently {index.name}')
+
+        start = time.perf_counter()
+        cur.execute(index_sql(index))
+        print(f'  {index.name} ({time.perf_counter() - start:.1f}s)')
+
+    for table in sorted(set(index.table for index in migration.indexes)):
+        cur.execute(f'analyze {table}')
+
+    cur.execute(
+        'insert into schema_migration (version, description) values (%s, %s)',
+        (migration.version, migration.description))
+    cur.close()
+
+
+# --------------------------------------------------
+def index_sql(index: Index) -> str:
+    """ Statement to create an index """
+
+    return ('create {}index concurrently if not exists {} '
+            'on {} using {} ({})').format('unique ' if index.unique else '',
+                                          index.name, index.table,
+                                          index.using,
+                                          ', '.join(index.columns))
+
+
+# --------------------------------------------------
+def benchmark(dbh, repeat: int) -> Dict[str, float]:
+    """ Median milliseconds for each benchmark query """
+
+    cur = dbh.cursor()
+    cur.execute("""
+        select s.study_id, s.nct_id, s.phase_id,
+               s.overall_status_id as status_id,
+               coalesce(s.last_update_posted, current_date) as posted
+        from   study s
+        where  s.study_id = (select max(study_id) from study)
+    """)
+    sample = dict(zip([d[0] for d in cur.description], cur.fetchone()))
+
+    cur.execute("""
+        select   condition_id
+        from     study_to_condition
+        group by 1
+        order by count(*) desc
+        limit    3
+    """)
+    sample['condition_ids'] = [rec[0] for rec in cur.fetchall()]
+
+    timings = {}
+    for name, sql in BENCHMARKS:
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cur.execute(sql, sample)
+            cur.fetchall()
+            runs.append((time.perf_counter() - start) * 1000)
+        timings[name] = statistics.median(runs)
+
+    cur.close()
+    return timings
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Composable study filters for /search
+
+Each predicate compiles to a condition on "study s" and its query
+parameters. Filters on conditions, sponsors and interventions are
+semi-joins (EXISTS/IN) on the link tables rather than joins, so a study
+matching several linked rows is still returned once. Names are matched
+on the stored, GIN-indexed "<table>_fulltext" vectors (see migrate.py).
+
+With "arrays", s is the denormalized study_search (see study_search.py)
+and the same filters test its "<entity>_ids" arrays instead.
+"""
+
+from abc import ABC, abstractmethod
+from typing import List, Tuple
+
+#
+# Link table, entity table, key and name column for each linked entity
+#
+LINKS = {
+    'condition':
+    ('study_to_condition', 'condition', 'condition_id', 'condition_name'),
+    'sponsor': ('study_to_sponsor', 'sponsor', 'sponsor_id', 'sponsor_name'),
+    'intervention': ('study_to_intervention', 'intervention',
+                     'intervention_id', 'intervention_name'),
+}
+
+
+class Predicate(ABC):
+    """ A filter on study s """
+
+    @abstractmethod
+    def compile(self) -> Tuple[str, List]:
+        """ SQL condition and its parameters """
+
+    def __and__(self, other: 'Predicate') -> 'And':
+        return And(self, other)
+
+
+class Where(Predicate):
+    """ A condition on the columns of study s """
+
+    def __init__(self, sql: str, *params):
+        self.sql = sql
+        self.params = list(params)
+
+    def compile(self) -> Tuple[str, List]:
+        return self.sql, self.params
+
+
+class And(Predicate):
+    """ All of the predicates """
+
+    def __init__(self, *predicates: Predicate):
+        self.predicates = []
+        for pred in predicates:
+            self.predicates.extend(
+                pred.predicates if isinstance(pred, And) else [pred])
+
+    def compile(self) -> Tuple[str, List]:
+        if not self.predicates:
+            return 'true', []
+
+        sqls, params = [], []
+        for pred in self.predicates:
+            sql, args = pred.compile()
+            sqls.append(sql)
+            params.extend(args)
+
+        return '\nand '.join(sqls), params
+
+
+class LinkedIds(Predicate):
+    """ Studies linked to any (or with match_all, every) of the ids """
+
+    def __init__(self,
+                 entity: str,
+                 ids: List[int],
+                 match_all: bool = False,
+                 arrays: bool = False):
+        self.link, _, self.key, _ = LINKS[entity]
+        self.entity = entity
+        self.ids = ids
+        self.match_all = match_all
+        self.arrays = arrays
+
+    def compile(self) -> Tuple[str, List]:
+        if self.arrays:
+            op = '@>' if self.match_all else '&&'
+            return f's.{self.entity}_ids {op} %s', [list(self.ids)]
+
+        if self.match_all and len(self.ids) > 1:
+            each = (f'select l.study_id from {self.link} l '
+                    f'where l.{self.key}=%s')
+            return 's.study_id in ({})'.format(' intersect '.join(
+                [each] * len(self.ids))), list(self.ids)
+
+        return (f'exists (select 1 from {self.link} l '
+                f'where l.study_id=s.study_id and l.{self.key} = any(%s))',
+                [list(self.ids)])
+
+
+class LinkedNames(Predicate):
+    """ Studies linked to an entity whose name matches the tsquery """
+
+    def __init__(self,
+                 entity: str,
+                 tsquery: str,
+                 *params,
+                 arrays: bool = False):
+        self.link, self.table, self.key, _ = LINKS[entity]
+        self.entity = entity
+        self.tsquery = tsquery
+        self.params = list(params)
+        self.arrays = arrays
+
+    def compile(self) -> Tuple[str, List]:
+        if self.arrays:
+            return (f's.{self.entity}_ids && array(select x.{self.key} '
+                    f'from {self.table} x '
+                    f'where x.{self.table}_fulltext @@ {self.tsquery})',
+                    self.params)
+
+        return (f'exists (select 1 from {self.link} l, {self.table} x '
+                f'where l.study_id=s.study_id and l.{self.key}=x.{self.key} '
+                f'and x.{self.table}_fulltext @@ {self.tsquery})', self.params)
+
+
+class Eligible(Predicate):
+    """ Studies with eligibility criteria e meeting all the conditions """
+
+    def __init__(self, conditions: And):
+        self.conditions = conditions
+
+    def compile(self) -> Tuple[str, List]:
+        sql, params = self.conditions.compile()
+        return ('exists (select 1 from study_eligibility e '
+                f'where e.study_id=s.study_id and {sql})', params)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Precomputed related studies for /study/{nct_id}/related
+
+Each study is the set of its conditions, interventions, sponsors and
+keywords. A batch job reduces the sets to MinHash signatures, finds
+candidate pairs by locality-sensitive hashing of bands of the
+signatures, scores them by estimated Jaccard similarity and keeps the
+best neighbors of each study, all with vectorized NumPy. The neighbors
+are written to a single file that workers map read-only like the study
+index, so a lookup is a binary search and a slice.
+"""
+
+import argparse
+import psycopg2
+from bisect import bisect_left
+from db import CONFIG_FILE, latest_dataload, make_dsn, read_config
+from mapped import MappedFile
+from typing import List, NamedTuple, Tuple
+
+#
+# Signature of BANDS * ROWS hashes; pairs agreeing on all the rows of
+# any band are compared, which finds most pairs over about 0.3 Jaccard
+# similarity. In buckets over MAX_BUCKET studies (e.g., from a very
+# common condition, or studies with the same features) each study is
+# compared only with the next WINDOW, in an order shuffled per band.
+#
+BANDS = 32
+ROWS = 3
+MAX_BUCKET = 100
+WINDOW = 10
+SEED = 20210501
+BATCH = 100000
+
+#
+# Arrays in file order, with their array typecodes
+#
+SECTIONS = [
+    ('study_id', 'i'),
+    ('neighbor_offset', 'I'),
+    ('neighbor', 'i'),
+    ('similarity', 'f'),
+]
+
+#
+# (study_id, hash of one feature) for every feature of every study
+#
+FEATURES_SQL = r"""
+    select study_id, hashtext('c' || condition_id)
+    from   study_to_condition
+    union all
+    select study_id, hashtext('i' || intervention_id)
+    from   study_to_intervention
+    union all
+    select study_id, hashtext('s' || sponsor_id)
+    from   study_to_sponsor
+    union all
+    select s.study_id, hashtext('k' || lower(trim(k.keyword)))
+    from   study s,
+           regexp_split_to_table(s.keywords, '\s*[,;]\s*') as k(keyword)
+    where  trim(k.keyword) <> ''
+"""
+
+
+class Args(NamedTuple):
+    """ Command-line arguments """
+    config: str
+    outfile: str
+    keep: int
+    min_similarity: float
+
+
+class Related(MappedFile):
+    """ Read-only view of a related-studies file """
+
+    MAGIC = b'CTRS'
+    VERSION = 1
+    KIND = 'related file'
+    SECTIONS = SECTIONS
+
+    @property
+    def num_studies(self) -> int:
+        return self.count
+
+    def neighbors(self, study_id: int, k: int) -> List[Tuple[int, float]]:
+        """ Up to k (study_id, similarity) most like the study, best first """
+
+        ids = self._views['study_id']
+        i = bisect_left(ids, study_id)
+        if i >= self.num_studies or ids[i] != study_id:
+            return []
+
+        offsets = self._views['neighbor_offset']
+        start, end = offsets[i], min(offsets[i + 1], offsets[i] + k)
+        return list(
+            zip(self._views['neighbor'][start:end],
+                self._views['similarity'][start:end]))
+
+
+# --------------------------------------------------
+def get_args() -> Args:
+    """ Get command-line arguments """
+
+    parser = argparse.ArgumentParser(
+        description='Build the related-studies index',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-c',
+                        '--config',
+                        help='Configuration file',
+                        metavar='FILE',
+                        default=CONFIG_FILE)
+
+    parser.add_argument('-o',
+                        '--outfile',
+                        help='Related file (default: related_file '
+                        'from config)',
+                        metavar='FILE',
+                        default='')
+
+    parser.add_argument('-k',
+                        '--keep',
+                        help='Neighbors kept per study',
+                        metavar='INT',
+                        type=int,
+                        default=20)
+
+    parser.add_argument('-m',
+                        '--min_similarity',
+                        help='Leave out neighbors less similar than this',
+                        metavar='FLOAT',
+                        type=float,
+                        default=0.1)
+
+    args = parser.parse_args()
+    return Args(args.config, args.outfile, args.keep, args.min_similarity)
+
+
+# --------------------------------------------------
+def main() -> None:
+    """ Make a jazz noise here """
+
+    args = get_args()
+    config = read_config(args.config)
+    outfile = args.outfile or config['DEFAULT'].get('related_file', '')
+    if not outfile:
+        raise SystemExit('No --outfile and no related_file in config')
+
+    dbh = psycopg2.connect(make_dsn(config))
+    num = build(dbh, outfile, args.keep, args.min_similarity)
+    dbh.close()
+
+    print(f'Wrote neighbors of {num:,} studies to "{outfile}".')
+
+
+# --------------------------------------------------
+def build(dbh,
+          outfile: str,
+          keep: int = 20,
+          min_similarity: float = 0.1) -> int:
+    """ Write the neighbors for the current data, replacing any old file """
+
+    # Only the batch job needs NumPy; the API reads the file without it
+    import numpy as np
+
+    cur = dbh.cursor()
+    dataload = latest_dataload(cur)
+    cur.close()
+
+    cur = dbh.cursor(name='related')
+    cur.itersize = BATCH
+    cur.execute(FEATURES_SQL)
+    batches = [np.zeros((0, 2), dtype=np.int64)]
+    while rows := cur.fetchmany(BATCH):
+        batches.append(np.array(rows, dtype=np.int64))
+    cur.close()
+    dbh.rollback()
+
+    arrays = find_neighbors(np.concatenate(batches), keep, min_similarity)
+    return Related.write(outfile, dataload, len(arrays['study_id']), arrays)
+
+
+# --------------------------------------------------
+def find_neighbors(pairs, keep: int, min_similarity: float) -> dict:
+    """
+    The file's arrays for (study_id, feature hash) pairs: each study's
+    best "keep" neighbors at least min_similarity alike
+    """
+
+    import numpy as np
+
+    if not len(pairs):
+        return {
+            name: np.zeros(1 if name == 'neighbor_offset' else 0, dtype=code)
+            for name, code in SECTIONS
+        }
+
+    # One (study, feature) each, grouped by study
+    keys = np.unique((pairs[:, 0] << 32) | (pairs[:, 1] & 0xffffffff))
+    study_ids, rows = np.unique(keys >> 32, return_inverse=True)
+    features = (keys & 0xffffffff).astype(np.uint64)
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+
+    # MinHash by multiply-shift hashing, wrapping in 64 bits
+    rng = np.random.default_rng(SEED)
+    mult = rng.integers(1, 2**63, BANDS * ROWS, dtype=np.uint64) | 1
+    add = rng.integers(0, 2**63, BANDS * ROWS, dtype=np.uint64)
+    sigs = np.empty((len(study_ids), BANDS * ROWS), dtype=np.uint32)
+    for k in range(BANDS * ROWS):
+        hashes = (features * mult[k] + add[k]) >> np.uint64(32)
+        sigs[:, k] = np.minimum.reduceat(hashes, starts)
+
+    # Candidates share a bucket in some band
+    band_mult = rng.integers(1, 2**63, ROWS, dtype=np.uint64) | 1
+    candidates = []
+    for band in range(BANDS):
+        cols = sigs[:, band * ROWS:(band + 1) * ROWS].astype(np.uint64)
+        bucket = (cols * band_mult).sum(axis=1)
+        order = np.lexsort((rng.random(len(bucket)), bucket))
+        bounds = np.flatnonzero(
+            np.r_[True, bucket[order][1:] != bucket[order][:-1], True])
+        sizes = np.diff(bounds)
+        for size in np.unique(sizes[sizes > 1]):
+            first = bounds[:-1][sizes == size]
+            members = order[first[:, None] + np.arange(size)]
+            if size <= MAX_BUCKET:
+                left, right = np.triu_indices(size, 1)
+            else:
+                left = np.repeat(np.arange(size), WINDOW)
+                right = (left + np.tile(np.arange(1, WINDOW + 1), size)) % size
+            a, b = members[:, left].ravel(), members[:, right].ravel()
+            candidates.append(
+                np.minimum(a, b).astype(np.int64) * len(study_ids) +
+                np.maximum(a, b))
+
+    src, dst, sim = [], [], []
+    if candidates:
+        pair_keys = np.unique(np.concatenate(candidates))
+        left, right = np.divmod(pair_keys, len(study_ids))
+        for i in range(0, len(pair_keys), BATCH):
+            lo, hi = left[i:i + BATCH], right[i:i + BATCH]
+            score = (sigs[lo] == sigs[hi]).mean(axis=1, dtype=np.float32)
+            close = score >= min_similarity
+            src += [lo[close], hi[close]]
+            dst += [hi[close], lo[close]]
+            sim += [score[close], score[close]]
+
+    src = np.concatenate(src) if src else np.zeros(0, dtype=np.int64)
+    dst = np.concatenate(dst) if dst else np.zeros(0, dtype=np.int64)
+    sim = np.concatenate(sim) if sim else np.zeros(0, dtype=np.float32)
+
+    # Best first within each study, then the first "keep" of each
+    order = np.lexsort((dst, -sim, src))
+    src, dst, sim = src[order], dst[order], sim[order]
+    group = np.searchsorted(src, src, side='left')
+    kept = np.arange(len(src)) - group < keep
+    src, dst, sim = src[kept], dst[kept], sim[kept]
+
+    return {
+        'study_id':
+        study_ids.astype(np.int32),
+        'neighbor_offset':
+        np.searchsorted(src, np.arange(len(study_ids) + 1)).astype(np.uint32),
+        'neighbor':
+        study_ids[dst].astype(np.int32),
+        'similarity':
+        sim.astype(np.float32),
+    }
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Blue/green data loads through a shadow schema
+
+"prepare" makes empty copies of the data tables in the shadow schema for
+the loader to fill (with the shadow schema first on its search_path);
+they have no indexes or foreign keys, so rows go in fast. "swap" then
+builds the indexes and constraints the live tables have, carries the
+weighted full-text vectors of unchanged studies forward and computes
+the rest, builds the study search table, analyzes everything and, in one short transaction,
+moves the live tables into the retired schema and the loaded ones into
+public. Readers never see a half-loaded table; the API workers notice
+the new dataload and refresh their caches (see get_dims in main.py).
+The retired tables are kept for inspection until the next "prepare".
+"""
+
+import argparse
+import fulltext
+import psycopg2
+import study_search
+import time
+from db import CONFIG_FILE, latest_dataload, make_dsn, read_config
+from typing import List, NamedTuple, Tuple
+
+RETIRED = 'retired'
+FULLTEXT_BATCH = 1000
+
+#
+# Tables replaced by each load; web users and their saved searches stay
+#
+TABLES = [
+    'dataload', 'status', 'phase', 'study_type', 'condition', 'sponsor',
+    'intervention', 'study', 'study_arm_group', 'study_design', 'study_doc',
+    'study_eligibility', 'study_location', 'study_outcome',
+    'study_to_condition', 'study_to_intervention', 'study_to_sponsor',
+    'study_url'
+]
+
+
+class Args(NamedTuple):
+    """ Command-line arguments """
+    action: str
+    config: str
+    schema: str
+    force: bool
+    lock_timeout: str
+
+
+# --------------------------------------------------
+def get_args() -> Args:
+    """ Get command-line arguments """
+
+    parser = argparse.ArgumentParser(
+        description='Load data into a shadow schema and swap it in',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('action',
+                        help='Make empty tables to load, or swap them in',
+                        metavar='ACTION',
+                        choices=['prepare', 'swap'])
+
+    parser.add_argument('-c',
+                        '--config',
+                        help='Configuration file',
+                        metavar='FILE',
+                        default=CONFIG_FILE)
+
+    parser.add_argument('-s',
+                        '--schema',
+                        help='Shadow schema',
+                        metavar='NAME',
+                        default='shadow')
+
+    parser.add_argument('-f',
+                        '--force',
+                        help='Swap even if the dataload is not newer',
+                        action='store_true')
+
+    parser.add_argument('-l',
+                        '--lock_timeout',
+                        help='Give up the swap if the tables stay busy',
+                        metavar='TIME',
+                        default='10s')
+
+    args = parser.parse_args()
+    return Args(args.action, args.config, args.schema, args.force,
+                args.lock_timeout)
+
+
+# --------------------------------------------------
+def main() -> None:
+    """ Make a jazz noise here """
+
+    args = get_args()
+    config = read_config(args.config)
+    dbh = psycopg2.connect(make_dsn(config))
+
+    if args.action == 'prepare':
+        prepare(dbh, args.schema)
+        print(f'Load into "{args.schema}", then run "swap".')
+    else:
+        dataload = swap(dbh, args.schema, args.force, args.lock_timeout)
+        print(f'Swapped in dataload {dataload}.')
+
+    dbh.close()
+
+
+# --------------------------------------------------
+def prepare(dbh, schema: str) -> None:
+    """ Empty copies of the data tables in schema, without indexes """
+
+    cur = dbh.cursor()
+    cur.execute(f'drop schema if exists {RETIRED} cascade')
+    cur.execute(f'drop schema if exists {schema} cascade')
+    cur.execute(f'create schema {schema}')
+
+    for table in TABLES:
+        cur.execute(f'create table {schema}.{table} (like public.{table} '
+                    'including all excluding indexes)')
+
+        # Serial columns get their own sequences so that none is left
+        # pointing at (or dropped with) the tables they replace
+        for column, sequence in serials(cur, 'public', table):
+            new = f'{schema}.{table}_{column}_seq'
+            cur.execute(f'create sequence {new} '
+                        f'owned by {schema}.{table}.{column}')
+            cur.execute(
+                f'select setval(%s, (select last_value from {sequence}))',
+                (new, ))
+            cur.execute(f'alter table {schema}.{table} alter {column} '
+                        f"set default nextval('{new}')")
+
+    dbh.commit()
+    cur.close()
+
+
+# --------------------------------------------------
+def swap(dbh, schema: str, force: bool, lock_timeout: str) -> str:
+    """
+    Index and analyze the loaded tables, then swap them in; what a swap
+    that gave up on the locks already built is kept, so it can be rerun
+    """
+
+    cur = dbh.cursor()
+    new = latest_dataload(cur, schema)
+    old = latest_dataload(cur, 'public')
+    if not new or (old and new <= old and not force):
+        raise SystemExit(f'Dataload "{new}" in "{schema}" is not newer '
+                         f'than "{old}" (use --force)')
+
+    # Read the definitions before the search path makes them ambiguous
+    indexes, constraints = definitions(cur)
+    cur.execute(f'set search_path to {schema}, public')
+
+    for table, name, sql in indexes:
+        cur.execute('select to_regclass(%s)', (f'{schema}.{name}', ))
+        if cur.fetchone()[0]:
+            continue
+
+        start = time.perf_counter()
+        cur.execute(sql.replace(' ON public.', f' ON {schema}.', 1))
+        print(f'  {name} ({time.perf_counter() - start:.1f}s)')
+
+    for table, name, sql in constraints:
+        cur.execute(
+            'select 1 from pg_constraint where conrelid=%s::regclass '
+            'and conname=%s', (f'{schema}.{table}', name))
+        if not cur.fetchone():
+            cur.execute(f'alter table {schema}.{table} add constraint {name} '
+                        f'{sql}')
+
+    # Only studies new or changed in this load need their vectors built
+    fulltext.prepare(dbh)
+    carried = fulltext.carry_forward(dbh, schema)
+    study_ids = fulltext.candidates(dbh, None)
+    for i in range(0, len(study_ids), FULLTEXT_BATCH):
+        fulltext.update_batch(dbh, study_ids[i:i + FULLTEXT_BATCH])
+    print(f'  fulltext ({carried:,} kept, {len(study_ids):,} built)')
+
+    tables = list(TABLES)
+    cur.execute('select to_regclass(%s)', (f'public.{study_search.TABLE}', ))
+    if cur.fetchone()[0]:
+        cur.execute("select obj_description(to_regclass(%s), 'pg_class')",
+                    (f'{schema}.{study_search.TABLE}', ))
+        if cur.fetchone()[0] != str(new):
+            dbh.commit()
+            study_search.build(dbh, schema)
+        tables.append(study_search.TABLE)
+
+    for table in tables:
+        cur.execute(f'analyze {schema}.{table}')
+
+    dbh.commit()
+
+    # Only this transaction takes locks that make readers wait
+    cur.execute('set local lock_timeout = %s', (lock_timeout, ))
+    cur.execute(f'create schema {RETIRED}')
+    for table in tables:
+        cur.execute(f'alter table public.{table} set schema {RETIRED}')
+        cur.execute(f'alter table {schema}.{table} set schema public')
+
+    dbh.commit()
+    cur.close()
+
+    return str(new)
+
+
+# --------------------------------------------------
+def definitions(cur) -> Tuple[List[Tuple[str, str, str]], ...]:
+    """
+    The live tables' indexes as "create index" statements, and their
+    primary key, unique and foreign key constraints, the first two on
+    the indexes of the same names
+    """
+
+    cur.execute(
+        """
+        select c.relname, i.relname, pg_get_indexdef(x.indexrelid)
+        from   pg_index x, pg_class i, pg_class c
+        where  x.indexrelid=i.oid
+        and    x.indrelid=c.oid
+        and    c.relnamespace='public'::regnamespace
+        and    c.relname = any(%s)
+        """, (TABLES, ))
+    indexes = cur.fetchall()
+
+    cur.execute(
+        """
+        select   c.relname, k.conname,
+                 case k.contype
+                      when 'p' then 'primary key using index ' || k.conname
+                      when 'u' then 'unique using index ' || k.conname
+                      else pg_get_constraintdef(k.oid)
+                 end
+        from     pg_constraint k, pg_class c
+        where    k.conrelid=c.oid
+        and      c.relnamespace='public'::regnamespace
+        and      c.relname = any(%s)
+        and      k.contype in ('p', 'u', 'f')
+        order by k.contype desc
+        """, (TABLES, ))
+    constraints = cur.fetchall()
+
+    return indexes, constraints
+
+
+# --------------------------------------------------
+def serials(cur, schema: str, table: str) -> List[Tuple[str, str]]:
+    """ Columns of a table filled from a sequence, with the sequence """
+
+    cur.execute(
+        """
+        select a.attname, pg_get_serial_sequence(%s, a.attname)
+        from   pg_attribute a
+        where  a.attrelid=%s::regclass
+        and    a.attnum > 0
+        and    not a.attisdropped
+        and    pg_get_serial_sequence(%s, a.attname) is not null
+        """, (f'{schema}.{table}', f'{schema}.{table}', f'{schema}.{table}'))
+
+    return cur.fetchall()
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
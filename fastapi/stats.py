@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+Aggregate cube of the studies for /stats
+
+Studies are counted into cells, one for each combination of phase,
+study type, statuses, start and completion years and enrollment bin
+that occurs. The cube holds the cells and their counts, the cell of
+each study, and which studies have each condition and sponsor, so a
+group-by, filtered on condition or sponsor ids or not, is a few
+vectorized passes over small arrays and never reads the study table.
+It is built once per dataload into a single file that workers map
+read-only like the study index. NumPy is imported only to build or open
+a cube, so workers without one never load it.
+"""
+
+import argparse
+import psycopg2
+from db import CONFIG_FILE, latest_dataload, make_dsn, read_config
+from mapped import MappedFile
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Tuple
+
+if TYPE_CHECKING:
+    import numpy as np
+
+BATCH = 100000
+
+#
+# Group-by name, with the cell column and the lookup table naming it
+#
+DIMENSIONS = {
+    'phase': ('phase_id', 'phase'),
+    'study_type': ('study_type_id', 'study_type'),
+    'overall_status': ('overall_status_id', 'status'),
+    'last_known_status': ('last_known_status_id', 'status'),
+    'start_year': ('start_year', None),
+    'completion_year': ('completion_year', None),
+    'enrollment': ('enrollment_bin', None),
+}
+
+#
+# Entities studies are linked to, with the link table and key
+#
+ENTITIES = {
+    'condition': ('study_to_condition', 'condition_id'),
+    'sponsor': ('study_to_sponsor', 'sponsor_id'),
+}
+
+#
+# Lower bounds of the enrollment bins
+#
+ENROLLMENT_BINS = [0, 1, 10, 50, 100, 500, 1000, 5000, 10000]
+
+#
+# Arrays in file order, with their NumPy dtypes
+#
+SECTIONS = [(col, 'i4') for col, _ in DIMENSIONS.values()] + [
+    ('cell_count', 'u4'),
+    ('study_cell', 'u4'),
+] + [(f'{entity}_{part}', dtype) for entity in ENTITIES
+     for part, dtype in [('id', 'i4'), ('offset', 'u4'), ('row', 'u4')]]
+
+#
+# Unknown values are -1
+#
+STUDIES_SQL = """
+    select   coalesce(s.phase_id, -1),
+             coalesce(s.study_type_id, -1),
+             coalesce(s.overall_status_id, -1),
+             coalesce(s.last_known_status_id, -1),
+             coalesce(extract(year from s.start_date)::int, -1),
+             coalesce(extract(year from s.completion_date)::int, -1),
+             coalesce(s.enrollment, -1),
+             s.study_id
+    from     study s
+    order by s.study_id
+"""
+
+#
+# Largest key space counted with an array per key rather than by sorting
+#
+MAX_BINCOUNT = 1 << 22
+
+
+class Args(NamedTuple):
+    """ Command-line arguments """
+    config: str
+    outfile: str
+
+
+class Cube(MappedFile):
+    """ Read-only view of a cube file """
+
+    MAGIC = b'CTSC'
+    VERSION = 1
+    KIND = 'cube file'
+    SECTIONS = SECTIONS
+
+    def __init__(self, filename: str):
+        super().__init__(filename)
+        self.num_cells = self.count
+        self.num_studies = len(self._views['study_cell'])
+
+    def __len__(self) -> int:
+        return self.num_studies
+
+    def _view(self, offset: int, length: int, dtype: str) -> 'np.ndarray':
+        """ A section as a NumPy array over the mapping """
+
+        import numpy as np
+
+        return np.frombuffer(self._mm,
+                             dtype=dtype,
+                             count=length // np.dtype(dtype).itemsize,
+                             offset=offset)
+
+    def studies(self,
+                entity: str,
+                ids: List[int],
+                match_all: bool,
+                within: Optional['np.ndarray'] = None) -> 'np.ndarray':
+        """
+        Which studies have any (or all) of the entity ids, of those within
+        the given selection if any, as a mask over the study rows
+        """
+
+        import numpy as np
+
+        known = self._views[f'{entity}_id']
+        offsets = self._views[f'{entity}_offset']
+        links = self._views[f'{entity}_row']
+
+        # Each study is listed once per id, so its hits count its ids
+        hits = np.zeros(self.num_studies, dtype=np.uint16)
+        keys = set(ids)
+        for key in keys:
+            i = np.searchsorted(known, key)
+            if i < len(known) and known[i] == key:
+                hits[links[offsets[i]:offsets[i + 1]]] += 1
+
+        selected = hits == len(keys) if match_all else hits > 0
+        if within is not None:
+            selected &= within
+
+        return selected
+
+    def group(self,
+              group_by: List[str],
+              selected: Optional['np.ndarray'] = None,
+              by_count: bool = False,
+              limit: int = 0) -> List[Tuple[Tuple[int, ...], int]]:
+        """
+        Studies (those selected, else all) counted by the values of the
+        dimensions and at most one entity in group_by, keyed on the values
+        in that order (ids, years or enrollment bins; -1 for unknown).
+        Groups are in order of the values, or by_count the largest first.
+        """
+
+        import numpy as np
+
+        arrays = self._views
+        entity = next((g for g in group_by if g in ENTITIES), None)
+
+        if entity:
+            # One count per link, so a study counts once for each sponsor
+            offsets = arrays[f'{entity}_offset'].astype(np.int64)
+            links = arrays[f'{entity}_row']
+            owner = np.repeat(arrays[f'{entity}_id'], np.diff(offsets))
+            if selected is not None:
+                keep = selected[links]
+                links, owner = links[keep], owner[keep]
+            cells = arrays['study_cell'][links]
+            weights = None
+        elif selected is None:
+            cells = np.arange(self.num_cells)
+            weights = arrays['cell_count']
+        else:
+            weights = np.bincount(arrays['study_cell'][selected],
+                                  minlength=self.num_cells)
+            cells = np.flatnonzero(weights)
+            weights = weights[cells]
+
+        if not len(cells):
+            return []
+
+        if not group_by:
+            return [((), int(weights.sum()))]
+
+        columns = [
+            owner if g == entity else arrays[DIMENSIONS[g][0]][cells]
+            for g in group_by
+        ]
+
+        # Pack the values into one key, then count per key
+        lows = [int(col.min()) for col in columns]
+        shape = tuple(
+            int(col.max()) - low + 1 for col, low in zip(columns, lows))
+        keys = np.ravel_multi_index(
+            [col.astype(np.int64) - low for col, low in zip(columns, lows)],
+            shape)
+
+        size = int(np.prod(shape, dtype=np.float64))
+        if size <= MAX_BINCOUNT:
+            counts = np.bincount(keys, weights=weights, minlength=size)
+            keys = np.flatnonzero(counts)
+            counts = counts[keys]
+        else:
+            keys, inverse = np.unique(keys, return_inverse=True)
+            counts = np.bincount(inverse, weights=weights)
+
+        if by_count:
+            order = np.argsort(-counts, kind='stable')
+            keys, counts = keys[order], counts[order]
+        if limit:
+            keys, counts = keys[:limit], counts[:limit]
+
+        values = np.stack(np.unravel_index(keys, shape), axis=1) + lows
+        return [(tuple(map(int, value)), int(count))
+                for value, count in zip(values, counts)]
+
+
+# --------------------------------------------------
+def enrollment_label(enrollment_bin: int) -> str:
+    """ Range of enrollment of a bin, e.g., "10-49" or "10000+" """
+
+    low = ENROLLMENT_BINS[enrollment_bin]
+    if enrollment_bin + 1 == len(ENROLLMENT_BINS):
+        return f'{low}+'
+
+    high = ENROLLMENT_BINS[enrollment_bin + 1] - 1
+    return str(low) if low == high else f'{low}-{high}'
+
+
+# --------------------------------------------------
+def get_args() -> Args:
+    """ Get command-line arguments """
+
+    parser = argparse.ArgumentParser(
+        description='Build the aggregate cube for /stats',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-c',
+                        '--config',
+                        help='Configuration file',
+                        metavar='FILE',
+                        default=CONFIG_FILE)
+
+    parser.add_argument('-o',
+                        '--outfile',
+                        help='Cube file (default: stats_file from config)',
+                        metavar='FILE',
+                        default='')
+
+    args = parser.parse_args()
+    return Args(args.config, args.outfile)
+
+
+# --------------------------------------------------
+def main() -> None:
+    """ Make a jazz noise here """
+
+    args = get_args()
+    config = read_config(args.config)
+    outfile = args.outfile or config['DEFAULT'].get('stats_file', '')
+    if not outfile:
+        raise SystemExit('No --outfile and no stats_file in config')
+
+    dbh = psycopg2.connect(make_dsn(config))
+    num = build(dbh, outfile)
+    dbh.close()
+
+    print(f'Wrote {num:,} cells to "{outfile}".')
+
+
+# --------------------------------------------------
+def build(dbh, outfile: str) -> int:
+    """ Write the cube for the current data, replacing any old file """
+
+    cur = dbh.cursor()
+    dataload = latest_dataload(cur)
+    cur.close()
+
+    studies = fetch(dbh, STUDIES_SQL, len(DIMENSIONS) + 1)
+    links = {
+        entity: fetch(dbh, f'select {key}, study_id from {link}', 2)
+        for entity, (link, key) in ENTITIES.items()
+    }
+    arrays = cube_arrays(studies, links)
+
+    return Cube.write(outfile, dataload, len(arrays['cell_count']), arrays)
+
+
+# --------------------------------------------------
+def cube_arrays(studies: 'np.ndarray',
+                links: Dict[str, 'np.ndarray']) -> Dict[str, 'np.ndarray']:
+    """
+    The sections of a cube from rows of the dimension values and study_id
+    (in study_id order, as STUDIES_SQL) and, for each entity, rows of its
+    id and a study_id, all int64; the enrollments are binned in place
+    """
+
+    import numpy as np
+
+    study_ids = studies[:, -1]
+
+    enrollment = studies[:, len(DIMENSIONS) - 1]
+    studies[:, len(DIMENSIONS) - 1] = np.where(
+        enrollment < 0, -1,
+        np.searchsorted(ENROLLMENT_BINS, enrollment, side='right') - 1)
+
+    cells, study_cell, cell_count = np.unique(studies[:, :len(DIMENSIONS)],
+                                              axis=0,
+                                              return_inverse=True,
+                                              return_counts=True)
+
+    arrays = {
+        col: cells[:, i]
+        for i, (col, _) in enumerate(DIMENSIONS.values())
+    }
+    arrays['cell_count'] = cell_count
+    arrays['study_cell'] = study_cell.ravel()
+
+    for entity in ENTITIES:
+        pairs = links[entity]
+        pairs = pairs[np.isin(pairs[:, 1], study_ids)]
+        rows = np.searchsorted(study_ids, pairs[:, 1])
+
+        # Sorted by entity, then study, without repeats
+        rows_by_id = np.unique((pairs[:, 0] << 32) | rows)
+        ids, starts = np.unique(rows_by_id >> 32, return_index=True)
+        arrays[f'{entity}_id'] = ids
+        arrays[f'{entity}_offset'] = np.append(starts, len(rows_by_id))
+        arrays[f'{entity}_row'] = rows_by_id & 0xffffffff
+
+    return {name: arrays[name].astype(dtype) for name, dtype in SECTIONS}
+
+
+# --------------------------------------------------
+def fetch(dbh, sql: str, width: int) -> 'np.ndarray':
+    """ Rows of ints from the query as one array, read in batches """
+
+    import numpy as np
+
+    cur = dbh.cursor(name='stats')
+    cur.itersize = BATCH
+    cur.execute(sql)
+    batches = [np.zeros((0, width), dtype=np.int64)]
+    while rows := cur.fetchmany(BATCH):
+        batches.append(np.array(rows, dtype=np.int64))
+    cur.close()
+    dbh.rollback()
+
+    return np.concatenate(batches)
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
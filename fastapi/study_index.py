@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped index of study metadata shared by the API workers
+
+The index is built once per dataload into a single file of fixed-width
+arrays sorted by study_id. Workers map it read-only, so the pages live
+once in the OS page cache no matter how many workers are running.
+"""
+
+import argparse
+import psycopg2
+from array import array
+from bisect import bisect_left
+from datetime import date
+from db import CONFIG_FILE, latest_dataload, make_dsn, read_config
+from mapped import MappedFile
+from typing import NamedTuple, Optional
+
+NCT_WIDTH = 11
+
+#
+# Arrays in file order, with their array typecodes; "B" is a raw blob
+#
+SECTIONS = [
+    ('study_id', 'i'),
+    ('nct_order', 'i'),
+    ('phase_id', 'h'),
+    ('study_type_id', 'h'),
+    ('overall_status_id', 'h'),
+    ('last_known_status_id', 'h'),
+    ('enrollment', 'i'),
+    ('start_date', 'i'),
+    ('completion_date', 'i'),
+    ('brief_title_offset', 'I'),
+    ('official_title_offset', 'I'),
+    ('nct_id', 'B'),
+    ('brief_title', 'B'),
+    ('official_title', 'B'),
+]
+
+
+class Args(NamedTuple):
+    """ Command-line arguments """
+    config: str
+    outfile: str
+
+
+class StudyRecord(NamedTuple):
+    """ Study metadata held in the index """
+    study_id: int
+    nct_id: str
+    brief_title: str
+    official_title: str
+    phase_id: Optional[int]
+    study_type_id: Optional[int]
+    overall_status_id: Optional[int]
+    last_known_status_id: Optional[int]
+    enrollment: Optional[int]
+    start_date: Optional[date]
+    completion_date: Optional[date]
+
+
+class StudyIndex(MappedFile):
+    """ Read-only view of an index file """
+
+    MAGIC = b'CTSI'
+    VERSION = 1
+    KIND = 'index'
+    SECTIONS = SECTIONS
+
+    @property
+    def num_studies(self) -> int:
+        return self.count
+
+    def get(self, study_id: int) -> Optional[StudyRecord]:
+        """ Look up a study by study_id """
+
+        ids = self._views['study_id']
+        i = bisect_left(ids, study_id)
+        if i < self.num_studies and ids[i] == study_id:
+            return self._record(i)
+
+    def find(self, nct_id: str) -> Optional[StudyRecord]:
+        """ Look up a study by nct_id """
+
+        key = nct_id.encode().ljust(NCT_WIDTH, b'\0')[:NCT_WIDTH]
+        order = self._views['nct_order']
+        lo, hi = 0, self.num_studies
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._nct_bytes(order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < self.num_studies and self._nct_bytes(order[lo]) == key:
+            return self._record(order[lo])
+
+    def _nct_bytes(self, i: int) -> bytes:
+        return self._views['nct_id'][i * NCT_WIDTH:(i + 1) *
+                                     NCT_WIDTH].tobytes()
+
+    def _text(self, name: str, i: int) -> str:
+        offsets = self._views[f'{name}_offset']
+        return self._views[name][offsets[i]:offsets[i + 1]].tobytes().decode()
+
+    def _record(self, i: int) -> StudyRecord:
+        views = self._views
+
+        def code(name):
+            return views[name][i] if views[name][i] >= 0 else None
+
+        def day(name):
+            return date.fromordinal(views[name][i]) if views[name][i] else None
+
+        return StudyRecord(
+            study_id=views['study_id'][i],
+            nct_id=self._nct_bytes(i).rstrip(b'\0').decode(),
+            brief_title=self._text('brief_title', i),
+            official_title=self._text('official_title', i),
+            phase_id=code('phase_id'),
+            study_type_id=code('study_type_id'),
+            overall_status_id=code('overall_status_id'),
+            last_known_status_id=code('last_known_status_id'),
+            enrollment=code('enrollment'),
+            start_date=day('start_date'),
+            completion_date=day('completion_date'))
+
+
+# --------------------------------------------------
+def get_args() -> Args:
+    """ Get command-line arguments """
+
+    parser = argparse.ArgumentParser(
+        description='Build the memory-mapped study index',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-c',
+                        '--config',
+                        help='Configuration file',
+                        metavar='FILE',
+                        default=CONFIG_FILE)
+
+    parser.add_argument('-o',
+                        '--outfile',
+                        help='Index file (default: study_index_file '
+                        'from config)',
+                        metavar='FILE',
+                        default='')
+
+    args = parser.parse_args()
+    return Args(args.config, args.outfile)
+
+
+# --------------------------------------------------
+def main() -> None:
+    """ Make a jazz noise here """
+
+    args = get_args()
+    config = read_config(args.config)
+    outfile = args.outfile or config['DEFAULT'].get('study_index_file', '')
+    if not outfile:
+        raise SystemExit('No --outfile and no study_index_file in config')
+
+    dbh = psycopg2.connect(make_dsn(config))
+    num = build(dbh, outfile)
+    dbh.close()
+
+    print(f'Wrote {num:,} studies to "{outfile}".')
+
+
+# --------------------------------------------------
+def build(dbh, outfile: str) -> int:
+    """ Write the index for the current data, replacing any old file """
+
+    cur = dbh.cursor()
+    dataload = latest_dataload(cur)
+    cur.close()
+
+    arrays = {
+        name: array(code) if code != 'B' else bytearray()
+        for name, code in SECTIONS
+    }
+    arrays['brief_title_offset'].append(0)
+    arrays['official_title_offset'].append(0)
+    nct_ids = []
+
+    cur = dbh.cursor(name='study_index')
+    cur.itersize = 10000
+    cur.execute("""
+        select   s.study_id, s.nct_id, s.brief_title, s.official_title,
+                 s.phase_id, s.study_type_id, s.overall_status_id,
+                 s.last_known_status_id, s.enrollment,
+                 s.start_date, s.completion_date
+        from     study s
+        order by s.study_id
+    """)
+
+    def code(val):
+        return -1 if val is None else val
+
+    for (study_id, nct_id, brief_title, official_title, phase_id,
+         study_type_id, overall_status_id, last_known_status_id, enrollment,
+         start_date, completion_date) in cur:
+        nct = (nct_id or '').encode().ljust(NCT_WIDTH, b'\0')[:NCT_WIDTH]
+        nct_ids.append(nct)
+        arrays['study_id'].append(study_id)
+        arrays['nct_id'].extend(nct)
+        arrays['phase_id'].append(code(phase_id))
+        arrays['study_type_id'].append(code(study_type_id))
+        arrays['overall_status_id'].append(code(overall_status_id))
+        arrays['last_known_status_id'].append(code(last_known_status_id))
+        arrays['enrollment'].append(code(enrollment))
+        arrays['start_date'].append(
+            start_date.toordinal() if start_date else 0)
+        arrays['completion_date'].append(
+            completion_date.toordinal() if completion_date else 0)
+
+        for name, text in [('brief_title', brief_title),
+                           ('official_title', official_title)]:
+            arrays[name].extend((text or '').encode())
+            arrays[f'{name}_offset'].append(len(arrays[name]))
+
+    cur.close()
+    dbh.rollback()
+
+    arrays['nct_order'].extend(
+        sorted(range(len(nct_ids)), key=nct_ids.__getitem__))
+
+    return StudyIndex.write(outfile, dataload, len(nct_ids), arrays)
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Denormalized table of the study columns /search filters on
+
+One row per study holds the ids of its conditions, sponsors and
+interventions as GIN-indexed integer arrays next to the study's own
+filter columns and fulltext vector, so a search on several filters is
+one indexed scan of one table with no link tables to walk. The table is
+built aside and swapped in per dataload; its comment records the
+dataload it was built from, and the API uses it only while that matches.
+"""
+
+import argparse
+import psycopg2
+import time
+from db import CONFIG_FILE, latest_dataload, make_dsn, read_config
+from typing import NamedTuple
+
+TABLE = 'study_search'
+
+#
+# Study columns copied as they are; the ones /search can return
+#
+COLUMNS = [
+    'study_id', 'nct_id', 'official_title', 'brief_title', 'enrollment',
+    'start_date', 'completion_date', 'study_first_posted',
+    'last_update_posted', 'phase_id', 'study_type_id', 'overall_status_id',
+    'last_known_status_id'
+]
+
+#
+# Linked entity ids gathered into "<entity>_ids" arrays from each link table
+#
+LINKED = {
+    'condition': ('study_to_condition', 'condition_id'),
+    'sponsor': ('study_to_sponsor', 'sponsor_id'),
+    'intervention': ('study_to_intervention', 'intervention_id'),
+}
+
+#
+# Indexed columns, with the index method
+#
+INDEXES = [
+    ('phase_id', 'btree'),
+    ('study_type_id', 'btree'),
+    ('overall_status_id', 'btree'),
+    ('last_known_status_id', 'btree'),
+    ('enrollment', 'btree'),
+    ('study_first_posted', 'btree'),
+    ('last_update_posted', 'btree'),
+    ('fulltext', 'gin'),
+] + [(f'{entity}_ids', 'gin') for entity in LINKED]
+
+
+class Args(NamedTuple):
+    """ Command-line arguments """
+    config: str
+
+
+# --------------------------------------------------
+def get_args() -> Args:
+    """ Get command-line arguments """
+
+    parser = argparse.ArgumentParser(
+        description='Build the denormalized study search table',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-c',
+                        '--config',
+                        help='Configuration file',
+                        metavar='FILE',
+                        default=CONFIG_FILE)
+
+    args = parser.parse_args()
+    return Args(args.config)
+
+
+# --------------------------------------------------
+def main() -> None:
+    """ Make a jazz noise here """
+
+    args = get_args()
+    config = read_config(args.config)
+    dbh = psycopg2.connect(make_dsn(config))
+
+    start = time.perf_counter()
+    num = build(dbh)
+    dbh.close()
+
+    print(f'Wrote {num:,} studies to "{TABLE}" '
+          f'({time.perf_counter() - start:.1f}s).')
+
+
+# --------------------------------------------------
+def build(dbh, schema: str = 'public') -> int:
+    """
+    Build the table in schema from the tables on the search path and swap
+    it in for any old one
+    """
+
+    new = f'{TABLE}_new'
+    cur = dbh.cursor()
+    dataload = latest_dataload(cur)
+
+    arrays = [
+        f"""coalesce((select   array_agg(l.{key} order by l.{key})
+                      from     {link} l
+                      where    l.study_id=s.study_id), '{{}}')
+            as {entity}_ids""" for entity, (link, key) in LINKED.items()
+    ]
+
+    cur.execute(f'drop table if exists {schema}.{new}')
+    cur.execute("""
+        create table {}.{} as
+        select {}, s.fulltext,
+               {}
+        from   study s
+    """.format(schema, new, ', '.join(f's.{col}' for col in COLUMNS),
+               ',\n'.join(arrays)))
+    num = cur.rowcount
+
+    cur.execute(f'alter table {schema}.{new} add primary key (study_id)')
+    for column, using in INDEXES:
+        cur.execute(f'create index {new}_{column}_idx '
+                    f'on {schema}.{new} using {using} ({column})')
+
+    cur.execute(f'analyze {schema}.{new}')
+
+    # Readers wait only for the drop and renames, not the build
+    cur.execute(f'drop table if exists {schema}.{TABLE}')
+    cur.execute(f'alter table {schema}.{new} rename to {TABLE}')
+    cur.execute(f'alter index {schema}.{new}_pkey rename to {TABLE}_pkey')
+    for column, _ in INDEXES:
+        cur.execute(f'alter index {schema}.{new}_{column}_idx '
+                    f'rename to {TABLE}_{column}_idx')
+
+    cur.execute(f'comment on table {schema}.{TABLE} is %s', (dataload, ))
+    dbh.commit()
+    cur.close()
+
+    return num
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
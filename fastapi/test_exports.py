@@ -0,0 +1,76 @@
+"""
+Background export jobs, on a scratch directory
+"""
+
+import os
+import threading
+import time
+from exports import Exports
+
+
+# --------------------------------------------------
+def wait(exports: Exports, key: str) -> dict:
+    """ The job's state once it has finished """
+
+    for _ in range(500):
+        state = exports.status(key)
+        if state and state['status'] in ('done', 'failed'):
+            return state
+        time.sleep(.01)
+
+    raise AssertionError(f'Export "{key}" did not finish')
+
+
+# --------------------------------------------------
+def test_same_export(tmp_path) -> None:
+    """ Identical submits at once share one job and one complete file """
+
+    exports = Exports(str(tmp_path), 1, 4)
+    builds = []
+
+    def build(fh, progress) -> int:
+        builds.append(threading.get_ident())
+        for i in range(100):
+            fh.write(f'{i}\n')
+            time.sleep(.001)
+        return 100
+
+    threads = [
+        threading.Thread(target=exports.submit, args=('abc', 100, build))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    state = wait(exports, 'abc')
+    exports.close()
+
+    assert len(builds) == 1
+    assert state['status'] == 'done'
+    assert state['num_studies'] == 100
+    with open(exports.path('abc')) as fh:
+        assert fh.read() == ''.join(f'{i}\n' for i in range(100))
+    assert sorted(os.listdir(tmp_path)) == ['abc.csv', 'abc.json']
+
+
+# --------------------------------------------------
+def test_failed_export(tmp_path) -> None:
+    """ A failed job leaves no file behind, and a new submit runs again """
+
+    exports = Exports(str(tmp_path), 1, 1)
+
+    def broken(fh, progress) -> int:
+        fh.write('partial')
+        raise RuntimeError('database went away')
+
+    exports.submit('abc', 1, broken)
+    state = wait(exports, 'abc')
+    assert state['status'] == 'failed'
+    assert state['error'] == 'database went away'
+    assert os.listdir(tmp_path) == ['abc.json']
+
+    exports.submit('abc', 1, lambda fh, progress: fh.write('ok') and 1)
+    assert wait(exports, 'abc')['status'] == 'done'
+    exports.close()
@@ -0,0 +1,149 @@
+"""
+API responses, those needing the database in config.ini skipped without it
+"""
+
+import main
+import psycopg2
+import pytest
+from db import CONFIG_FILE, make_dsn, read_config
+from exports import Exports
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+
+# --------------------------------------------------
+@pytest.fixture(scope='module')
+def client():
+    """ API client """
+
+    try:
+        psycopg2.connect(make_dsn(read_config(CONFIG_FILE))).close()
+    except (AssertionError, psycopg2.OperationalError) as e:
+        pytest.skip(f'No database: {e}')
+
+    with TestClient(main.app) as client:
+        yield client
+
+
+# --------------------------------------------------
+def test_bad_tsquery(client) -> None:
+    """ Malformed boolean searches are the caller's error """
+
+    for url in ['/search?text=%26%26%26&text_bool=1',
+                '/conditions?name=%26%26%26&bool_search=1',
+                '/sponsors?name=%26%26%26&bool_search=1']:
+        res = client.get(url)
+        assert res.status_code == 400, url
+        assert res.json()['detail']['error'] == 'bad_query', url
+
+
+# --------------------------------------------------
+def test_bad_search_params(client) -> None:
+    """ Unranked relevance and negative limits are rejected up front """
+
+    for url in ['/search?sort=relevance&condition_ids=1',
+                '/search?text=cancer&limit=-1']:
+        assert client.get(url).status_code == 400, url
+
+
+# --------------------------------------------------
+def test_new_since() -> None:
+    """ Saved search deltas follow NCT IDs from one dataload to the next """
+
+    # Each dataload numbers the same studies afresh
+    first = ([1, 2, 3], ['NCT01', 'NCT02', 'NCT03'])
+    second = ([101, 102, 103], ['NCT01', 'NCT02', 'NCT03'])
+    assert main.new_since(*second, first[1]) == []
+
+    third = ([201, 202, 204], ['NCT01', 'NCT02', 'NCT04'])
+    assert main.new_since(*third, second[1]) == [204]
+
+
+# --------------------------------------------------
+def test_gender_all() -> None:
+    """ Any gender is no filter; one gender also takes studies open to all """
+
+    sql, _ = main.search_filters(phase_ids='1', gender='All')[2].compile()
+    assert 'eligible_gender' not in sql
+
+    sql, params = main.search_filters(gender='female')[2].compile()
+    assert 'e.eligible_gender in (%s, %s)' in sql
+    assert params == ['all', 'female']
+
+
+# --------------------------------------------------
+def test_parse_age() -> None:
+    """ Ages in days, in years when no unit is given """
+
+    assert main.parse_age('18') == 18 * 365.25
+    assert main.parse_age(' 6 Months ') == 6 * 30.4375
+    assert main.parse_age('2 weeks') == 14
+    assert main.parse_age('1.5 years') == 1.5 * 365.25
+    assert main.parse_age('12 Hours') == .5
+    assert main.parse_age('150') == 150 * 365.25
+
+    for age in ['', 'N/A', '18 yrs', '-1', 'eighteen', '151 years']:
+        with pytest.raises(HTTPException) as e:
+            main.parse_age(age)
+        assert e.value.status_code == 400, age
+
+
+# --------------------------------------------------
+def test_eligibility_filters() -> None:
+    """ Eligibility conditions go in one subquery of study_eligibility """
+
+    sql, params = main.search_filters(age='30',
+                                      min_age='6 months',
+                                      max_age='65',
+                                      gender='male',
+                                      healthy_volunteers=1)[2].compile()
+    assert sql.count('from study_eligibility e') == 1
+    assert 'e.age_days @> age_in_days(%s)' in sql
+    assert 'e.age_days && int4range(age_in_days(%s), age_in_days(%s)' in sql
+    assert 'e.accepts_healthy_volunteers' in sql
+    assert params == ['30', '6 months', '65', 'all', 'male']
+
+    sql, params = main.search_filters(max_age='2 years')[2].compile()
+    assert params == [None, '2 years']
+
+    for bad in [dict(min_age='65', max_age='18'), dict(age='N/A'),
+                dict(gender='other')]:
+        with pytest.raises(HTTPException) as e:
+            main.search_filters(**bad)
+        assert e.value.status_code == 400, bad
+
+
+# --------------------------------------------------
+def test_export_range(tmp_path, monkeypatch) -> None:
+    """ Export downloads resume from a byte range """
+
+    exports = Exports(str(tmp_path), 1, 1)
+    monkeypatch.setattr(main, 'exports', exports)
+    key = '0123456789abcdef0123456789abcdef'
+    exports.submit(key, 1, lambda fh, progress: fh.write('0123456789') and 1)
+    exports.pool.shutdown(wait=True)
+
+    # No lifespan, so no database
+    client = TestClient(main.app)
+    url = f'/exports/{key}/file'
+
+    res = client.get(url)
+    assert res.status_code == 200
+    assert res.content == b'0123456789'
+
+    for byte_range, body, content_range in [
+        ('bytes=2-5', b'2345', 'bytes 2-5/10'),
+        ('bytes=7-', b'789', 'bytes 7-9/10'),
+        ('bytes=-3', b'789', 'bytes 7-9/10'),
+        ('bytes=8-20', b'89', 'bytes 8-9/10'),
+    ]:
+        res = client.get(url, headers={'Range': byte_range})
+        assert res.status_code == 206, byte_range
+        assert res.content == body, byte_range
+        assert res.headers['content-range'] == content_range, byte_range
+
+    for byte_range in ['bytes=10-', 'bytes=5-2', 'bytes=-', 'lines=1-2']:
+        res = client.get(url, headers={'Range': byte_range})
+        assert res.status_code == 416, byte_range
+
+    assert client.get(f'/exports/{"f" * 32}/file').status_code == 404
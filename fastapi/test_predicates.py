@@ -0,0 +1,74 @@
+"""
+The predicate-built /search filters find the same studies as the old ones
+
+Needs the database in config.ini; skipped without it.
+"""
+
+import psycopg2
+import pytest
+from bench_predicates import cases, legacy_sql, new_sql, sample
+from db import CONFIG_FILE, make_dsn, read_config
+from predicates import And, LinkedIds, Predicate, Where
+
+
+# --------------------------------------------------
+@pytest.fixture(scope='module')
+def cur():
+    """ Database cursor """
+
+    try:
+        dbh = psycopg2.connect(make_dsn(read_config(CONFIG_FILE)))
+    except (AssertionError, psycopg2.OperationalError) as e:
+        pytest.skip(f'No database: {e}')
+
+    cur = dbh.cursor()
+    yield cur
+    cur.close()
+    dbh.close()
+
+
+# --------------------------------------------------
+def test_same_studies(cur) -> None:
+    """ Every filter and pair of filters """
+
+    for params in cases(sample(cur)):
+        cur.execute(legacy_sql(params))
+        old = set(rec[0] for rec in cur.fetchall())
+
+        cur.execute(*new_sql(params))
+        new = [rec[0] for rec in cur.fetchall()]
+
+        assert len(new) == len(set(new)), params
+        assert set(new) == old, params
+
+
+# --------------------------------------------------
+def test_compile() -> None:
+    """ Predicates combine into one condition with ordered parameters """
+
+    filters = Where('s.phase_id = %s', 2) & LinkedIds('sponsor', [5, 6])
+    filters &= Where('s.enrollment >= %s', 100)
+    sql, params = filters.compile()
+
+    assert sql.split('\nand ')[0] == 's.phase_id = %s'
+    assert 'from study_to_sponsor l' in sql
+    assert params == [2, [5, 6], 100]
+    assert And().compile() == ('true', [])
+
+    with pytest.raises(TypeError):
+        Predicate()
+
+
+# --------------------------------------------------
+def test_age_in_days(cur) -> None:
+    """ Eligibility ages as written in the criteria, in days """
+
+    cur.execute("select to_regprocedure('age_in_days(text)')")
+    if not cur.fetchone()[0]:
+        pytest.skip('No age_in_days(); run migrate.py')
+
+    for age, days in [('18 Years', 6575), ('6 Months', 183), ('2 Weeks', 14),
+                      ('30 days', 30), ('1.5 years', 548), ('12 Hours', 1),
+                      ('18', 6575), ('N/A', None), ('', None), (None, None)]:
+        cur.execute('select age_in_days(%s)', (age, ))
+        assert cur.fetchone()[0] == days, age
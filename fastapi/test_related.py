@@ -0,0 +1,70 @@
+"""
+Neighbors found by the related-studies build, on made-up studies
+"""
+
+import numpy as np
+import os
+import pytest
+from related import Related, find_neighbors
+
+
+# --------------------------------------------------
+def built(tmp_path, pairs) -> Related:
+    """ The related file for (study_id, feature) pairs """
+
+    filename = os.path.join(tmp_path, 'related.bin')
+    arrays = find_neighbors(pairs, 20, 0.1)
+    Related.write(filename, '2021-06-01', len(arrays['study_id']), arrays)
+    return Related(filename)
+
+
+# --------------------------------------------------
+def test_large_bucket(tmp_path) -> None:
+    """ Studies with the same features all fall in one bucket """
+
+    num, features = 300, [11, 22, 33]
+    pairs = np.array([(study_id, feature) for study_id in range(1, num + 1)
+                      for feature in features])
+
+    related = built(tmp_path, pairs)
+
+    for study_id in range(1, num + 1):
+        found = related.neighbors(study_id, 20)
+        assert len(found) == 20, study_id
+        assert all(sim == 1.0 for _, sim in found)
+        assert study_id not in [other for other, _ in found]
+
+    related.close()
+
+
+# --------------------------------------------------
+def test_small_bucket(tmp_path) -> None:
+    """ Every pair of a few alike studies is compared """
+
+    pairs = np.array([(1, 11), (1, 22), (2, 11), (2, 22), (3, 11), (3, 22),
+                      (4, 99)])
+
+    related = built(tmp_path, pairs)
+
+    assert sorted(related.neighbors(1, 20)) == [(2, 1.0), (3, 1.0)]
+    assert related.neighbors(4, 20) == []
+    assert related.neighbors(5, 20) == []
+
+    related.close()
+
+
+# --------------------------------------------------
+def test_truncated(tmp_path) -> None:
+    """ A half-written file is refused like a file of another version """
+
+    related = built(tmp_path, np.array([(1, 11), (2, 11)]))
+    filename = related.filename
+    related.close()
+    with open(filename, 'rb') as fh:
+        data = fh.read()
+
+    for size in [5, 30, len(data) - 3]:
+        with open(filename, 'wb') as fh:
+            fh.write(data[:size])
+        with pytest.raises(ValueError):
+            Related(filename)
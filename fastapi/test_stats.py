@@ -0,0 +1,83 @@
+"""
+Group-by counts from a stats cube built on made-up studies
+"""
+
+import numpy as np
+import os
+from stats import Cube, cube_arrays
+
+#
+# Phase, study type, overall and last known status, start and completion
+# years, enrollment, study_id; -1 is unknown
+#
+STUDIES = [
+    (1, 1, 1, -1, 2020, 2022, 5, 1),
+    (1, 1, 1, -1, 2020, 2022, 7, 2),
+    (2, 1, 2, -1, 2021, -1, 100, 3),
+    (2, 2, 2, -1, 2021, -1, -1, 4),
+    (-1, 2, 1, -1, -1, -1, 20000, 5),
+]
+
+#
+# (id, study_id), with a repeat and a study not loaded
+#
+LINKS = {
+    'condition': [(10, 1), (10, 3), (20, 3), (20, 4), (10, 3), (30, 99)],
+    'sponsor': [(7, 1), (7, 2), (8, 5)],
+}
+
+
+# --------------------------------------------------
+def built(tmp_path) -> Cube:
+    """ The cube file for the studies """
+
+    filename = os.path.join(tmp_path, 'stats.bin')
+    arrays = cube_arrays(
+        np.array(STUDIES, dtype=np.int64), {
+            entity: np.array(pairs, dtype=np.int64)
+            for entity, pairs in LINKS.items()
+        })
+    Cube.write(filename, '2021-06-01', len(arrays['cell_count']), arrays)
+    return Cube(filename)
+
+
+# --------------------------------------------------
+def test_group(tmp_path) -> None:
+    """ Counts by dimensions, binned enrollment and linked entities """
+
+    cube = built(tmp_path)
+
+    assert len(cube) == 5
+    assert cube.group([]) == [((), 5)]
+    assert cube.group(['phase']) == [((-1, ), 1), ((1, ), 2), ((2, ), 2)]
+    assert cube.group(['enrollment']) == [((-1, ), 1), ((1, ), 2),
+                                          ((4, ), 1), ((8, ), 1)]
+    assert cube.group(['phase', 'study_type']) == [((-1, 2), 1),
+                                                   ((1, 1), 2),
+                                                   ((2, 1), 1),
+                                                   ((2, 2), 1)]
+    assert cube.group(['condition']) == [((10, ), 2), ((20, ), 2)]
+    assert cube.group(['phase'], by_count=True, limit=1) == [((1, ), 2)]
+
+
+# --------------------------------------------------
+def test_filtered(tmp_path) -> None:
+    """ Counts of the studies with any or all of some conditions """
+
+    cube = built(tmp_path)
+
+    either = cube.studies('condition', [10, 20], match_all=False)
+    both = cube.studies('condition', [10, 20], match_all=True)
+    assert list(np.flatnonzero(either)) == [0, 2, 3]
+    assert list(np.flatnonzero(both)) == [2]
+    assert not cube.studies('condition', [999], match_all=False).any()
+
+    assert cube.group(['phase'], either) == [((1, ), 1), ((2, ), 2)]
+    assert cube.group(['phase'], both) == [((2, ), 1)]
+
+    sponsored = cube.studies('sponsor', [7], match_all=False)
+    assert cube.group(['condition', 'phase'], sponsored) == [((10, 1), 1)]
+    assert cube.group(
+        ['sponsor'],
+        cube.studies('condition', [20], match_all=False,
+                     within=sponsored)) == []